@@ -243,8 +243,7 @@ def main(args):
 
         parser = StreamableParser(encoding, role=Role.ASSISTANT)
         field_created = False
-        current_output_text = ""
-        output_text_delta_buffer = ""
+        citation_normalizer = browser_tool.citation_normalizer() if args.browser else None
         for predicted_token in generator.generate(tokens, encoding.stop_tokens_for_assistant_actions()):
             parser.process(predicted_token)
             if args.raw:
@@ -267,17 +266,12 @@ def main(args):
                 else:
                     print(termcolor.colored("CoT:", "yellow"), flush=True)
 
-            should_send_output_text_delta = True
-            output_text_delta_buffer += parser.last_content_delta
-            if args.browser:
-                updated_output_text, _annotations, has_partial_citations = browser_tool.normalize_citations(current_output_text + output_text_delta_buffer)
-                output_text_delta_buffer = updated_output_text[len(current_output_text):]
-                if has_partial_citations:
-                    should_send_output_text_delta = False
-            if should_send_output_text_delta:
-                print(output_text_delta_buffer, end="", flush=True)
-                current_output_text += output_text_delta_buffer
-                output_text_delta_buffer = ""
+            output_text_delta = parser.last_content_delta
+            if citation_normalizer is not None:
+                # Unfinished citations are held back until complete
+                output_text_delta, _annotations, _has_partial_citations = citation_normalizer.feed(output_text_delta)
+            if output_text_delta:
+                print(output_text_delta, end="", flush=True)
 
         messages += parser.messages
 
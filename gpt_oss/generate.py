@@ -8,18 +8,29 @@ import argparse
 from gpt_oss.tokenizer import get_tokenizer
 
 
+def get_drafter(args, device):
+    if args.draft_tokens == 0:
+        return None
+    if args.draft_checkpoint is None:
+        from gpt_oss.torch.speculative import PromptLookupDrafter
+        return PromptLookupDrafter()
+    from gpt_oss.torch.model import Transformer
+    from gpt_oss.torch.speculative import DraftModelDrafter
+    return DraftModelDrafter(Transformer.from_checkpoint(args.draft_checkpoint, device=device), device)
+
+
 def main(args):
     match args.backend:
         case "torch":
             from gpt_oss.torch.utils import init_distributed
             from gpt_oss.torch.model import TokenGenerator as TorchGenerator
             device = init_distributed()
-            generator = TorchGenerator(args.checkpoint, device=device)
+            generator = TorchGenerator(args.checkpoint, device=device, drafter=get_drafter(args, device), num_draft_tokens=args.draft_tokens, mxfp4_experts=args.mxfp4_experts, converted_cache_dir=args.converted_cache_dir, num_threads=args.num_threads, compile_decode=args.compile_decode)
         case "triton":
             from gpt_oss.torch.utils import init_distributed
             from gpt_oss.triton.model import TokenGenerator as TritonGenerator
             device = init_distributed()
-            generator = TritonGenerator(args.checkpoint, context=args.context_length, device=device)
+            generator = TritonGenerator(args.checkpoint, context=args.context_length, device=device, drafter=get_drafter(args, device), num_draft_tokens=args.draft_tokens)
         case "vllm":
             from gpt_oss.vllm.token_generator import TokenGenerator as VLLMGenerator
             generator = VLLMGenerator(args.checkpoint, tensor_parallel_size=args.tensor_parallel_size)
@@ -29,6 +40,12 @@ def main(args):
     tokenizer = get_tokenizer()
     tokens = tokenizer.encode(args.prompt)
     max_tokens = None if args.limit == 0 else args.limit
+    if args.num_samples > 1:
+        # The prompt is prefilled once for all samples
+        samples = generator.sample(tokens, stop_tokens=[tokenizer.eot_token], n=args.num_samples, temperature=args.temperature, max_tokens=args.limit)
+        for i, sample in enumerate(samples):
+            print(f"Sample {i}: {repr(tokenizer.decode(sample))}")
+        return
     for token, logprob in generator.generate(tokens, stop_tokens=[tokenizer.eot_token], temperature=args.temperature, max_tokens=max_tokens, return_logprobs=True):
         tokens.append(token)
         token_text = tokenizer.decode([token])
@@ -90,6 +107,47 @@ if __name__ == "__main__":
         default=4096,
         help="Context length for Triton backend",
     )
+    parser.add_argument(
+        "--draft-tokens",
+        type=int,
+        default=0,
+        help="Tokens to draft per step for speculative decoding with the torch and triton backends (0 to disable)",
+    )
+    parser.add_argument(
+        "--draft-checkpoint",
+        type=str,
+        default=None,
+        help="Smaller checkpoint to draft with (default: prompt lookup, no second model)",
+    )
+    parser.add_argument(
+        "--mxfp4-experts",
+        action="store_true",
+        help="Keep MoE weights in MXFP4 and dequantize the selected experts on the fly (torch backend)",
+    )
+    parser.add_argument(
+        "--converted-cache-dir",
+        type=str,
+        default=None,
+        help="Directory caching dequantized, sharded weights between runs (torch backend)",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=None,
+        help="Intra-op threads for CPU inference (torch backend, default: torch's choice)",
+    )
+    parser.add_argument(
+        "--compile-decode",
+        action="store_true",
+        help="Compile the single-token decode step with torch.compile (torch backend)",
+    )
+    parser.add_argument(
+        "-n",
+        "--num-samples",
+        type=int,
+        default=1,
+        help="Number of completions to sample from one prefill of the prompt (torch backend)",
+    )
     args = parser.parse_args()
 
     main(args)
@@ -1,9 +1,11 @@
 import os
 import datetime
 import uuid
+from collections import deque
 from typing import Callable, Literal, Optional, Union
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.exception_handlers import request_validation_exception_handler
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import StreamingResponse
@@ -67,6 +69,16 @@ from .types import (
     WebSearchActionSearch,
     WebSearchCallItem,
 )
+from .scheduler import BatchScheduler, sequential_infer_next_tokens
+from .sse import (
+    DEFAULT_FLUSH_INTERVAL,
+    FLUSH_INTERVAL_HEADER,
+    coalesce_events,
+    parse_flush_interval,
+)
+from .streaming import SamplingParams, StreamingBackend, TokenStream
+from .store import InMemoryResponseStore, ResponseStore
+from .tracing import Tracer
 
 DEFAULT_TEMPERATURE = 0.0
 
@@ -97,10 +109,69 @@ def is_not_builtin_tool(
     )
 
 
+def next_turn_tokens(
+    encoding: HarmonyEncoding, tokens: list[int]
+) -> Optional[list[int]]:
+    """Tokens of a finished conversation as a follow-up turn's prompt prefix.
+
+    Matches rendering the conversation from its items: a final answer ends
+    with `<|end|>` rather than `<|return|>`, and the analysis messages before
+    it are dropped. Returns `None` unless the response ended in a final
+    answer or a function call, e.g. when it was cut off at
+    `max_output_tokens`.
+    """
+    start, end, return_, call, channel, message = (
+        encoding.encode(token, allowed_special="all")[0]
+        for token in (
+            "<|start|>",
+            "<|end|>",
+            "<|return|>",
+            "<|call|>",
+            "<|channel|>",
+            "<|message|>",
+        )
+    )
+    if not tokens or tokens[-1] not in (return_, call):
+        return None
+    if tokens[-1] == call:
+        return list(tokens)
+
+    bounds = [i for i, token in enumerate(tokens) if token == start]
+    bounds = [0] + bounds + [len(tokens)]
+    kept = []
+    for begin, stop in zip(bounds, bounds[1:]):
+        message_tokens = tokens[begin:stop]
+        header = message_tokens
+        if message in message_tokens:
+            header = message_tokens[: message_tokens.index(message)]
+        if channel in header:
+            channel_name = encoding.decode_utf8(header[header.index(channel) + 1 :])
+            if channel_name.split()[:1] == ["analysis"]:
+                continue
+        kept.extend(message_tokens)
+    kept[-1] = end
+    return kept
+
+
 def create_api_server(
-    infer_next_token: Callable[[list[int], float], int], encoding: HarmonyEncoding
+    infer_next_token: Union[Callable[[list[int], float], int], StreamingBackend],
+    encoding: HarmonyEncoding,
+    response_store: Optional[ResponseStore] = None,
+    tracer: Optional[Tracer] = None,
+    sse_flush_interval: float = DEFAULT_FLUSH_INTERVAL,
 ) -> FastAPI:
     app = FastAPI()
+    if response_store is None:
+        response_store = InMemoryResponseStore()
+
+    if hasattr(infer_next_token, "start"):
+        backend = infer_next_token
+    else:
+        # Single-token backends take turns, one request per step
+        backend = BatchScheduler(
+            sequential_infer_next_tokens(infer_next_token), max_batch_size=1
+        )
+    stop_tokens = frozenset(encoding.stop_tokens_for_assistant_actions())
 
     @app.exception_handler(RequestValidationError)
     async def log_validation_error(request: Request, exc: RequestValidationError):
@@ -113,7 +184,6 @@ def create_api_server(
         except Exception as body_exc:
             print(f"Failed to read invalid request body: {body_exc}")
         return await request_validation_exception_handler(request, exc)
-    responses_store: dict[str, tuple[ResponsesRequest, ResponseObject]] = {}
 
     def generate_response(
         input_tokens: list[int],
@@ -387,7 +457,6 @@ def create_api_server(
         initial_tokens: list[int]
         tokens: list[int]
         output_tokens: list[int]
-        output_text: str
         request_body: ResponsesRequest
         request: Request
         sequence_number: int
@@ -400,7 +469,7 @@ def create_api_server(
             request: Optional[Request] = None,
             response_id: Optional[str] = None,
             store_callback: Optional[
-                Callable[[str, ResponsesRequest, ResponseObject], None]
+                Callable[[str, ResponsesRequest, ResponseObject, list[int]], None]
             ] = None,
             browser_tool: Optional[SimpleBrowserTool] = None,
             python_tool: Optional[PythonTool] = None,
@@ -409,7 +478,6 @@ def create_api_server(
             self.initial_tokens = initial_tokens
             self.tokens = initial_tokens.copy()
             self.output_tokens = []
-            self.output_text = ""
             self.request_body = request_body
             self.parser = StreamableParser(encoding, role=Role.ASSISTANT)
             self.as_sse = as_sse
@@ -428,6 +496,8 @@ def create_api_server(
             self.response_id = response_id
             self.store_callback = store_callback
             self.new_request = True
+            self.token_stream: Optional[TokenStream] = None
+            self.pending_tokens: deque[int] = deque()
             self.browser_tool = browser_tool
             self.use_browser_tool = browser_tool is not None
             self.browser_call_ids: list[str] = []
@@ -490,9 +560,56 @@ def create_api_server(
             else:
                 return event
 
+        async def _next_token(self) -> int:
+            """Next token from the backend, restarting generation whenever the
+            conversation was changed here (e.g. tool output)."""
+            if self.new_request:
+                self._close_token_stream()
+                self.new_request = False
+            while not self.pending_tokens:
+                if self.token_stream is None:
+                    max_tokens = self.request_body.max_output_tokens
+                    self.token_stream = backend.start(
+                        self.response_id,
+                        self.tokens,
+                        SamplingParams(
+                            temperature=self.temperature,
+                            stop_tokens=stop_tokens,
+                            max_tokens=(
+                                max(max_tokens - len(self.output_tokens), 1)
+                                if max_tokens is not None
+                                else None
+                            ),
+                        ),
+                    )
+                try:
+                    self.pending_tokens.extend(await self.token_stream.__anext__())
+                except StopAsyncIteration:
+                    self.token_stream = None
+            return self.pending_tokens.popleft()
+
+        def _close_token_stream(self):
+            self.pending_tokens.clear()
+            if self.token_stream is not None:
+                self.token_stream.close()
+                self.token_stream = None
+
         async def run(self):
+            try:
+                async for event in self._run():
+                    yield event
+            finally:
+                # Stop generating for responses that end early, e.g. when the
+                # client disconnects
+                self._close_token_stream()
+                if tracer is not None:
+                    tracer.end(self.response_id)
+
+        async def _run(self):
             browser_tool = self.browser_tool
             self.new_request = True
+            if tracer is not None:
+                tracer.prompt(self.response_id, self.initial_tokens)
             initial_response = generate_response(
                 self.initial_tokens,
                 self.output_tokens,
@@ -529,10 +646,9 @@ def create_api_server(
             current_output_index = -1
             sent_output_item_added = False
 
-            # we use this if the model outputs a citation to buffer until completed
-            output_delta_buffer = ""
-            # we use this to track the current output text content for things like providing the right indices in citations
-            current_output_text_content = ""
+            # normalizes citations in the final message as it streams, holding
+            # back unfinished ones
+            citation_normalizer = None
             current_annotations = []
 
             while True:
@@ -540,13 +656,10 @@ def create_api_server(
                 if self.request is not None and await self.request.is_disconnected():
                     print("Client disconnected, stopping token generation.")
                     break
-                next_tok = infer_next_token(
-                    self.tokens,
-                    temperature=self.temperature,
-                    new_request=self.new_request,
-                )
-                self.new_request = False
+                next_tok = await self._next_token()
                 self.tokens.append(next_tok)
+                if tracer is not None:
+                    tracer.tokens(self.response_id, [next_tok])
                 try:
                     self.parser.process(next_tok)
                 except Exception:
@@ -702,7 +815,7 @@ def create_api_server(
                                 )
                             )
                             current_annotations = []
-                            current_output_text_content = ""
+                            citation_normalizer = None
                             self.current_message_item_id = None
 
                 if (
@@ -735,30 +848,15 @@ def create_api_server(
                             )
                         )
 
-                    output_delta_buffer += self.parser.last_content_delta
-                    should_send_output_text_delta = True
+                    output_delta = self.parser.last_content_delta
                     if browser_tool:
-                        # we normalize on the full current text to get the right indices in citations
-                        updated_output_text, annotations, has_partial_citations = (
-                            browser_tool.normalize_citations(
-                                current_output_text_content + output_delta_buffer
-                            )
+                        if citation_normalizer is None:
+                            citation_normalizer = browser_tool.citation_normalizer()
+                        # only the new text is normalized, with annotation
+                        # indices into the whole message
+                        output_delta, new_annotations, _has_partial_citations = (
+                            citation_normalizer.feed(output_delta)
                         )
-                        # remove the current text to get back the delta but now normalized
-                        output_delta_buffer = updated_output_text[
-                            len(current_output_text_content) :
-                        ]
-
-                        # Filter annotations to only include those whose start_index is not already present in current_annotations
-                        # this is to avoid sending duplicate annotations as multiple annotations can't be in the same place
-                        existing_start_indices = {
-                            a["start_index"] for a in current_annotations
-                        }
-                        new_annotations = [
-                            a
-                            for a in annotations
-                            if a["start_index"] not in existing_start_indices
-                        ]
                         for a in new_annotations:
                             current_annotations.append(a)
                             citation = UrlCitation(**a)
@@ -774,10 +872,7 @@ def create_api_server(
                                 )
                             )
 
-                        if has_partial_citations:
-                            should_send_output_text_delta = False
-
-                    if should_send_output_text_delta:
+                    if output_delta:
                         message_id = self._ensure_message_item_id()
                         yield self._send_event(
                             ResponseOutputTextDelta(
@@ -785,11 +880,9 @@ def create_api_server(
                                 output_index=current_output_index,
                                 content_index=current_content_index,
                                 item_id=message_id,
-                                delta=output_delta_buffer,
+                                delta=output_delta,
                             )
                         )
-                        current_output_text_content += output_delta_buffer
-                        output_delta_buffer = ""
 
                 if (
                     self.parser.last_content_delta
@@ -833,15 +926,6 @@ def create_api_server(
                         )
                     )
 
-                try:
-                    # purely for debugging purposes
-                    output_token_text = encoding.decode_utf8([next_tok])
-                    self.output_text += output_token_text
-                    print(output_token_text, end="", flush=True)
-
-                except RuntimeError:
-                    pass
-
                 if next_tok in encoding.stop_tokens_for_assistant_actions():
                     if len(self.parser.messages) > 0:
                         last_message = self.parser.messages[-1]
@@ -927,7 +1011,6 @@ def create_api_server(
                                 Conversation.from_messages(result), Role.ASSISTANT
                             )
 
-                            print(encoding.decode_utf8(new_tokens))
                             self.output_tokens.append(next_tok)
                             self.tokens.append(
                                 encoding.encode("<|end|>", allowed_special="all")[0]
@@ -937,6 +1020,10 @@ def create_api_server(
                                 self.parser.process(token)
                                 self.output_tokens.append(token)
                                 self.tokens.append(token)
+                            if tracer is not None:
+                                tracer.tokens(
+                                    self.response_id, self.tokens[-len(new_tokens) - 1 :]
+                                )
 
                             yield self._send_event(
                                 ResponseWebSearchCallCompleted(
@@ -1036,8 +1123,6 @@ def create_api_server(
 
                             result = await run_python_tool()
 
-                            print(result)
-
                             code_outputs: list[
                                 CodeInterpreterOutputLogs | CodeInterpreterOutputImage
                             ] = []
@@ -1058,7 +1143,6 @@ def create_api_server(
                                 Conversation.from_messages(result), Role.ASSISTANT
                             )
 
-                            print(encoding.decode_utf8(new_tokens))
                             self.output_tokens.append(next_tok)
                             self.tokens.append(
                                 encoding.encode("<|end|>", allowed_special="all")[0]
@@ -1068,6 +1152,10 @@ def create_api_server(
                                 self.parser.process(token)
                                 self.output_tokens.append(token)
                                 self.tokens.append(token)
+                            if tracer is not None:
+                                tracer.tokens(
+                                    self.response_id, self.tokens[-len(new_tokens) - 1 :]
+                                )
 
                             yield self._send_event(
                                 ResponseCodeInterpreterCallCompleted(
@@ -1099,11 +1187,15 @@ def create_api_server(
                             break
                     else:
                         raise ValueError("No messages to process")
-                if len(self.output_tokens) >= self.request_body.max_output_tokens:
-                    break
-
                 # Adding in the end if we know we are not done
                 self.output_tokens.append(next_tok)
+                # Stop at the limit rather than fetch one token past it
+                max_output_tokens = self.request_body.max_output_tokens
+                if (
+                    max_output_tokens is not None
+                    and len(self.output_tokens) >= max_output_tokens
+                ):
+                    break
 
             if self.request is None or not await self.request.is_disconnected():
                 response = generate_response(
@@ -1124,7 +1216,14 @@ def create_api_server(
                     treat_functions_python_as_builtin=self.functions_python_as_builtin,
                 )
                 if self.store_callback and self.request_body.store:
-                    self.store_callback(self.response_id, self.request_body, response)
+                    # The store may block on disk, so it stays off the event loop
+                    await run_in_threadpool(
+                        self.store_callback,
+                        self.response_id,
+                        self.request_body,
+                        response,
+                        self.tokens,
+                    )
                 yield self._send_event(
                     ResponseCompletedEvent(
                         type="response.completed",
@@ -1132,11 +1231,73 @@ def create_api_server(
                     )
                 )
 
+    def input_messages(
+        items: list, function_call_map: dict[str, FunctionCallItem]
+    ) -> list[Message]:
+        messages = []
+        is_last_message_function_call_output = (
+            len(items) > 0 and items[-1].type == "function_call_output"
+        )
+        # Find the index of the last assistant message
+        last_assistant_idx = -1
+        for idx, item in enumerate(items):
+            if item.type == "message" and item.role == Role.ASSISTANT:
+                last_assistant_idx = idx
+
+        for idx, item in enumerate(items):
+            if item.type == "message":
+                # TODO: add system prompt handling
+                if isinstance(item.content, str):
+                    messages.append(
+                        Message.from_role_and_content(item.role, item.content)
+                    )
+                else:
+                    for content_item in item.content:
+                        messages.append(
+                            Message.from_role_and_content(
+                                item.role, content_item.text
+                            )
+                        )
+                # add final channel to the last assistant message if it's from the assistant
+                if item.role == Role.ASSISTANT:
+                    messages[-1] = messages[-1].with_channel("final")
+            elif item.type == "reasoning":
+                # Only include reasoning if it is after the last assistant message and we are handling a function call at the moment
+                if (
+                    idx > last_assistant_idx
+                    and is_last_message_function_call_output
+                ):
+                    for content_item in item.content:
+                        messages.append(
+                            Message.from_role_and_content(
+                                Role.ASSISTANT, content_item.text
+                            ).with_channel("analysis")
+                        )
+            elif item.type == "function_call":
+                function_call_map[item.call_id] = item
+                messages.append(
+                    Message.from_role_and_content(Role.ASSISTANT, item.arguments)
+                    .with_recipient(f"functions.{item.name}")
+                    .with_channel("commentary")
+                )
+            elif item.type == "function_call_output":
+                function_call = function_call_map.get(item.call_id, None)
+                if not function_call:
+                    raise ValueError(f"Function call {item.call_id} not found")
+
+                messages.append(
+                    Message.from_author_and_content(
+                        Author.new(Role.TOOL, f"functions.{function_call.name}"),
+                        item.output,
+                    )
+                    .with_recipient("assistant")
+                    .with_channel("commentary")
+                )
+
+        return messages
+
     @app.post("/v1/responses", response_model=ResponseObject)
     async def generate(body: ResponsesRequest, request: Request):
-        print("request received")
-        print(body.reasoning)
-
         use_browser_tool = any(
             getattr(tool, "type", None) in ("browser_search", "web_search")
             for tool in (body.tools or [])
@@ -1172,10 +1333,15 @@ def create_api_server(
             python_function_name_conflict
         )
 
+        # Tokens of the previous turn, if the prompt can continue from them
+        previous_tokens = None
+        function_call_map = {}
         if body.previous_response_id:
-            prev = responses_store.get(body.previous_response_id)
+            prev = await run_in_threadpool(
+                response_store.get, body.previous_response_id
+            )
             if prev:
-                prev_req, prev_resp = prev
+                prev_req, prev_resp = prev.request, prev.response
 
                 def _ensure_list(inp):
                     if isinstance(inp, str):
@@ -1188,11 +1354,34 @@ def create_api_server(
                         ]
                     return list(inp)
 
+                new_input = _ensure_list(body.input)
                 merged_input = _ensure_list(prev_req.input) + list(prev_resp.output)
-                merged_input.extend(_ensure_list(body.input))
+                merged_input.extend(new_input)
 
                 if body.instructions is None:
                     body.instructions = prev_req.instructions
+                # The stored tokens keep the reasoning before a function call,
+                # which the full rendering only keeps while answering the call.
+                # The system and developer messages must also render the same.
+                ends_in_call = bool(prev_resp.output) and (
+                    prev_resp.output[-1].type == "function_call"
+                )
+                answers_call = bool(new_input) and (
+                    new_input[-1].type == "function_call_output"
+                )
+                if (
+                    prev.tokens is not None
+                    and (answers_call or not ends_in_call)
+                    and body.instructions == prev_req.instructions
+                    and body.tools == prev_req.tools
+                    and body.reasoning == prev_req.reasoning
+                ):
+                    previous_tokens = prev.tokens
+                    function_call_map = {
+                        item.call_id: item
+                        for item in prev_resp.output
+                        if item.type == "function_call"
+                    }
                 body.input = merged_input
 
         system_message_content = SystemContent.new().with_conversation_start_date(
@@ -1204,7 +1393,6 @@ def create_api_server(
 
                 reasoning_effort = get_reasoning_effort(body.reasoning.effort)
             except ValueError as e:
-                from fastapi import HTTPException
                 print(e)
 
                 raise HTTPException(status_code=422, detail=str(e))
@@ -1253,80 +1441,30 @@ def create_api_server(
 
             messages.append(developer_message)
 
-        if isinstance(body.input, str):
-            user_message = Message.from_role_and_content(Role.USER, body.input)
-            messages.append(user_message)
-        else:
-            is_last_message_function_call_output = (
-                len(body.input) > 0 and body.input[-1].type == "function_call_output"
+        if previous_tokens is not None:
+            # Only the new items are rendered
+            initial_tokens = previous_tokens + encoding.render_conversation_for_completion(
+                Conversation.from_messages(input_messages(new_input, function_call_map)),
+                Role.ASSISTANT,
             )
-            function_call_map = {}
-            # Find the index of the last assistant message
-            last_assistant_idx = -1
-            for idx, item in enumerate(body.input):
-                if item.type == "message" and item.role == Role.ASSISTANT:
-                    last_assistant_idx = idx
-
-            for idx, item in enumerate(body.input):
-                if item.type == "message":
-                    # TODO: add system prompt handling
-                    if isinstance(item.content, str):
-                        messages.append(
-                            Message.from_role_and_content(item.role, item.content)
-                        )
-                    else:
-                        for content_item in item.content:
-                            messages.append(
-                                Message.from_role_and_content(
-                                    item.role, content_item.text
-                                )
-                            )
-                    # add final channel to the last assistant message if it's from the assistant
-                    if item.role == Role.ASSISTANT:
-                        messages[-1] = messages[-1].with_channel("final")
-                elif item.type == "reasoning":
-                    # Only include reasoning if it is after the last assistant message and we are handling a function call at the moment
-                    if (
-                        idx > last_assistant_idx
-                        and is_last_message_function_call_output
-                    ):
-                        for content_item in item.content:
-                            messages.append(
-                                Message.from_role_and_content(
-                                    Role.ASSISTANT, content_item.text
-                                ).with_channel("analysis")
-                            )
-                elif item.type == "function_call":
-                    function_call_map[item.call_id] = item
-                    messages.append(
-                        Message.from_role_and_content(Role.ASSISTANT, item.arguments)
-                        .with_recipient(f"functions.{item.name}")
-                        .with_channel("commentary")
-                    )
-                elif item.type == "function_call_output":
-                    function_call = function_call_map.get(item.call_id, None)
-                    if not function_call:
-                        raise ValueError(f"Function call {item.call_id} not found")
-
-                    messages.append(
-                        Message.from_author_and_content(
-                            Author.new(Role.TOOL, f"functions.{function_call.name}"),
-                            item.output,
-                        )
-                        .with_recipient("assistant")
-                        .with_channel("commentary")
-                    )
+        else:
+            if isinstance(body.input, str):
+                user_message = Message.from_role_and_content(Role.USER, body.input)
+                messages.append(user_message)
+            else:
+                messages.extend(input_messages(body.input, {}))
 
-        conversation = Conversation.from_messages(messages)
+            conversation = Conversation.from_messages(messages)
 
-        initial_tokens = encoding.render_conversation_for_completion(
-            conversation, Role.ASSISTANT
-        )
-        print(encoding.decode_utf8(initial_tokens))
+            initial_tokens = encoding.render_conversation_for_completion(
+                conversation, Role.ASSISTANT
+            )
         response_id = f"resp_{uuid.uuid4().hex}"
 
-        def store_callback(rid: str, req: ResponsesRequest, resp: ResponseObject):
-            responses_store[rid] = (req, resp)
+        def store_callback(
+            rid: str, req: ResponsesRequest, resp: ResponseObject, tokens: list[int]
+        ):
+            response_store.put(rid, req, resp, next_turn_tokens(encoding, tokens))
 
         event_stream = StreamResponsesEvents(
             initial_tokens,
@@ -1341,7 +1479,21 @@ def create_api_server(
         )
 
         if body.stream:
-            return StreamingResponse(event_stream.run(), media_type="text/event-stream")
+            flush_interval = sse_flush_interval
+            if FLUSH_INTERVAL_HEADER in request.headers:
+                try:
+                    flush_interval = parse_flush_interval(
+                        request.headers[FLUSH_INTERVAL_HEADER]
+                    )
+                except ValueError:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Invalid {FLUSH_INTERVAL_HEADER} header",
+                    )
+            return StreamingResponse(
+                coalesce_events(event_stream.run(), flush_interval),
+                media_type="text/event-stream",
+            )
         else:
             last_event = None
             async for event in event_stream.run():
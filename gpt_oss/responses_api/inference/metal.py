@@ -1,12 +1,18 @@
 """Metal backend for :mod:`gpt_oss.responses_api`."""
 
+import asyncio
+import queue
+import threading
 from typing import Callable
 
 from gpt_oss.metal import Context, Model
 
+from ..streaming import SamplingParams, TokenStream
+
 
 # Tunables
 MAX_OUTPUT_TOKENS = 100
+STREAM_CHUNK_TOKENS = 8  # tokens sampled per call while streaming
 
 
 def setup_model(checkpoint: str) -> Callable[[list[int], float], int]:
@@ -41,3 +47,64 @@ def setup_model(checkpoint: str) -> Callable[[list[int], float], int]:
         return int(output_tokens.pop(0))
 
     return infer_next_token
+
+
+class MetalStreamingBackend:
+    """Streams tokens sampled in chunks from a single Metal context.
+
+    The context holds one sequence, so generations are queued and run one at
+    a time, first in first out, on a worker thread.
+    """
+
+    def __init__(self, context: Context, seed: int = 0):
+        self.context = context
+        self.seed = seed
+        self._requests: queue.Queue = queue.Queue()
+        threading.Thread(target=self._run, name="metal-stream", daemon=True).start()
+
+    def start(
+        self, request_id: str, tokens: list[int], sampling_params: SamplingParams
+    ) -> TokenStream:
+        stream = TokenStream(asyncio.get_running_loop())
+        self._requests.put((stream, list(tokens), sampling_params))
+        return stream
+
+    def _run(self) -> None:
+        while True:
+            stream, tokens, sampling_params = self._requests.get()
+            # Skip generations the consumer gave up on while they were queued
+            if not stream.closed:
+                self._generate(stream, tokens, sampling_params)
+
+    def _generate(
+        self, stream: TokenStream, tokens: list[int], sampling_params: SamplingParams
+    ) -> None:
+        try:
+            # The context reuses its KV cache for the common prefix
+            self.context.reset()
+            for t in tokens:
+                self.context.append(t)
+
+            num_generated, done = 0, False
+            while not done and not stream.closed:
+                chunk_size = STREAM_CHUNK_TOKENS
+                if sampling_params.max_tokens is not None:
+                    chunk_size = min(chunk_size, sampling_params.max_tokens - num_generated)
+                chunk = self.context.sample(
+                    max_output_tokens=chunk_size,
+                    temperature=sampling_params.temperature,
+                    seed=self.seed,
+                )
+                chunk, done = sampling_params.clip([int(t) for t in chunk], num_generated)
+                num_generated += len(chunk)
+                if not chunk or not stream.put(chunk):
+                    break
+            stream.end()
+        except Exception as e:
+            stream.end(e)
+
+
+def setup_streaming_model(checkpoint: str) -> MetalStreamingBackend:
+    """Load the Metal model and return a streaming backend."""
+    model = Model(checkpoint)
+    return MetalStreamingBackend(Context(model))
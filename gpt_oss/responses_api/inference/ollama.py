@@ -4,13 +4,16 @@ for testing and development. It does not leverage any prompt caching or other op
 can therefore be slow between turns.
 """
 
+import asyncio
 import json
 import threading
 import time
-from typing import Callable, Optional
+from typing import Callable, Iterator, Optional
 
 import requests
-from openai_harmony import HarmonyEncodingName, load_harmony_encoding
+from openai_harmony import HarmonyEncoding, HarmonyEncodingName, load_harmony_encoding
+
+from ..streaming import SamplingParams, TokenStream
 
 EOS_TOKEN = 200002  # only used on hard timeout
 
@@ -57,54 +60,101 @@ def _reset_stream_state():
     _touch_progress()
 
 
+def _iter_token_chunks(
+    encoding: HarmonyEncoding,
+    model_name: str,
+    token_ids: list[int],
+    temperature: float,
+) -> Iterator[list[int]]:
+    """Yield the tokens of an Ollama stream as they arrive, then EOS_TOKEN."""
+    url = "http://localhost:11434/api/generate"
+
+    payload = {
+        "model": model_name,
+        "prompt": encoding.decode(token_ids),
+        "stream": True,
+        "options": {"temperature": temperature},
+        "raw": True,
+    }
+
+    accum_text = ""
+    last_len = 0  # number of tokens already emitted
+
+    with requests.post(url, json=payload, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            obj = json.loads(line)
+
+            if isinstance(obj.get("response"), str):
+                accum_text += obj["response"]
+                toks = encoding.encode(accum_text, allowed_special="all")
+                if len(toks) > last_len:
+                    yield toks[last_len:]
+                    last_len = len(toks)
+
+            if obj.get("done", False):
+                yield [EOS_TOKEN]
+                break
+
+
+class OllamaStreamingBackend:
+    """Forwards every generation to its own Ollama stream."""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.encoding = load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS)
+
+    def start(
+        self, request_id: str, tokens: list[int], sampling_params: SamplingParams
+    ) -> TokenStream:
+        stream = TokenStream(asyncio.get_running_loop())
+        threading.Thread(
+            target=self._generate,
+            args=(stream, list(tokens), sampling_params),
+            name="ollama-stream",
+            daemon=True,
+        ).start()
+        return stream
+
+    def _generate(
+        self, stream: TokenStream, tokens: list[int], sampling_params: SamplingParams
+    ) -> None:
+        num_generated = 0
+        try:
+            for chunk in _iter_token_chunks(
+                self.encoding, self.model_name, tokens, sampling_params.temperature
+            ):
+                chunk, done = sampling_params.clip(chunk, num_generated)
+                num_generated += len(chunk)
+                if not stream.put(chunk) or done:
+                    break
+        except Exception as e:
+            stream.end(e)
+            return
+        stream.end()
+
+
+def setup_streaming_model(checkpoint: str) -> OllamaStreamingBackend:
+    return OllamaStreamingBackend(checkpoint)
+
+
 def setup_model(checkpoint: str) -> Callable[[list[int], float, bool], int]:
     encoding = load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS)
     model_name = checkpoint
 
     def _start_stream(token_ids: list[int], temperature: float):
-        prompt_text = encoding.decode(token_ids)
-
         def run():
-            nonlocal prompt_text, temperature
             global _stream_error
-            global _previous_request_tokens
-
-            accum_text = ""
-            last_len = 0  # number of tokens already emitted
 
             try:
-                url = "http://localhost:11434/api/generate"
-
-                payload = {
-                    "model": model_name,
-                    "prompt": prompt_text,
-                    "stream": True,
-                    "options": {"temperature": temperature},
-                    "raw": True,
-                }
-
-                with requests.post(url, json=payload, stream=True, timeout=60) as resp:
-                    resp.raise_for_status()
-                    for line in resp.iter_lines(decode_unicode=True):
-                        if not line:
-                            continue
-                        obj = json.loads(line)
-
-                        if isinstance(obj.get("response"), str):
-                            accum_text += obj["response"]
-                            toks = encoding.encode(accum_text, allowed_special="all")
-                            if len(toks) > last_len:
-                                new_toks = toks[last_len:]
-                                with _buffer_lock:
-                                    _token_buffer.extend(new_toks)
-                                last_len = len(toks)
-                                _touch_progress()
-
-                        if obj.get("done", False):
-                            _token_buffer.append(EOS_TOKEN)
-                            last_len = len(toks)
-                            _touch_progress()
-                            break
+                for new_toks in _iter_token_chunks(
+                    encoding, model_name, token_ids, temperature
+                ):
+                    with _buffer_lock:
+                        _token_buffer.extend(new_toks)
+                    _touch_progress()
 
                 _stream_done.set()
 
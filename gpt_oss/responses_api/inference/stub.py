@@ -1,6 +1,13 @@
 import time
 from typing import Callable
 
+from ..scheduler import DecodeRequest, InferNextTokens
+
+# Simulated cost of one batched forward: a fixed per-step latency (weight
+# loads, kernel launches) plus a small per-sequence cost.
+STEP_LATENCY_S = 0.1
+PER_SEQUENCE_LATENCY_S = 0.002
+
 fake_tokens = [
     200005,
     35644,
@@ -140,3 +147,30 @@ def stub_infer_next_token(
 
 def setup_model(_checkpoint: str) -> Callable[[list[int], float], int]:
     return stub_infer_next_token
+
+
+def get_stub_infer_next_tokens() -> InferNextTokens:
+    """Batching-aware stub: each request replays `fake_tokens` from the start,
+    and a step costs about the same whether it serves one request or many."""
+    positions: dict[str, int] = {}
+
+    def stub_infer_next_tokens(requests: list[DecodeRequest]) -> list[int]:
+        time.sleep(STEP_LATENCY_S + PER_SEQUENCE_LATENCY_S * len(requests))
+        next_tokens = []
+        for request in requests:
+            if request.new_request or request.request_id not in positions:
+                positions[request.request_id] = 0
+            position = positions[request.request_id]
+            next_tokens.append(fake_tokens[position])
+            if position + 1 == len(fake_tokens):
+                # The replay is over; forget the request
+                del positions[request.request_id]
+            else:
+                positions[request.request_id] = position + 1
+        return next_tokens
+
+    return stub_infer_next_tokens
+
+
+def setup_batched_model(_checkpoint: str) -> InferNextTokens:
+    return get_stub_infer_next_tokens()
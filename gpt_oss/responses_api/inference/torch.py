@@ -0,0 +1,265 @@
+"""Torch backend for :mod:`gpt_oss.responses_api`.
+
+Every step runs the next token of all active requests through a single
+batched forward of :class:`gpt_oss.torch.model.Transformer`; the batch is
+assembled by :class:`gpt_oss.responses_api.scheduler.BatchScheduler`.
+Requests keep their keys and values in a shared paged KV cache, so only
+tokens that are not cached yet go through the model, and a prefix cache lets
+requests that start the same way (system prompt, tools, earlier turns) share
+the blocks holding that prefix. Long prompts are prefilled in chunks spread
+over several steps, interleaved with the decode steps of other requests.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import torch
+
+from gpt_oss.torch.model import Transformer
+from gpt_oss.torch.paged_cache import PagedKVCache
+from gpt_oss.torch.prefix_cache import PrefixCache, PrefixNode
+
+from ..scheduler import DecodeRequest, InferNextTokens
+
+DEFAULT_TEMPERATURE = 0.0
+KV_CACHE_BLOCK_SIZE = 16
+# Upper bound on the number of tokens held in the KV cache across all requests
+KV_CACHE_MAX_TOKENS = int(os.environ.get("KV_CACHE_MAX_TOKENS", 262_144))
+# Most prompt tokens fed to the model in a single step, across all requests
+PREFILL_CHUNK_SIZE = int(os.environ.get("PREFILL_CHUNK_SIZE", 512))
+# Set to 1 to keep MoE weights in MXFP4, about 4x less memory than bf16
+MXFP4_EXPERTS = bool(int(os.environ.get("MXFP4_EXPERTS", 0)))
+# Directory caching converted weights, so that restarts skip dequantization
+CONVERTED_CHECKPOINT_CACHE = os.environ.get("CONVERTED_CHECKPOINT_CACHE")
+
+rank = int(
+    os.environ.get("RANK", 0)
+)  # set this env var to another value to run on other GPUs
+
+
+def load_model(checkpoint: str):
+    print(f"[{rank}] loading model...")
+
+    torch.set_grad_enabled(False)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(rank)
+        device = torch.device(f"cuda:{rank}")
+    else:
+        device = torch.device("cpu")
+
+    model = Transformer.from_checkpoint(
+        checkpoint,
+        device=device,
+        mxfp4_experts=MXFP4_EXPERTS,
+        converted_cache_dir=CONVERTED_CHECKPOINT_CACHE,
+    )
+
+    print(f"[{rank}] loaded")
+    return model, device
+
+
+def lcp(cache: list[int], inp: list[int]) -> list[int]:
+    i = 0
+    max_len = min(len(cache), len(inp))
+    while i < max_len and cache[i] == inp[i]:
+        i += 1
+    return cache[:i]
+
+
+def sample_next_tokens(logits: torch.Tensor, temperatures: list[float]) -> list[int]:
+    """Sample one token per row of `logits`, greedily where the temperature is 0."""
+    next_tokens = torch.argmax(logits, dim=-1)
+    sampled_rows = [i for i, temperature in enumerate(temperatures) if temperature != 0.0]
+    if sampled_rows:
+        rows = torch.as_tensor(sampled_rows, device=logits.device)
+        scale = torch.as_tensor(
+            [1.0 / temperatures[i] for i in sampled_rows],
+            dtype=logits.dtype,
+            device=logits.device,
+        )
+        probs = torch.softmax(logits[rows] * scale[:, None], dim=-1)
+        next_tokens[rows] = torch.multinomial(probs, num_samples=1)[:, 0]
+    return next_tokens.tolist()
+
+
+def get_infer_next_tokens(model: Transformer, device: torch.device) -> InferNextTokens:
+    config = model.config
+    max_num_blocks = KV_CACHE_MAX_TOKENS // KV_CACHE_BLOCK_SIZE
+    cache = PagedKVCache(
+        config.num_hidden_layers,
+        config.num_key_value_heads,
+        config.head_dim,
+        block_size=KV_CACHE_BLOCK_SIZE,
+        num_blocks=min(1024, max_num_blocks),
+        max_num_blocks=max_num_blocks,
+        device=device,
+    )
+    prefix_cache = PrefixCache(cache)
+    block_size = cache.block_size
+    # Tokens held in the cache for every request, least recently used first
+    cached_tokens: OrderedDict[str, list[int]] = OrderedDict()
+    # Deepest prefix cache node on each request's path, and its depth in blocks
+    prefix_cursors: dict[str, tuple[PrefixNode, int]] = {}
+
+    def drop(request_id: str) -> None:
+        del cached_tokens[request_id]
+        prefix_cursors.pop(request_id, None)
+        cache.free(request_id)
+
+    def truncate(request_id: str, n_tokens: int) -> None:
+        del cached_tokens[request_id][n_tokens:]
+        cache.truncate(request_id, n_tokens)
+        node, depth = prefix_cursors.pop(request_id, (None, 0))
+        while node is not None and depth > n_tokens // block_size:
+            node, depth = node.parent, depth - 1
+        if node is not None and prefix_cache.contains(node):
+            prefix_cursors[request_id] = (node, depth)
+
+    def publish(request_id: str) -> None:
+        """Add the request's full blocks to the prefix cache."""
+        tokens = cached_tokens[request_id]
+        node, depth = prefix_cursors.get(request_id, (None, 0))
+        if node is not None and not prefix_cache.contains(node):
+            node, depth = None, 0
+        num_full_blocks = len(tokens) // block_size
+        if num_full_blocks > depth:
+            node = prefix_cache.insert(
+                tokens[depth * block_size : num_full_blocks * block_size],
+                cache.block_tables[request_id][depth:num_full_blocks],
+                node,
+            )
+            prefix_cursors[request_id] = (node, num_full_blocks)
+
+    def evict(needed_blocks: int, keep: set[str]) -> None:
+        """Free cached prefixes, then least recently used requests, until
+        `needed_blocks` fit."""
+        prefix_cache.evict(needed_blocks)
+        for request_id in list(cached_tokens):
+            if cache.num_available_blocks >= needed_blocks:
+                break
+            if request_id not in keep:
+                # Its full blocks stay reachable through the prefix cache
+                drop(request_id)
+                prefix_cache.evict(needed_blocks)
+
+    def prepare(request: DecodeRequest) -> list[int]:
+        """Line the cache up with `request.tokens` and return the tokens to feed."""
+        request_id, tokens = request.request_id, request.tokens
+        cached = cached_tokens.get(request_id)
+        if cached is None or request.new_request:
+            # The conversation may have been rewritten; keep the common prefix,
+            # or borrow a longer one from the prefix cache
+            num_common = len(lcp(cached, tokens)) if cached is not None else 0
+            shared_blocks = prefix_cache.match(tokens[:-1])
+            if cached is None or len(shared_blocks) * block_size > num_common:
+                if cached is not None:
+                    drop(request_id)
+                cache.allocate(request_id, shared_blocks)
+                cached_tokens[request_id] = tokens[: len(shared_blocks) * block_size]
+            else:
+                truncate(request_id, num_common)
+        cached_tokens.move_to_end(request_id)
+        # Always feed at least one token to get logits for the next one
+        if len(cached_tokens[request_id]) >= len(tokens):
+            truncate(request_id, len(tokens) - 1)
+        return tokens[len(cached_tokens[request_id]) :]
+
+    def shares_prefill(request: DecodeRequest, prefilling: list[list[int]]) -> bool:
+        """Whether a prompt prefilled in the same step covers at least one more
+        full block of `request.tokens` than the request has cached."""
+        num_cached_blocks = len(cached_tokens[request.request_id]) // block_size
+        return any(
+            len(lcp(tokens, request.tokens[:-1])) // block_size > num_cached_blocks
+            for tokens in prefilling
+        )
+
+    @torch.inference_mode()
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[Optional[int]]:
+        # Long prompts are fed PREFILL_CHUNK_SIZE tokens per step at most, so
+        # that they do not stall the decode steps of other requests
+        budget = PREFILL_CHUNK_SIZE
+        new_tokens, chunks = [], []
+        # Requests with the same prompt, e.g. several samples of it, prefill
+        # it once: the others wait for its blocks to reach the prefix cache
+        prefilling: list[list[int]] = []
+        for request in requests:
+            tokens = prepare(request)
+            chunk = tokens
+            if len(tokens) > 1 and shares_prefill(request, prefilling):
+                # Matched against the prefix cache again on the next step
+                drop(request.request_id)
+                tokens = chunk = []
+            elif len(tokens) > 1:
+                prefilling.append(request.tokens)
+                chunk = tokens[: max(budget, 0)]
+                budget -= len(chunk)
+            new_tokens.append(tokens)
+            chunks.append(chunk)
+
+        # Requests are fed in order while the blocks they need fit; the rest
+        # wait, like a deferred prefill, and so does any request whose blocks
+        # were evicted to make room for an earlier one
+        fed, num_blocks = [], 0
+        for i, chunk in enumerate(chunks):
+            request_id = requests[i].request_id
+            if not chunk or request_id not in cached_tokens:
+                continue
+            needed = num_blocks + cache.blocks_needed(request_id, len(chunk))
+            evict(needed, keep={requests[j].request_id for j in fed} | {request_id})
+            if cache.num_available_blocks < needed:
+                if not fed:
+                    raise RuntimeError(
+                        f"Request {request_id} does not fit in the KV cache"
+                        f" ({KV_CACHE_MAX_TOKENS} tokens)."
+                    )
+                continue
+            fed.append(i)
+            num_blocks = needed
+        seq_ids = [requests[i].request_id for i in fed]
+        seq_lens = [len(chunks[i]) for i in fed]
+
+        x = torch.as_tensor(
+            [token for i in fed for token in chunks[i]],
+            dtype=torch.int32,
+            device=device,
+        )
+        logits = model(x, seq_lens=seq_lens, cache=cache, seq_ids=seq_ids)
+        for seq_id, i in zip(seq_ids, fed):
+            cached_tokens[seq_id].extend(chunks[i])
+            publish(seq_id)
+
+        # Only the last position of each fully fed sequence is sampled
+        last_positions = torch.as_tensor(seq_lens, device=device).cumsum(0) - 1
+        done = [j for j, i in enumerate(fed) if len(chunks[i]) == len(new_tokens[i])]
+        sampled = sample_next_tokens(
+            logits[last_positions[done]].float(),
+            [requests[fed[j]].temperature for j in done],
+        )
+        next_tokens: list[Optional[int]] = [None] * len(requests)
+        for j, token in zip(done, sampled):
+            next_tokens[fed[j]] = token
+        return next_tokens
+
+    return infer_next_tokens
+
+
+def setup_batched_model(checkpoint: str) -> InferNextTokens:
+    model, device = load_model(checkpoint)
+    return get_infer_next_tokens(model, device)
+
+
+def setup_model(checkpoint: str) -> Callable[[list[int], float, bool], int]:
+    infer_next_tokens = setup_batched_model(checkpoint)
+
+    def infer_next_token(
+        tokens: list[int],
+        temperature: float = DEFAULT_TEMPERATURE,
+        new_request: bool = False,
+    ) -> int:
+        request = DecodeRequest("", tokens, temperature, new_request)
+        while (next_token := infer_next_tokens([request])[0]) is None:
+            request.new_request = False
+        return next_token
+
+    return infer_next_token
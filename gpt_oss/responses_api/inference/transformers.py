@@ -1,18 +1,28 @@
 """
-NOTE: this is not the most efficient way to use transformers. It's a simple implementation that infers
-one token at a time to mimic the behavior of the Triton implementation.
+Transformers backend for :mod:`gpt_oss.responses_api`.
+
+Every request keeps its `past_key_values` in a `DynamicCache`. Before each
+step the cache is cropped to the longest common prefix with the request's
+tokens, so only new tokens go through the model and decoding runs one token
+per forward. A new request takes over the cache of the session it shares the
+longest prefix with (usually the previous turn of the same conversation).
 """
 
 import os
-from typing import Callable, List
+from collections import OrderedDict
+from typing import Callable, List, Optional
 
 # Transformers imports
-from transformers import AutoModelForCausalLM, PreTrainedModel
+from transformers import AutoModelForCausalLM, DynamicCache, PreTrainedModel
 import torch
 
+from ..scheduler import DecodeRequest, InferNextTokens
+
 
 DEFAULT_TEMPERATURE = 0.0
 TP = os.environ.get("TP", 2)
+# Number of sessions whose KV cache is kept between requests
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 4))
 
 def load_model(checkpoint: str):
     """
@@ -28,28 +38,132 @@ def load_model(checkpoint: str):
     return model
 
 
+def lcp(cache: list[int], inp: list[int]) -> list[int]:
+    i = 0
+    max_len = min(len(cache), len(inp))
+    while i < max_len and cache[i] == inp[i]:
+        i += 1
+    return cache[:i]
+
+
+class Session:
+    def __init__(self):
+        self.tokens: list[int] = []
+        self.past_key_values = DynamicCache()
+
+
+def get_infer_next_tokens(model: PreTrainedModel) -> InferNextTokens:
+    # Sessions by request id, least recently used first
+    sessions: OrderedDict[str, Session] = OrderedDict()
+
+    def acquire(
+        request_id: str,
+        tokens: list[int],
+        new_request: bool,
+        busy_requests: frozenset = frozenset(),
+    ) -> Session:
+        session = sessions.get(request_id)
+        if session is None or new_request:
+            # Take over the idle cache sharing the longest prefix with `tokens`
+            best_id = max(
+                (i for i in sessions if i not in busy_requests),
+                key=lambda i: len(lcp(sessions[i].tokens, tokens)),
+                default=None,
+            )
+            if best_id is not None and lcp(sessions[best_id].tokens, tokens):
+                session = sessions.pop(best_id)
+            elif session is None:
+                session = Session()
+            sessions[request_id] = session
+            while len(sessions) > MAX_SESSIONS:
+                sessions.popitem(last=False)
+        sessions.move_to_end(request_id)
+        return session
+
+    def infer(
+        request_id: str,
+        tokens: List[int],
+        temperature: float,
+        new_request: bool,
+        busy_requests: frozenset = frozenset(),
+    ) -> int:
+        if not tokens:
+            raise ValueError("tokens must contain at least one input token id")
+
+        continuing = not new_request and request_id in sessions
+        session = acquire(request_id, tokens, new_request, busy_requests)
+        if continuing:
+            # A continuing request only appends to what its session holds
+            num_cached = len(session.tokens)
+        else:
+            num_cached = len(lcp(session.tokens, tokens))
+        # Always feed at least one token to get logits for the next one
+        num_cached = min(num_cached, len(tokens) - 1)
+        if num_cached < len(session.tokens):
+            # A negative length drops that many tokens from the end
+            session.past_key_values.crop(num_cached - len(session.tokens))
+            del session.tokens[num_cached:]
+
+        new_tokens = tokens[num_cached:]
+        output = model(
+            input_ids=torch.tensor([new_tokens], dtype=torch.int64, device=model.device),
+            past_key_values=session.past_key_values,
+            cache_position=torch.arange(
+                num_cached, len(tokens), dtype=torch.int64, device=model.device
+            ),
+            use_cache=True,
+        )
+        session.tokens.extend(new_tokens)
+
+        logits = output.logits[0, -1].float()
+        if temperature == 0.0:
+            return torch.argmax(logits, dim=-1).item()
+        probs = torch.softmax(logits * (1.0 / temperature), dim=-1)
+        return torch.multinomial(probs, num_samples=1).item()
+
+    @torch.inference_mode()
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[Optional[int]]:
+        request_ids = frozenset(request.request_id for request in requests)
+        return [
+            infer(
+                request.request_id,
+                request.tokens,
+                request.temperature,
+                request.new_request,
+                busy_requests=request_ids - {request.request_id},
+            )
+            for request in requests
+        ]
+
+    # Requests beyond the number of sessions would evict each other every step
+    infer_next_tokens.max_batch_size = MAX_SESSIONS
+    return infer_next_tokens
+
+
 def get_infer_next_token(model: PreTrainedModel):
     """
     Return a callable with the same shape as the original triton implementation:
       infer_next_token(tokens: List[int], temperature: float, new_request: bool) -> int
-
-    Implementation detail:
-      - We issue a single-token generation with using model.generate
-      - generate handles sampling (temperature=0 => greedy, otherwise, sampling).
     """
+    infer_next_tokens = get_infer_next_tokens(model)
 
     def infer_next_token(
         tokens: List[int],
         temperature: float = DEFAULT_TEMPERATURE,
-        new_request: bool = False, # kept for interface compatibility; unused here
+        new_request: bool = False,
     ) -> int:
-        tokens = torch.tensor([tokens], dtype=torch.int64, device=model.device)
-        output = model.generate(tokens, max_new_tokens=1, do_sample=temperature != 0, temperature=temperature)
-        return output[0, -1].tolist()
+        return infer_next_tokens(
+            [DecodeRequest("", tokens, temperature, new_request)]
+        )[0]
 
     return infer_next_token
 
 
+def setup_batched_model(checkpoint: str) -> InferNextTokens:
+    model = load_model(checkpoint)
+    return get_infer_next_tokens(model)
+
+
 def setup_model(checkpoint: str) -> Callable[[List[int], float, bool], int]:
     model = load_model(checkpoint)
     infer_next_token = get_infer_next_token(model)
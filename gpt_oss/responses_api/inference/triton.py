@@ -1,6 +1,6 @@
 import datetime
 import os
-from typing import Callable
+from typing import Callable, Optional
 
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 import torch
@@ -8,9 +8,14 @@ import torch.distributed as dist
 
 from gpt_oss.triton.model import Cache, ModelConfig, Transformer
 
+from ..scheduler import DecodeRequest, InferNextTokens
+
 DEFAULT_TEMPERATURE = 0.0
 CONTEXT = 16_384
-CONCURRENT_SESSIONS = 1
+# Number of KV cache slots; every slot keeps one conversation's prefix resident
+CONCURRENT_SESSIONS = int(os.environ.get("CONCURRENT_SESSIONS", 4))
+# Most prompt tokens prefilled in a single step, across all requests
+PREFILL_CHUNK_SIZE = int(os.environ.get("PREFILL_CHUNK_SIZE", 512))
 
 rank = int(
     os.environ.get("RANK", 0)
@@ -31,28 +36,100 @@ def load_model(checkpoint: str):
     return model, device
 
 
-def get_infer_next_token(model, device):
-    caches = [
-        Cache(CONCURRENT_SESSIONS, CONTEXT, model.config.num_key_value_heads)
-        for _ in range(len(model.block))
-    ]
-    # offsets = torch.zeros(CONCURRENT_SESSIONS, dtype=torch.int32, device=device) # TBD
-    input_token = torch.zeros(
-        1, dtype=torch.int32, device=device
-    )  # add concurrent sessions support
-    tokens_so_far = []
-
-    model.prefill(torch.zeros(1, 4, dtype=torch.int32, device=device), caches)
-    graph = torch.cuda.CUDAGraph()
-    with torch.cuda.graph(graph):
-        logits = model(input_token[None, :], caches=caches)[0]
-
-    def lcp(cache: list[int], inp: list[int]) -> list[int]:
-        i = 0
-        max_len = min(len(cache), len(inp))
-        while i < max_len and cache[i] == inp[i]:
-            i += 1
-        return cache[:i]
+def lcp(cache: list[int], inp: list[int]) -> list[int]:
+    i = 0
+    max_len = min(len(cache), len(inp))
+    while i < max_len and cache[i] == inp[i]:
+        i += 1
+    return cache[:i]
+
+
+class SlotPool:
+    """Maps conversations onto a fixed number of KV cache slots.
+
+    A request continues in the slot it was given. A new request is placed in
+    the slot whose cached tokens share the longest prefix with it, which is
+    where the previous turn of the same conversation lives, and otherwise in
+    the least recently used slot.
+    """
+
+    def __init__(self, num_slots: int):
+        self.slot_tokens: list[list[int]] = [[] for _ in range(num_slots)]
+        self.slot_owner: list[Optional[str]] = [None] * num_slots
+        self.slot_last_used = [0] * num_slots
+        self.request_slots: dict[str, int] = {}
+        self.clock = 0
+
+    def acquire(
+        self,
+        request_id: str,
+        tokens: list[int],
+        new_request: bool,
+        busy_requests: frozenset = frozenset(),
+    ) -> int:
+        """Return the slot to run `request_id` in.
+
+        Slots owned by `busy_requests` are being decoded right now and are
+        only taken over when every slot is busy.
+        """
+        self.clock += 1
+        slot = self.request_slots.get(request_id)
+        if slot is None or new_request:
+            candidates = [
+                i
+                for i, owner in enumerate(self.slot_owner)
+                if owner == request_id or owner not in busy_requests
+            ] or list(range(len(self.slot_owner)))
+            # Longest shared prefix first, then least recently used
+            slot = max(
+                candidates,
+                key=lambda i: (
+                    len(lcp(self.slot_tokens[i], tokens)),
+                    -self.slot_last_used[i],
+                ),
+            )
+            previous_owner = self.slot_owner[slot]
+            if self.request_slots.get(previous_owner) == slot:
+                del self.request_slots[previous_owner]
+            previous_slot = self.request_slots.get(request_id)
+            if previous_slot is not None and previous_slot != slot:
+                self.slot_owner[previous_slot] = None
+            self.request_slots[request_id] = slot
+            self.slot_owner[slot] = request_id
+        self.slot_last_used[slot] = self.clock
+        return slot
+
+
+def get_infer_next_tokens(model, device) -> InferNextTokens:
+    slot_caches = list(
+        zip(
+            *(
+                Cache(
+                    CONCURRENT_SESSIONS,
+                    CONTEXT,
+                    model.config.num_key_value_heads,
+                    device=device,
+                ).slots()
+                for _ in range(len(model.block))
+            )
+        )
+    )
+    input_token = torch.zeros(1, dtype=torch.int32, device=device)
+    pool = SlotPool(CONCURRENT_SESSIONS)
+    # New requests that were skipped for lack of prefill budget
+    deferred_new_requests: set[str] = set()
+
+    # One graph per slot; all graphs share a memory pool and the input token
+    graphs, slot_logits = [], []
+    for caches in slot_caches:
+        model.prefill(torch.zeros(1, 4, dtype=torch.int32, device=device), caches)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=graphs[0].pool() if graphs else None):
+            slot_logits.append(model(input_token[None, :], caches=caches)[0])
+        graphs.append(graph)
+        # Drop the warmup tokens, so the slot's first request starts at 0
+        for cache in caches:
+            cache.reset()
 
     def sample_next_token(
         logits: torch.Tensor, temperature: float = DEFAULT_TEMPERATURE
@@ -63,39 +140,117 @@ def get_infer_next_token(model, device):
         probs = torch.softmax(logits * (1.0 / temperature), dim=-1)
         return torch.multinomial(probs[-1, :], num_samples=1).item()
 
-    @torch.inference_mode()
-    def infer_next_token(
+    def infer(
+        request_id: str,
         tokens: list[int],
-        temperature: float = DEFAULT_TEMPERATURE,
-        new_request: bool = False,
-    ) -> int:
-        nonlocal tokens_so_far
-        tokens_so_far = lcp(tokens_so_far, tokens)
-        for cache in caches:
-            cache.truncate(len(tokens_so_far))
-        all_tokens = tokens  # for pdb
-        tokens = tokens[len(tokens_so_far) :]
+        temperature: float,
+        new_request: bool,
+        busy_requests: frozenset = frozenset(),
+        max_prefill_tokens: int = CONTEXT,
+    ) -> tuple[Optional[int], int]:
+        """Returns the next token, or None while the prompt is only partly
+        prefilled, and the number of prompt tokens prefilled."""
+        continuing = not new_request and request_id in pool.request_slots
+        slot = pool.acquire(request_id, tokens, new_request, busy_requests)
+        caches = slot_caches[slot]
+        slot_tokens = pool.slot_tokens[slot]
+        if continuing:
+            # A continuing request only appends to what its slot holds
+            num_cached = len(slot_tokens)
+        else:
+            num_cached = len(lcp(slot_tokens, tokens))
+        # Always feed at least one token to get logits for the next one
+        num_cached = min(num_cached, len(tokens) - 1)
+        if num_cached < len(slot_tokens):
+            for cache in caches:
+                cache.truncate(num_cached, len(slot_tokens))
+            del slot_tokens[num_cached:]
+        new_tokens = tokens[num_cached:]
+
+        if len(new_tokens) - 1 > max_prefill_tokens:
+            # Feed one chunk now and the rest on later steps
+            chunk = new_tokens[:max_prefill_tokens]
+            if chunk:
+                model.prefill(
+                    torch.as_tensor(chunk, dtype=torch.int32, device=device)[None, :],
+                    caches,
+                )
+            slot_tokens.extend(chunk)
+            return None, len(chunk)
 
-        if len(tokens) > 1:
+        if len(new_tokens) > 1:
             model.prefill(
-                torch.as_tensor(tokens[:-1], dtype=torch.int32, device=device)[None, :],
+                torch.as_tensor(new_tokens[:-1], dtype=torch.int32, device=device)[None, :],
                 caches,
             )
 
-        if len(tokens) == 0:
-            breakpoint()
-
-        input_token[-1] = tokens[-1]
-        graph.replay()
+        input_token[-1] = new_tokens[-1]
+        graphs[slot].replay()
+        slot_tokens.extend(new_tokens)
 
         # decide next token on rank‑0
-        next_tok = sample_next_token(logits, temperature=temperature)
+        return sample_next_token(slot_logits[slot], temperature=temperature), len(new_tokens) - 1
+
+    @torch.inference_mode()
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[Optional[int]]:
+        request_ids = frozenset(request.request_id for request in requests)
+        # Long prompts are prefilled in chunks over several steps, so that
+        # they do not stall the decode steps of other requests
+        budget = PREFILL_CHUNK_SIZE
+        next_tokens = []
+        for request in requests:
+            slot = pool.request_slots.get(request.request_id)
+            decoding = (
+                not request.new_request
+                and request.request_id not in deferred_new_requests
+                and slot is not None
+                and len(request.tokens) == len(pool.slot_tokens[slot]) + 1
+            )
+            if budget <= 0 and not decoding:
+                # Nothing to prefill with this step; keep the slots as they are
+                if request.new_request:
+                    deferred_new_requests.add(request.request_id)
+                next_tokens.append(None)
+                continue
+            next_token, num_prefilled = infer(
+                request.request_id,
+                request.tokens,
+                request.temperature,
+                request.new_request or request.request_id in deferred_new_requests,
+                busy_requests=request_ids - {request.request_id},
+                max_prefill_tokens=max(budget, 0),
+            )
+            deferred_new_requests.discard(request.request_id)
+            budget -= num_prefilled
+            next_tokens.append(next_token)
+        return next_tokens
+
+    # Requests beyond the number of slots would evict each other every step
+    infer_next_tokens.max_batch_size = CONCURRENT_SESSIONS
+    return infer_next_tokens
+
 
-        return next_tok
+def get_infer_next_token(model, device):
+    infer_next_tokens = get_infer_next_tokens(model, device)
+
+    def infer_next_token(
+        tokens: list[int],
+        temperature: float = DEFAULT_TEMPERATURE,
+        new_request: bool = False,
+    ) -> int:
+        request = DecodeRequest("", tokens, temperature, new_request)
+        while (next_token := infer_next_tokens([request])[0]) is None:
+            request.new_request = False
+        return next_token
 
     return infer_next_token
 
 
+def setup_batched_model(checkpoint: str) -> InferNextTokens:
+    model, device = load_model(checkpoint)
+    return get_infer_next_tokens(model, device)
+
+
 def setup_model(checkpoint: str) -> Callable[[list[int], float], int]:
     model, device = load_model(checkpoint)
     infer_next_token = get_infer_next_token(model, device)
@@ -1,15 +1,24 @@
 """
-NOTE: this is not the most efficient way to use vLLM. It's a simple implementation that infers 
-one token at a time to mimic the behavior of the Triton implementation. 
+vLLM backend for :mod:`gpt_oss.responses_api`.
+
+`setup_streaming_model` keeps a single `AsyncLLMEngine` and submits every
+generation to it as one long-running request, so vLLM's paged attention,
+continuous batching and prefix caching all apply. `setup_model` is the
+simple implementation that infers one token at a time to mimic the behavior
+of the Triton implementation.
 """
 
+import asyncio
+import itertools
 import os
 from typing import Callable, List, Optional
 
 # vLLM imports
-from vllm import LLM, SamplingParams
+from vllm import LLM, AsyncEngineArgs, AsyncLLMEngine, SamplingParams
 from vllm.inputs import TokensPrompt
 
+from .. import streaming
+
 DEFAULT_TEMPERATURE = 0.0
 TP = os.environ.get("TP", 2)
 
@@ -82,3 +91,78 @@ def setup_model(checkpoint: str) -> Callable[[List[int], float, bool], int]:
     llm = load_model(checkpoint)
     infer_next_token = get_infer_next_token(llm)
     return infer_next_token
+
+
+class VLLMStreamingBackend:
+    """Streams token ids from an `AsyncLLMEngine` shared by all requests."""
+
+    def __init__(self, engine: AsyncLLMEngine):
+        self.engine = engine
+        self._counter = itertools.count()
+
+    def start(
+        self,
+        request_id: str,
+        tokens: list[int],
+        sampling_params: streaming.SamplingParams,
+    ) -> streaming.TokenStream:
+        loop = asyncio.get_running_loop()
+        # A response restarts generation after tool calls; keep engine ids unique
+        engine_request_id = f"{request_id}-{next(self._counter)}"
+        task: Optional[asyncio.Task] = None
+        # Cancelling the task makes vLLM abort the request
+        stream = streaming.TokenStream(loop, on_close=lambda: task.cancel())
+        task = loop.create_task(
+            self._generate(stream, engine_request_id, list(tokens), sampling_params)
+        )
+        return stream
+
+    async def _generate(
+        self,
+        stream: streaming.TokenStream,
+        request_id: str,
+        tokens: list[int],
+        sampling_params: streaming.SamplingParams,
+    ) -> None:
+        sampling = SamplingParams(
+            temperature=float(sampling_params.temperature),
+            max_tokens=sampling_params.max_tokens,
+            stop_token_ids=list(sampling_params.stop_tokens),
+            detokenize=False,  # only token ids go back to the server
+            n=1,
+        )
+        num_sent = 0
+        try:
+            async for output in self.engine.generate(
+                TokensPrompt(prompt_token_ids=tokens), sampling, request_id
+            ):
+                gen = output.outputs[0]
+                token_ids = list(gen.token_ids)
+                if (
+                    output.finished
+                    and isinstance(gen.stop_reason, int)
+                    and token_ids[-1:] != [gen.stop_reason]
+                ):
+                    # The server's parser needs the stop token itself
+                    token_ids.append(gen.stop_reason)
+                if len(token_ids) > num_sent and not stream.put(token_ids[num_sent:]):
+                    break
+                num_sent = len(token_ids)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            stream.end(e)
+            return
+        stream.end()
+
+
+def setup_streaming_model(checkpoint: str) -> VLLMStreamingBackend:
+    engine = AsyncLLMEngine.from_engine_args(
+        AsyncEngineArgs(
+            model=checkpoint,
+            tensor_parallel_size=int(TP),
+            enable_prefix_caching=True,  # reuse KV for shared prefixes
+            disable_log_stats=True,
+        )
+    )
+    return VLLMStreamingBackend(engine)
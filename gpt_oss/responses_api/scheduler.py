@@ -0,0 +1,173 @@
+"""Continuous batching for :mod:`gpt_oss.responses_api`.
+
+Every in-flight response starts a token stream on the
+:class:`BatchScheduler`. A worker thread collects the open streams at each
+step, hands them to the backend as one batch, and fans the sampled tokens
+back out to the streams, which keeps the event loop free for HTTP traffic.
+Requests join and leave the batch on any step, so a long response never holds
+up a short one. Backends may also spread a long prompt over several steps;
+such requests simply stay in the batch until their token is ready.
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from .streaming import SamplingParams, TokenStream
+
+DEFAULT_MAX_BATCH_SIZE = 32
+
+
+@dataclass
+class DecodeRequest:
+    """One stream's request for its next token."""
+
+    request_id: str
+    tokens: list[int]
+    temperature: float = 0.0
+    new_request: bool = False
+
+
+# A batched backend samples one next token for every request in the batch, or
+# returns None for requests whose prompt is still being prefilled in chunks.
+# Backends that keep per-request state in a fixed number of places, e.g. KV
+# cache slots, report that number as a `max_batch_size` attribute.
+InferNextTokens = Callable[[list[DecodeRequest]], list[Optional[int]]]
+
+
+def sequential_infer_next_tokens(
+    infer_next_token: Callable[..., int],
+) -> InferNextTokens:
+    """Adapt a single-token backend to the batched interface."""
+
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[int]:
+        return [
+            infer_next_token(
+                request.tokens,
+                temperature=request.temperature,
+                new_request=request.new_request,
+            )
+            for request in requests
+        ]
+
+    return infer_next_tokens
+
+
+@dataclass(eq=False)
+class _Generation:
+    stream: TokenStream
+    request: DecodeRequest
+    sampling_params: SamplingParams
+    num_generated: int = 0
+
+
+class BatchScheduler:
+    """Groups concurrent requests into batched backend steps.
+
+    The backend runs on a dedicated worker thread, off the asyncio event
+    loop. Every started stream is decoded on each step until it ends. Once
+    there are more than `max_batch_size` of them, the later ones wait for a
+    place in the batch, so that the backend never has to swap out the state
+    of a request it is still generating for. `max_batch_size` is capped at
+    the backend's own `max_batch_size`, if it has one. Implements
+    :class:`gpt_oss.responses_api.streaming.StreamingBackend`.
+    """
+
+    def __init__(
+        self,
+        infer_next_tokens: InferNextTokens,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    ):
+        assert max_batch_size > 0
+        self.infer_next_tokens = infer_next_tokens
+        self.max_batch_size = min(
+            max_batch_size, getattr(infer_next_tokens, "max_batch_size", max_batch_size)
+        )
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        # Generations being decoded or waiting for a place, in starting order
+        self._active: OrderedDict[_Generation, None] = OrderedDict()
+        # Generations started since the event loop last admitted new ones
+        self._incoming: list[_Generation] = []
+        self._worker: Optional[threading.Thread] = None
+
+    def start(
+        self,
+        request_id: str,
+        tokens: list[int],
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> TokenStream:
+        """Start generating after `tokens`; must be called on the event loop."""
+        loop = asyncio.get_running_loop()
+        generation = _Generation(
+            None,
+            DecodeRequest(
+                request_id, list(tokens), sampling_params.temperature, new_request=True
+            ),
+            sampling_params,
+        )
+        generation.stream = TokenStream(loop, on_close=lambda: self._close(generation))
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="generation-worker", daemon=True
+                )
+                self._worker.start()
+            if not self._incoming:
+                # Admit generations once every task that is ready has run, so
+                # that streams started together begin on the same step.
+                loop.call_soon(self._admit)
+            self._incoming.append(generation)
+        return generation.stream
+
+    def _admit(self) -> None:
+        with self._lock:
+            for generation in self._incoming:
+                if not generation.stream.closed:
+                    self._active[generation] = None
+            self._incoming = []
+            self._has_work.notify()
+
+    def _close(self, generation: _Generation) -> None:
+        with self._lock:
+            self._active.pop(generation, None)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while not self._active:
+                    self._has_work.wait()
+                batch = list(self._active)[: self.max_batch_size]
+
+            try:
+                next_tokens = self.infer_next_tokens(
+                    [generation.request for generation in batch]
+                )
+            except Exception as e:
+                with self._lock:
+                    for generation in batch:
+                        self._active.pop(generation, None)
+                        generation.stream.end(e)
+                continue
+
+            with self._lock:
+                for generation, next_tok in zip(batch, next_tokens):
+                    if generation not in self._active:
+                        continue
+                    # Prefill or decoding continues on the next step from
+                    # where this one stopped
+                    generation.request.new_request = False
+                    if next_tok is None:
+                        continue
+                    generation.request.tokens.append(next_tok)
+                    _, done = generation.sampling_params.clip(
+                        [next_tok], generation.num_generated
+                    )
+                    generation.num_generated += 1
+                    if not generation.stream.put([next_tok]):
+                        self._active.pop(generation)
+                    elif done:
+                        self._active.pop(generation)
+                        generation.stream.end()
@@ -1,6 +1,7 @@
 # torchrun --nproc-per-node=4 serve.py
 
 import argparse
+import logging
 
 import uvicorn
 from openai_harmony import (
@@ -9,6 +10,15 @@ from openai_harmony import (
 )
 
 from .api_server import create_api_server
+from .scheduler import DEFAULT_MAX_BATCH_SIZE, BatchScheduler
+from .sse import DEFAULT_FLUSH_INTERVAL
+from .store import (
+    DEFAULT_MAX_ENTRIES,
+    DEFAULT_TTL,
+    InMemoryResponseStore,
+    SQLiteResponseStore,
+)
+from .tracing import TokenLogger
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Responses API server")
@@ -35,24 +45,100 @@ if __name__ == "__main__":
         # default to metal on macOS, triton on other platforms
         default="metal" if __import__("platform").system() == "Darwin" else "triton",
     )
+    parser.add_argument(
+        "--max-batch-size",
+        metavar="N",
+        type=int,
+        default=DEFAULT_MAX_BATCH_SIZE,
+        help="Maximum number of requests decoded together by batching backends (1 to disable)",
+    )
+    parser.add_argument(
+        "--response-store",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="SQLite database for stored responses, shared by all workers"
+        " (default: keep them in memory)",
+    )
+    parser.add_argument(
+        "--response-store-max-entries",
+        metavar="N",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="Maximum number of stored responses",
+    )
+    parser.add_argument(
+        "--response-store-ttl",
+        metavar="SECONDS",
+        type=float,
+        default=DEFAULT_TTL,
+        help="Seconds after which a stored response expires",
+    )
+    parser.add_argument(
+        "--sse-flush-interval",
+        metavar="SECONDS",
+        type=float,
+        default=DEFAULT_FLUSH_INTERVAL,
+        help="Join streamed events produced within this many seconds into one"
+        " write (0 to write every event at once)",
+    )
+    parser.add_argument(
+        "--trace-tokens",
+        action="store_true",
+        help="Log every prompt and the generated text, in batches",
+    )
     args = parser.parse_args()
 
     if args.inference_backend == "triton":
-        from .inference.triton import setup_model
+        from .inference import triton as backend
+    elif args.inference_backend == "torch":
+        from .inference import torch as backend
     elif args.inference_backend == "stub":
-        from .inference.stub import setup_model
+        from .inference import stub as backend
     elif args.inference_backend == "metal":
-        from .inference.metal import setup_model
+        from .inference import metal as backend
     elif args.inference_backend == "ollama":
-        from .inference.ollama import setup_model
+        from .inference import ollama as backend
     elif args.inference_backend == "vllm":
-        from .inference.vllm import setup_model
+        from .inference import vllm as backend
     elif args.inference_backend == "transformers":
-        from .inference.transformers import setup_model
+        from .inference import transformers as backend
     else:
         raise ValueError(f"Invalid inference backend: {args.inference_backend}")
 
     encoding = load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS)
 
-    infer_next_token = setup_model(args.checkpoint)
-    uvicorn.run(create_api_server(infer_next_token, encoding), port=args.port)
+    if hasattr(backend, "setup_streaming_model"):
+        infer_next_token = backend.setup_streaming_model(args.checkpoint)
+    elif hasattr(backend, "setup_batched_model"):
+        infer_next_token = BatchScheduler(
+            backend.setup_batched_model(args.checkpoint),
+            max_batch_size=args.max_batch_size,
+        )
+    else:
+        infer_next_token = backend.setup_model(args.checkpoint)
+    if args.response_store:
+        response_store = SQLiteResponseStore(
+            args.response_store,
+            max_entries=args.response_store_max_entries,
+            ttl=args.response_store_ttl,
+        )
+    else:
+        response_store = InMemoryResponseStore(
+            max_entries=args.response_store_max_entries, ttl=args.response_store_ttl
+        )
+    tracer = None
+    if args.trace_tokens:
+        logging.basicConfig()
+        logging.getLogger("gpt_oss.responses_api.tracing").setLevel(logging.DEBUG)
+        tracer = TokenLogger(encoding)
+    uvicorn.run(
+        create_api_server(
+            infer_next_token,
+            encoding,
+            response_store,
+            tracer,
+            sse_flush_interval=args.sse_flush_interval,
+        ),
+        port=args.port,
+    )
@@ -0,0 +1,97 @@
+"""Coalesced server-sent events for :mod:`gpt_oss.responses_api`.
+
+Every generated token produces at least one event, so writing events as
+they come means a socket write per token and client. :func:`coalesce_events`
+instead joins the events produced within `flush_interval` seconds of the
+first unwritten one, or up to `max_bytes`, into a single chunk. Clients that
+need every event right away can turn this off per request by sending a
+flush interval of 0.
+"""
+
+import asyncio
+import math
+from typing import AsyncIterator, Optional, Union
+
+DEFAULT_FLUSH_INTERVAL = 0.02
+DEFAULT_MAX_BYTES = 16 * 1024
+# Request header overriding the flush interval, in seconds
+FLUSH_INTERVAL_HEADER = "x-sse-flush-interval"
+# Longer intervals asked for in the header are cut to this
+MAX_FLUSH_INTERVAL = 1.0
+
+
+def parse_flush_interval(value: str) -> float:
+    """The flush interval in a request header, or `ValueError` if it is not
+    a finite number of seconds, at least 0."""
+    flush_interval = float(value)
+    if not math.isfinite(flush_interval) or flush_interval < 0:
+        raise ValueError(f"Invalid flush interval: {value!r}")
+    return min(flush_interval, MAX_FLUSH_INTERVAL)
+
+
+class _End:
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+async def _next_event(events: AsyncIterator[str]) -> Union[str, _End]:
+    try:
+        return await events.__anext__()
+    except StopAsyncIteration:
+        return _End()
+    except Exception as e:
+        return _End(e)
+
+
+async def coalesce_events(
+    events: AsyncIterator[str],
+    flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> AsyncIterator[str]:
+    """Yield the SSE strings from `events` joined into chunks."""
+    if flush_interval <= 0:
+        async for event in events:
+            yield event
+        return
+
+    loop = asyncio.get_running_loop()
+    # Reading the next event runs in a task, so that waiting for it can time
+    # out without interrupting the event generator. Only that one event is
+    # read ahead, so a slow client still slows generation down.
+    pending: Optional[asyncio.Future] = None
+    try:
+        end = None
+        while end is None:
+            if pending is None:
+                pending = asyncio.ensure_future(_next_event(events))
+            item = await pending
+            pending = None
+            deadline = loop.time() + flush_interval
+            chunk, size = [], 0
+            while True:
+                if isinstance(item, _End):
+                    end = item
+                    break
+                chunk.append(item)
+                size += len(item)
+                if size >= max_bytes:
+                    break
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                pending = asyncio.ensure_future(_next_event(events))
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    break
+                item, pending = pending.result(), None
+            if chunk:
+                yield "".join(chunk)
+        if end.error is not None:
+            raise end.error
+    finally:
+        # Stops generating when the client goes away before the end
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        if hasattr(events, "aclose"):
+            await events.aclose()
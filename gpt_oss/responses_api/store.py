@@ -0,0 +1,233 @@
+"""Stores of finished responses for :mod:`gpt_oss.responses_api`.
+
+Requests with ``store=True`` keep their request and response so that a later
+request can continue the conversation with ``previous_response_id``. Both
+stores drop records older than their TTL and, once full, the least recently
+used ones. :class:`InMemoryResponseStore` lives in the server process;
+:class:`SQLiteResponseStore` keeps compressed records in a local database
+file, which survives restarts and is shared by all workers on the host.
+
+Along with each response the stores can keep the tokens the next turn
+continues from, so a follow-up only has to render its new items.
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Protocol
+
+from .types import ResponseObject, ResponsesRequest
+
+DEFAULT_MAX_ENTRIES = 10_000
+# Seconds a stored response can be continued from
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+
+class StoredResponse(NamedTuple):
+    request: ResponsesRequest
+    response: ResponseObject
+    # Conversation tokens a follow-up turn continues from, if known
+    tokens: Optional[list[int]] = None
+
+
+class ResponseStore(Protocol):
+    # The server calls stores from a thread pool rather than the event loop,
+    # so they may block on I/O but have to be thread-safe.
+
+    def get(self, response_id: str) -> Optional[StoredResponse]:
+        """Return what was stored under `response_id`, or `None` if it was
+        never stored or has expired."""
+        ...
+
+    def put(
+        self,
+        response_id: str,
+        request: ResponsesRequest,
+        response: ResponseObject,
+        tokens: Optional[list[int]] = None,
+    ) -> None: ...
+
+
+class InMemoryResponseStore:
+    """LRU of responses in the server process, lost on restart."""
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: Optional[float] = DEFAULT_TTL,
+    ):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Response id -> (time stored, record), least recently used first
+        self._entries: OrderedDict[str, tuple[float, StoredResponse]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, response_id: str) -> Optional[StoredResponse]:
+        with self._lock:
+            entry = self._entries.get(response_id)
+            if entry is None:
+                return None
+            stored_at, record = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self._entries[response_id]
+                return None
+            self._entries.move_to_end(response_id)
+            return record
+
+    def put(
+        self,
+        response_id: str,
+        request: ResponsesRequest,
+        response: ResponseObject,
+        tokens: Optional[list[int]] = None,
+    ) -> None:
+        now = time.time()
+        record = StoredResponse(
+            request, response, list(tokens) if tokens is not None else None
+        )
+        with self._lock:
+            self._entries[response_id] = (now, record)
+            self._entries.move_to_end(response_id)
+            if self.ttl is not None:
+                # Sweep expired entries off the LRU end; others expire on lookup
+                while self._entries:
+                    oldest_id, (stored_at, _) = next(iter(self._entries.items()))
+                    if now - stored_at <= self.ttl:
+                        break
+                    del self._entries[oldest_id]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteResponseStore:
+    """Responses in a local SQLite database.
+
+    Each record is the zlib-compressed JSON of the request and response with
+    unset fields left out, and the tokens as compressed 32-bit integers. The
+    database runs in WAL mode, so several server processes can share one file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = DEFAULT_MAX_ENTRIES,
+        ttl: Optional[float] = DEFAULT_TTL,
+    ):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=30.0, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " id TEXT PRIMARY KEY,"
+            " stored_at REAL NOT NULL,"
+            " used_at REAL NOT NULL,"
+            " request BLOB NOT NULL,"
+            " response BLOB NOT NULL,"
+            " tokens BLOB)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_stored_at ON responses (stored_at)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)"
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def get(self, response_id: str) -> Optional[StoredResponse]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stored_at, request, response, tokens FROM responses"
+                " WHERE id = ?",
+                (response_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            stored_at, request, response, tokens = row
+            if self.ttl is not None and now - stored_at > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE id = ?", (response_id,))
+                return None
+            self._conn.execute(
+                "UPDATE responses SET used_at = ? WHERE id = ?", (now, response_id)
+            )
+        return StoredResponse(
+            ResponsesRequest.model_validate_json(zlib.decompress(request)),
+            ResponseObject.model_validate_json(zlib.decompress(response)),
+            _decode_tokens(tokens) if tokens is not None else None,
+        )
+
+    def put(
+        self,
+        response_id: str,
+        request: ResponsesRequest,
+        response: ResponseObject,
+        tokens: Optional[list[int]] = None,
+    ) -> None:
+        now = time.time()
+        record = (
+            response_id,
+            now,
+            now,
+            zlib.compress(request.model_dump_json(exclude_unset=True).encode("utf-8")),
+            zlib.compress(response.model_dump_json(exclude_unset=True).encode("utf-8")),
+            _encode_tokens(tokens) if tokens is not None else None,
+        )
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", record
+                )
+                if self.ttl is not None:
+                    self._conn.execute(
+                        "DELETE FROM responses WHERE stored_at < ?", (now - self.ttl,)
+                    )
+                if self.max_entries is not None:
+                    self._conn.execute(
+                        "DELETE FROM responses WHERE id IN (SELECT id FROM responses"
+                        " ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                        (self.max_entries,),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+
+def _encode_tokens(tokens: list[int]) -> bytes:
+    data = array("i", tokens)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return zlib.compress(data.tobytes())
+
+
+def _decode_tokens(blob: bytes) -> list[int]:
+    data = array("i")
+    data.frombytes(zlib.decompress(blob))
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tolist()
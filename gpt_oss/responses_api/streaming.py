@@ -0,0 +1,108 @@
+"""Streaming backend protocol for :mod:`gpt_oss.responses_api`.
+
+A streaming backend is handed the whole prompt once per generation with
+:meth:`StreamingBackend.start` and returns a :class:`TokenStream`, which
+yields the generated tokens in chunks until a stop token, the token budget
+or :meth:`TokenStream.close`. The server never resends the conversation per
+token, and tokens generated in a burst reach it as a single chunk.
+"""
+
+import asyncio
+from dataclasses import dataclass
+from typing import Callable, Optional, Protocol
+
+
+@dataclass(frozen=True)
+class SamplingParams:
+    temperature: float = 0.0
+    # The stream ends after the first of these tokens, which is included
+    stop_tokens: frozenset[int] = frozenset()
+    max_tokens: Optional[int] = None
+
+    def clip(self, tokens: list[int], num_generated: int) -> tuple[list[int], bool]:
+        """Cut a chunk that follows `num_generated` tokens at the first stop
+        token or the token budget. Returns the kept tokens and whether the
+        generation is finished."""
+        if self.max_tokens is not None:
+            tokens = tokens[: self.max_tokens - num_generated]
+        for i, token in enumerate(tokens):
+            if token in self.stop_tokens:
+                return tokens[: i + 1], True
+        return tokens, num_generated + len(tokens) == self.max_tokens
+
+
+_END_OF_STREAM = object()
+
+
+class TokenStream:
+    """Chunks of tokens generated for one request, in order.
+
+    Producers run on their own thread and hand tokens to the event loop
+    through an asyncio queue with :meth:`put` and :meth:`end`, so consuming
+    them never blocks on the model. Iterate with ``async for``; every step
+    returns all tokens that arrived since the previous one.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        on_close: Optional[Callable[[], None]] = None,
+    ):
+        self.closed = False
+        self._loop = loop
+        self._on_close = on_close
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._end = None
+
+    def __aiter__(self) -> "TokenStream":
+        return self
+
+    async def __anext__(self) -> list[int]:
+        tokens = []
+        while self._end is None and not (tokens and self._queue.empty()):
+            item = await self._queue.get()
+            if isinstance(item, list):
+                tokens.extend(item)
+            else:
+                self._end = item
+        if tokens:
+            return tokens
+        if self._end is _END_OF_STREAM:
+            raise StopAsyncIteration
+        raise self._end
+
+    def close(self) -> None:
+        """Stop generating; called by the consumer."""
+        if not self.closed:
+            self.closed = True
+            if self._on_close is not None:
+                self._on_close()
+
+    def put(self, tokens: list[int]) -> bool:
+        """Hand over tokens from any thread; False once nobody is listening."""
+        if self.closed:
+            return False
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, list(tokens))
+        except RuntimeError:  # event loop closed
+            self.closed = True
+            return False
+        return True
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """Finish the stream from any thread, optionally with an error."""
+        self.closed = True
+        try:
+            self._loop.call_soon_threadsafe(
+                self._queue.put_nowait, error or _END_OF_STREAM
+            )
+        except RuntimeError:  # event loop closed
+            pass
+
+
+class StreamingBackend(Protocol):
+    def start(
+        self, request_id: str, tokens: list[int], sampling_params: SamplingParams
+    ) -> TokenStream:
+        """Start generating after `tokens`; called on the event loop."""
+        ...
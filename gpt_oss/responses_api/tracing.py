@@ -0,0 +1,79 @@
+"""Optional tracing of prompts and generated tokens for :mod:`gpt_oss.responses_api`.
+
+The server does no per-token I/O unless it is given a :class:`Tracer`.
+:class:`TokenLogger` is the one used by ``serve.py --trace-tokens``: it
+decodes and logs the generated text in batches, one record per
+`batch_size` tokens and one at the end of each response.
+"""
+
+import logging
+from typing import Protocol
+
+from openai_harmony import HarmonyEncoding
+
+DEFAULT_BATCH_SIZE = 256
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer(Protocol):
+    def prompt(self, response_id: str, tokens: list[int]) -> None:
+        """Called with the prompt before a response is generated."""
+        ...
+
+    def tokens(self, response_id: str, tokens: list[int]) -> None:
+        """Called with the tokens added to the conversation after the prompt,
+        including tool output, in order."""
+        ...
+
+    def end(self, response_id: str) -> None:
+        """Called once the response is finished or abandoned."""
+        ...
+
+
+class TokenLogger:
+    """Logs prompts and generated text to `logger` at DEBUG level."""
+
+    def __init__(
+        self,
+        encoding: HarmonyEncoding,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        logger: logging.Logger = logger,
+    ):
+        assert batch_size > 0
+        self.encoding = encoding
+        self.batch_size = batch_size
+        self.logger = logger
+        # Tokens not logged yet, by response id
+        self.pending: dict[str, list[int]] = {}
+
+    def _log(self, response_id: str, kind: str, tokens: list[int]) -> None:
+        self.logger.debug(
+            "%s %s (%d tokens): %s",
+            response_id,
+            kind,
+            len(tokens),
+            self.encoding.decode(tokens),
+            extra={"response_id": response_id, "kind": kind, "num_tokens": len(tokens)},
+        )
+
+    def prompt(self, response_id: str, tokens: list[int]) -> None:
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._flush(response_id)
+            self._log(response_id, "prompt", tokens)
+
+    def tokens(self, response_id: str, tokens: list[int]) -> None:
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        pending = self.pending.setdefault(response_id, [])
+        pending.extend(tokens)
+        if len(pending) >= self.batch_size:
+            self._flush(response_id)
+
+    def end(self, response_id: str) -> None:
+        self._flush(response_id)
+
+    def _flush(self, response_id: str) -> None:
+        pending = self.pending.pop(response_id, None)
+        if pending:
+            self._log(response_id, "output", pending)
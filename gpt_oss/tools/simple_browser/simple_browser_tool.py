@@ -629,6 +629,18 @@ sources=""" + self.backend.source
         if hide_partial_citations and has_partial_citations:
             old_content = PARTIAL_FINAL_LINK_PATTERN.sub("", old_content)
 
+        new_content, annotations = self._replace_citations(old_content)
+        return new_content, annotations, has_partial_citations
+
+    def citation_normalizer(self) -> "CitationNormalizer":
+        """A :class:`CitationNormalizer` for one streamed message."""
+        return CitationNormalizer(self)
+
+    def _replace_citations(
+        self, old_content: str, offset: int = 0
+    ) -> tuple[str, list[dict[str, Any]]]:
+        """Replace complete citations in `old_content`; annotation indices
+        are shifted by `offset`, the length of the text preceding it."""
         matches = []
         for match in CITATION_OUTPUT_PATTERN.finditer(old_content):
             cursor = match.group("cursor")
@@ -671,7 +683,7 @@ sources=""" + self.backend.source
                 domain = extract_domain(url)
                 replacement = f" ([{domain}]({url})) "
                 # The start and end indices in the new content
-                start_index = len(new_content)
+                start_index = offset + len(new_content)
                 end_index = start_index + len(replacement)
                 annotations.append({
                     "start_index": start_index,
@@ -692,5 +704,36 @@ sources=""" + self.backend.source
             last_idx = orig_end
 
         new_content += old_content[last_idx:]
-        return new_content, annotations, has_partial_citations
-
+        return new_content, annotations
+
+
+class CitationNormalizer:
+    """Incremental :meth:`SimpleBrowserTool.normalize_citations` for a message
+    that arrives in pieces.
+
+    Only the text fed since the last call is scanned, and only a trailing
+    unfinished citation is held back, so every citation is normalized and
+    annotated exactly once however long the message gets.
+    """
+
+    def __init__(self, browser_tool: SimpleBrowserTool):
+        self.browser_tool = browser_tool
+        # Length of the normalized text returned so far
+        self.offset = 0
+        # Start of a citation that is not complete yet
+        self.pending = ""
+
+    def feed(self, delta: str) -> tuple[str, list[dict[str, Any]], bool]:
+        """Returns a tuple of (new_text, annotations, has_partial_citations)
+        - new_text: normalized text that can be sent after the previous one
+        - annotations: annotations of the citations in new_text, with start
+          and end indices into the whole normalized message
+        - has_partial_citations: whether an unfinished citation is held back
+        """
+        text = self.pending + delta
+        partial = PARTIAL_FINAL_LINK_PATTERN.search(text)
+        end = partial.start() if partial is not None else len(text)
+        text, self.pending = text[:end], text[end:]
+        new_text, annotations = self.browser_tool._replace_citations(text, self.offset)
+        self.offset += len(new_text)
+        return new_text, annotations, partial is not None
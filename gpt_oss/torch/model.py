@@ -5,8 +5,17 @@ from dataclasses import dataclass
 
 import torch
 import torch.distributed as dist
+from safetensors import safe_open
 
-from gpt_oss.torch.weights import Checkpoint
+from gpt_oss.torch.paged_cache import PagedKVCache, SequenceSlots
+from gpt_oss.torch.speculative import Drafter, verify_draft
+from gpt_oss.torch.weights import (
+    Checkpoint,
+    Shard,
+    checkpoint_fingerprint,
+    dequantize_mxfp4,
+    save_converted,
+)
 
 
 @dataclass
@@ -46,6 +55,19 @@ class RMSNorm(torch.nn.Module):
         t = t * torch.rsqrt(torch.mean(t**2, dim=-1, keepdim=True) + self.eps)
         return (t * self.scale).to(dtype)
 
+    def decode_step(self, x: torch.Tensor, workspace: "DecodeWorkspace") -> torch.Tensor:
+        """`forward` for a single token, writing into `workspace`."""
+        assert x.shape == workspace.norm.shape
+        t = workspace.norm_float.copy_(x)
+        mean = torch.mean(
+            torch.mul(t, t, out=workspace.norm_square),
+            dim=-1,
+            keepdim=True,
+            out=workspace.norm_mean,
+        )
+        t.mul_(mean.add_(self.eps).rsqrt_()).mul_(self.scale)
+        return workspace.norm.copy_(t)
+
 
 def _apply_rotary_emb(
     x: torch.Tensor,
@@ -60,6 +82,22 @@ def _apply_rotary_emb(
     return torch.cat((o1, o2), dim=-1)
 
 
+def _apply_rotary_emb_(
+    x: torch.Tensor,
+    cos: torch.Tensor,
+    sin: torch.Tensor,
+) -> torch.Tensor:
+    """In-place `_apply_rotary_emb` for `x` of shape (..., head_dim)."""
+    cos = cos.to(x.dtype)
+    sin = sin.to(x.dtype)
+    x1, x2 = torch.chunk(x, 2, dim=-1)
+    # Same rounding as `_apply_rotary_emb`
+    x1_sin = x1 * sin
+    x1.mul_(cos).sub_(x2 * sin)
+    x2.mul_(cos).add_(x1_sin)
+    return x
+
+
 class RotaryEmbedding(torch.nn.Module):
     def __init__(
         self,
@@ -81,6 +119,8 @@ class RotaryEmbedding(torch.nn.Module):
         self.ntk_alpha = ntk_alpha
         self.ntk_beta = ntk_beta
         self.device = device
+        # Computed on first use
+        self.concentration_and_inv_freq = None
 
     def _compute_concentration_and_inv_freq(self) -> torch.Tensor:
         """See YaRN paper: https://arxiv.org/abs/2309.00071"""
@@ -122,9 +162,14 @@ class RotaryEmbedding(torch.nn.Module):
 
         return concentration, inv_freq
 
-    def _compute_cos_sin(self, num_tokens: int):
-        concentration, inv_freq = self._compute_concentration_and_inv_freq()
-        t = torch.arange(num_tokens, dtype=torch.float32, device=self.device)
+    def _compute_cos_sin(self, num_tokens: int, positions: torch.Tensor | None = None):
+        if self.concentration_and_inv_freq is None:
+            self.concentration_and_inv_freq = self._compute_concentration_and_inv_freq()
+        concentration, inv_freq = self.concentration_and_inv_freq
+        if positions is None:
+            t = torch.arange(num_tokens, dtype=torch.float32, device=self.device)
+        else:
+            t = positions.to(dtype=torch.float32, device=self.device)
         freqs = torch.einsum("i,j->ij", t, inv_freq)
         cos = freqs.cos() * concentration
         sin = freqs.sin() * concentration
@@ -134,9 +179,10 @@ class RotaryEmbedding(torch.nn.Module):
         self,
         query: torch.Tensor,
         key: torch.Tensor,
+        positions: torch.Tensor | None = None,
     ) -> tuple[torch.Tensor, torch.Tensor]:
         num_tokens = query.shape[0]
-        cos, sin = self._compute_cos_sin(num_tokens)
+        cos, sin = self._compute_cos_sin(num_tokens, positions)
 
         query_shape = query.shape
         query = query.view(num_tokens, -1, self.head_dim)
@@ -150,29 +196,71 @@ class RotaryEmbedding(torch.nn.Module):
         return query, key
 
 
-def sdpa(Q, K, V, S, sm_scale, sliding_window=0):
+# Attention is computed in tiles of at most this many queries, and this many
+# query-key scores per head
+SDPA_QUERY_BLOCK_SIZE = 256
+SDPA_TILE_SIZE = 256 * 1024
+
+
+def sdpa(Q, K, V, S, sm_scale, sliding_window=0, start_q=0):
     # sliding_window == 0 means no sliding window
+    # start_q is the position of the first query among the keys
     n_tokens, n_heads, q_mult, d_head = Q.shape
-    assert K.shape == (n_tokens, n_heads, d_head)
-    assert V.shape == (n_tokens, n_heads, d_head)
-    K = K[:, :, None, :].expand(-1, -1, q_mult, -1)
-    V = V[:, :, None, :].expand(-1, -1, q_mult, -1)
-    S = S.reshape(n_heads, q_mult, 1, 1).expand(-1, -1, n_tokens, -1)
-    mask = torch.triu(Q.new_full((n_tokens, n_tokens), -float("inf")), diagonal=1)
-    if sliding_window > 0:
-        mask += torch.tril(
-            mask.new_full((n_tokens, n_tokens), -float("inf")), diagonal=-sliding_window
-        )
-    QK = torch.einsum("qhmd,khmd->hmqk", Q, K)
-    QK *= sm_scale
-    QK += mask[None, None, :, :]
-    QK = torch.cat([QK, S], dim=-1)
-    W = torch.softmax(QK, dim=-1)
-    W = W[..., :-1]
-    attn = torch.einsum("hmqk,khmd->qhmd", W, V)
+    n_kv_tokens = K.shape[0]
+    assert K.shape == (n_kv_tokens, n_heads, d_head)
+    assert V.shape == (n_kv_tokens, n_heads, d_head)
+    q_block_size = max(min(n_tokens, SDPA_QUERY_BLOCK_SIZE), 1)
+    kv_block_size = max(SDPA_TILE_SIZE // q_block_size, 1)
+    # Online softmax over blocks of keys. The sinks act as one more logit per
+    # head without a value, so they seed the running max and denominator.
+    sinks = S.reshape(n_heads, q_mult, 1).float()
+    attn = torch.empty_like(Q)
+    for q_start in range(0, n_tokens, q_block_size):
+        q_end = min(q_start + q_block_size, n_tokens)
+        q_pos = torch.arange(q_start + start_q, q_end + start_q, device=Q.device)
+        # Only keys inside the causal window of some query in the block
+        kv_start = 0
+        if sliding_window > 0:
+            kv_start = max(0, q_start + start_q - sliding_window + 1)
+        kv_end = min(n_kv_tokens, q_end + start_q)
+
+        running_max = sinks.expand(-1, -1, q_end - q_start).clone()
+        denominator = torch.ones_like(running_max)
+        acc = torch.zeros(
+            (n_heads, q_mult, q_end - q_start, d_head), dtype=torch.float32, device=Q.device
+        )
+        for kv_block_start in range(kv_start, kv_end, kv_block_size):
+            kv_block_end = min(kv_block_start + kv_block_size, kv_end)
+            QK = torch.einsum(
+                "qhmd,khd->hmqk", Q[q_start:q_end], K[kv_block_start:kv_block_end]
+            ).float()
+            QK *= sm_scale
+            k_pos = torch.arange(kv_block_start, kv_block_end, device=Q.device)
+            mask = k_pos[None, :] > q_pos[:, None]
+            if sliding_window > 0:
+                mask |= k_pos[None, :] <= q_pos[:, None] - sliding_window
+            QK.masked_fill_(mask, -float("inf"))
+
+            block_max = torch.maximum(running_max, QK.amax(dim=-1))
+            correction = torch.exp(running_max - block_max)
+            W = torch.exp(QK - block_max[..., None])
+            denominator = denominator * correction + W.sum(dim=-1)
+            acc *= correction[..., None]
+            acc += torch.einsum(
+                "hmqk,khd->hmqd", W.to(V.dtype), V[kv_block_start:kv_block_end]
+            ).float()
+            running_max = block_max
+        attn[q_start:q_end] = (acc / denominator[..., None]).permute(2, 0, 1, 3)
     return attn.reshape(n_tokens, -1)
 
 
+def packed_positions(seq_lens: list[int], device: torch.device | None = None) -> torch.Tensor:
+    """Position of every token in a packed batch, restarting at 0 for each sequence."""
+    return torch.cat(
+        [torch.arange(n, dtype=torch.long, device=device) for n in seq_lens]
+    )
+
+
 class AttentionBlock(torch.nn.Module):
     def __init__(
         self,
@@ -186,6 +274,7 @@ class AttentionBlock(torch.nn.Module):
         self.num_key_value_heads = config.num_key_value_heads
         # Only apply sliding window to every other layer
         self.sliding_window = config.sliding_window if layer_idx % 2 == 0 else 0
+        self.layer_idx = layer_idx
         self.sinks = torch.nn.Parameter(
             torch.empty(config.num_attention_heads, device=device, dtype=torch.bfloat16)
         )
@@ -214,7 +303,31 @@ class AttentionBlock(torch.nn.Module):
             device=device,
         )
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def _cached_sdpa(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        cache: PagedKVCache,
+        slots: SequenceSlots,
+    ) -> torch.Tensor:
+        cache.write(self.layer_idx, slots.write_slots, k, v)
+        read_slots, start_q = slots.read_slots, slots.start
+        if self.sliding_window > 0:
+            # Keys that fell out of the window are never attended to
+            first = max(0, slots.start - self.sliding_window + 1)
+            read_slots, start_q = read_slots[first:], start_q - first
+        k, v = cache.read(self.layer_idx, read_slots)
+        return sdpa(q, k, v, self.sinks, self.sm_scale, self.sliding_window, start_q)
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        seq_lens: list[int] | None = None,
+        positions: torch.Tensor | None = None,
+        cache: PagedKVCache | None = None,
+        slots: list[SequenceSlots] | None = None,
+    ) -> torch.Tensor:
         t = self.norm(x)
         qkv = self.qkv(t)
         q = qkv[:, : self.num_attention_heads * self.head_dim].contiguous()
@@ -239,12 +352,62 @@ class AttentionBlock(torch.nn.Module):
         )
         k = k.view(-1, self.num_key_value_heads, self.head_dim)
         v = v.view(-1, self.num_key_value_heads, self.head_dim)
-        q, k = self.rope(q, k)
-        t = sdpa(q, k, v, self.sinks, self.sm_scale, self.sliding_window)
+        q, k = self.rope(q, k, positions)
+        if cache is not None:
+            t = torch.cat(
+                [
+                    self._cached_sdpa(qs, ks, vs, cache, seq_slots)
+                    for qs, ks, vs, seq_slots in zip(
+                        q.split(seq_lens), k.split(seq_lens), v.split(seq_lens), slots
+                    )
+                ]
+            )
+        elif seq_lens is None:
+            t = sdpa(q, k, v, self.sinks, self.sm_scale, self.sliding_window)
+        else:
+            # Packed batch: attention never crosses a sequence boundary
+            t = torch.cat(
+                [
+                    sdpa(qs, ks, vs, self.sinks, self.sm_scale, self.sliding_window)
+                    for qs, ks, vs in zip(
+                        q.split(seq_lens), k.split(seq_lens), v.split(seq_lens)
+                    )
+                ]
+            )
         t = self.out(t)
         t = x + t
         return t
 
+    def decode_step(
+        self,
+        x: torch.Tensor,
+        cache: PagedKVCache,
+        slots: SequenceSlots,
+        workspace: "DecodeWorkspace",
+    ) -> torch.Tensor:
+        """`forward` for one new token of one cached sequence. Projections
+        write into `workspace`, RoPE is applied in place and the residual is
+        added to `x` in place."""
+        t = self.norm.decode_step(x, workspace)
+        qkv = torch.addmm(self.qkv.bias, t, self.qkv.weight.T, out=workspace.qkv)
+        q_dim = self.num_attention_heads * self.head_dim
+        kv_dim = self.num_key_value_heads * self.head_dim
+        # Views of the projection, without copies
+        q = qkv[:, :q_dim].view(
+            1,
+            self.num_key_value_heads,
+            self.num_attention_heads // self.num_key_value_heads,
+            self.head_dim,
+        )
+        k = qkv[:, q_dim : q_dim + kv_dim].view(1, self.num_key_value_heads, self.head_dim)
+        v = qkv[:, q_dim + kv_dim :].view(1, self.num_key_value_heads, self.head_dim)
+        cos, sin = self.rope._compute_cos_sin(1, workspace.position)
+        _apply_rotary_emb_(q, cos[:, None, None], sin[:, None, None])
+        _apply_rotary_emb_(k, cos[:, None], sin[:, None])
+        t = self._cached_sdpa(q, k, v, cache, slots)
+        t = torch.addmm(self.out.bias, t, self.out.weight.T, out=workspace.out)
+        return x.add_(t)
+
 
 def swiglu(x, alpha: float = 1.702, limit: float = 7.0):
     x_glu, x_linear = x[..., ::2], x[..., 1::2]
@@ -256,13 +419,41 @@ def swiglu(x, alpha: float = 1.702, limit: float = 7.0):
     return out_glu * (x_linear + 1)
 
 
+def swiglu_(x, out, alpha: float = 1.702, limit: float = 7.0):
+    """`swiglu` into `out`, overwriting `x`."""
+    x_glu, x_linear = x[..., ::2], x[..., 1::2]
+    x_glu.clamp_(min=None, max=limit)
+    x_linear.clamp_(min=-limit, max=limit)
+    out = torch.mul(x_glu, alpha, out=out).sigmoid_().mul_(x_glu)
+    return out.mul_(x_linear.add_(1))
+
+
+def mxfp4_parameters(
+    shape: tuple[int, ...], device: torch.device | None = None
+) -> tuple[torch.nn.Parameter, torch.nn.Parameter]:
+    """Packed blocks and exponents of an MXFP4 weight with the given shape."""
+    *prefix_shape, in_features = shape
+    blocks = torch.empty(
+        (*prefix_shape, in_features // 32, 16), device=device, dtype=torch.uint8
+    )
+    scales = torch.empty(
+        (*prefix_shape, in_features // 32), device=device, dtype=torch.uint8
+    )
+    return (
+        torch.nn.Parameter(blocks, requires_grad=False),
+        torch.nn.Parameter(scales, requires_grad=False),
+    )
+
+
 class MLPBlock(torch.nn.Module):
     def __init__(
         self,
         config: ModelConfig,
         device: torch.device | None = None,
+        mxfp4_experts: bool = False,
     ):
         super().__init__()
+        self.mxfp4_experts = mxfp4_experts
         self.num_experts = config.num_experts
         self.experts_per_token = config.experts_per_token
         self.swiglu_limit = config.swiglu_limit
@@ -272,17 +463,43 @@ class MLPBlock(torch.nn.Module):
             config.hidden_size, config.num_experts, device=device, dtype=torch.bfloat16
         )
         assert config.intermediate_size % self.world_size == 0
-        self.mlp1_weight = torch.nn.Parameter(
-            torch.empty(
-                (
-                    config.num_experts,
-                    config.intermediate_size * 2 // self.world_size,
-                    config.hidden_size,
-                ),
-                device=device,
-                dtype=torch.bfloat16,
+        per_rank_intermediate_size = config.intermediate_size // self.world_size
+        if mxfp4_experts:
+            # Expert weights stay packed in MXFP4, 32 values per block of 16
+            # bytes sharing an exponent, and are dequantized when used
+            assert config.hidden_size % 32 == 0
+            assert per_rank_intermediate_size % 32 == 0
+            self.mlp1_weight_blocks, self.mlp1_weight_scales = mxfp4_parameters(
+                (config.num_experts, per_rank_intermediate_size * 2, config.hidden_size),
+                device,
+            )
+            self.mlp2_weight_blocks, self.mlp2_weight_scales = mxfp4_parameters(
+                (config.num_experts, config.hidden_size, per_rank_intermediate_size),
+                device,
+            )
+        else:
+            self.mlp1_weight = torch.nn.Parameter(
+                torch.empty(
+                    (
+                        config.num_experts,
+                        config.intermediate_size * 2 // self.world_size,
+                        config.hidden_size,
+                    ),
+                    device=device,
+                    dtype=torch.bfloat16,
+                )
+            )
+            self.mlp2_weight = torch.nn.Parameter(
+                torch.empty(
+                    (
+                        config.num_experts,
+                        config.hidden_size,
+                        config.intermediate_size // self.world_size,
+                    ),
+                    device=device,
+                    dtype=torch.bfloat16,
+                )
             )
-        )
         self.mlp1_bias = torch.nn.Parameter(
             torch.empty(
                 (config.num_experts, config.intermediate_size * 2 // self.world_size),
@@ -290,17 +507,6 @@ class MLPBlock(torch.nn.Module):
                 dtype=torch.bfloat16,
             )
         )
-        self.mlp2_weight = torch.nn.Parameter(
-            torch.empty(
-                (
-                    config.num_experts,
-                    config.hidden_size,
-                    config.intermediate_size // self.world_size,
-                ),
-                device=device,
-                dtype=torch.bfloat16,
-            )
-        )
         self.mlp2_bias = torch.nn.Parameter(
             torch.empty(
                 (config.num_experts, config.hidden_size),
@@ -309,6 +515,19 @@ class MLPBlock(torch.nn.Module):
             )
         )
 
+    def expert_weight(
+        self, name: str, expert: int, out: torch.Tensor | None = None
+    ) -> torch.Tensor:
+        """The bf16 weight `name` ("mlp1_weight" or "mlp2_weight") of `expert`,
+        dequantized into `out` if given and the weights are in MXFP4."""
+        if not self.mxfp4_experts:
+            return getattr(self, name)[expert]
+        blocks = getattr(self, f"{name}_blocks")[expert]
+        scales = getattr(self, f"{name}_scales")[expert]
+        if out is not None:
+            out = out.view(*blocks.shape[:-1], blocks.shape[-1] * 2)
+        return dequantize_mxfp4(blocks, scales, out=out).flatten(-2)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         t = self.norm(x)
         g = self.gate(t)
@@ -316,25 +535,82 @@ class MLPBlock(torch.nn.Module):
         expert_weights = torch.nn.functional.softmax(experts.values, dim=1)
         expert_indices = experts.indices
 
-        # MLP #1
-        mlp1_weight = self.mlp1_weight[expert_indices, ...]
-        mlp1_bias = self.mlp1_bias[expert_indices, ...]
-        t = torch.einsum("beck,bk->bec", mlp1_weight, t) + mlp1_bias
-        t = swiglu(t, limit=self.swiglu_limit)
+        # Sort the (token, expert) pairs by expert, so that every active expert
+        # runs one matmul over the tokens routed to it instead of each token
+        # gathering copies of its experts' weights
+        flat_indices = expert_indices.flatten()
+        order = torch.argsort(flat_indices, stable=True)
+        token_indices = order // self.experts_per_token
+        routing_weights = expert_weights.flatten()[order, None]
+        counts = torch.bincount(flat_indices, minlength=self.num_experts).tolist()
 
-        # MLP #2
-        mlp2_weight = self.mlp2_weight[expert_indices, ...]
-        mlp2_bias = self.mlp2_bias[expert_indices, ...]
-        t = torch.einsum("beck,bek->bec", mlp2_weight, t)
+        out = torch.zeros_like(t)
+        end = 0
+        for expert, count in enumerate(counts):
+            if count == 0:
+                continue
+            start, end = end, end + count
+            tokens = token_indices[start:end]
+            # MLP #1
+            h = torch.nn.functional.linear(
+                t[tokens], self.expert_weight("mlp1_weight", expert), self.mlp1_bias[expert]
+            )
+            h = swiglu(h, limit=self.swiglu_limit)
+            # MLP #2, weighted by the routing weights
+            h = torch.nn.functional.linear(h, self.expert_weight("mlp2_weight", expert))
+            out.index_add_(0, tokens, h * routing_weights[start:end])
         if self.world_size > 1:
-            dist.all_reduce(t, op=dist.ReduceOp.SUM)
-        t += mlp2_bias
-
-        # Weighted sum of experts
-        t = torch.einsum("bec,be->bc", t, expert_weights)
+            dist.all_reduce(out, op=dist.ReduceOp.SUM)
+        # The second bias is not sharded, so it is added after the reduction
+        mlp2_bias = self.mlp2_bias[expert_indices, ...]
+        t = out + torch.einsum("bec,be->bc", mlp2_bias, expert_weights)
 
         return x + t
 
+    def decode_step(self, x: torch.Tensor, workspace: "DecodeWorkspace") -> torch.Tensor:
+        """`forward` for a single token, adding to `x` in place. Routing,
+        the expert MLPs and the bias gather write into `workspace`."""
+        t = self.norm.decode_step(x, workspace)
+        g = torch.addmm(self.gate.bias, t, self.gate.weight.T, out=workspace.gate)
+        values, indices = torch.topk(
+            g[0],
+            k=self.experts_per_token,
+            sorted=True,
+            out=(workspace.expert_values, workspace.expert_indices),
+        )
+        # Softmax in float32, rounded to bf16 like `forward`; the values are
+        # sorted, so the first is the largest
+        weights = workspace.expert_weights_float.copy_(values)
+        weights.sub_(values[0]).exp_()
+        weights.div_(
+            torch.sum(weights, 0, keepdim=True, out=workspace.expert_weight_sum)
+        )
+        expert_weights = workspace.expert_weights.copy_(weights)
+
+        out = workspace.mlp_out.zero_()
+        for expert, weight in zip(indices.tolist(), expert_weights):
+            h = torch.addmm(
+                self.mlp1_bias[expert],
+                t,
+                self.expert_weight("mlp1_weight", expert, workspace.mlp1_weight).T,
+                out=workspace.mlp1,
+            )
+            h = swiglu_(h, workspace.swiglu, limit=self.swiglu_limit)
+            h = torch.mm(
+                h,
+                self.expert_weight("mlp2_weight", expert, workspace.mlp2_weight).T,
+                out=workspace.mlp2,
+            )
+            out.add_(h.mul_(weight))
+        if self.world_size > 1:
+            dist.all_reduce(out, op=dist.ReduceOp.SUM)
+        # The second bias is not sharded, so it is added after the reduction
+        mlp2_bias = torch.index_select(
+            self.mlp2_bias, 0, indices, out=workspace.expert_biases
+        )
+        out.add_(torch.mv(mlp2_bias.T, expert_weights, out=workspace.mlp2[0]))
+        return x.add_(out)
+
 
 class TransformerBlock(torch.nn.Module):
     def __init__(
@@ -342,31 +618,109 @@ class TransformerBlock(torch.nn.Module):
         config: ModelConfig,
         layer_idx: int,
         device: torch.device | None = None,
+        mxfp4_experts: bool = False,
     ):
         super().__init__()
         self.layer_idx = layer_idx
         self.attn = AttentionBlock(config, layer_idx, device)
-        self.mlp = MLPBlock(config, device)
+        self.mlp = MLPBlock(config, device, mxfp4_experts=mxfp4_experts)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = self.attn(x)
+    def forward(
+        self,
+        x: torch.Tensor,
+        seq_lens: list[int] | None = None,
+        positions: torch.Tensor | None = None,
+        cache: PagedKVCache | None = None,
+        slots: list[SequenceSlots] | None = None,
+    ) -> torch.Tensor:
+        x = self.attn(
+            x, seq_lens=seq_lens, positions=positions, cache=cache, slots=slots
+        )
         x = self.mlp(x)
         return x
 
 
+class DecodeWorkspace:
+    """Buffers reused by every layer and every step of
+    :meth:`Transformer.decode_step`, so decoding a token allocates little.
+    With `mxfp4_experts`, it also holds the dequantized weights of one expert."""
+
+    def __init__(
+        self,
+        config: ModelConfig,
+        device: torch.device | None = None,
+        mxfp4_experts: bool = False,
+    ):
+        world_size = dist.get_world_size() if dist.is_initialized() else 1
+        intermediate_size = config.intermediate_size // world_size
+
+        def empty(num_features: int) -> torch.Tensor:
+            return torch.empty((1, num_features), device=device, dtype=torch.bfloat16)
+
+        self.x = empty(config.hidden_size)
+        # RMSNorm output and its float32 intermediates
+        self.norm = empty(config.hidden_size)
+        self.norm_float = torch.empty(
+            (1, config.hidden_size), device=device, dtype=torch.float32
+        )
+        self.norm_square = torch.empty_like(self.norm_float)
+        self.norm_mean = torch.empty((1, 1), device=device, dtype=torch.float32)
+        self.qkv = empty(
+            config.head_dim * (config.num_attention_heads + 2 * config.num_key_value_heads)
+        )
+        self.out = empty(config.hidden_size)
+        # MoE routing
+        self.gate = empty(config.num_experts)
+        self.expert_values = torch.empty(
+            config.experts_per_token, device=device, dtype=torch.bfloat16
+        )
+        self.expert_indices = torch.empty(
+            config.experts_per_token, device=device, dtype=torch.long
+        )
+        self.expert_weights_float = torch.empty(
+            config.experts_per_token, device=device, dtype=torch.float32
+        )
+        self.expert_weight_sum = torch.empty(1, device=device, dtype=torch.float32)
+        self.expert_weights = torch.empty_like(self.expert_values)
+        self.expert_biases = torch.empty(
+            (config.experts_per_token, config.hidden_size),
+            device=device,
+            dtype=torch.bfloat16,
+        )
+        self.mlp1 = empty(intermediate_size * 2)
+        self.swiglu = empty(intermediate_size)
+        self.mlp2 = empty(config.hidden_size)
+        self.mlp_out = empty(config.hidden_size)
+        self.mlp1_weight = self.mlp2_weight = None
+        if mxfp4_experts:
+            self.mlp1_weight = torch.empty(
+                (intermediate_size * 2, config.hidden_size),
+                device=device,
+                dtype=torch.bfloat16,
+            )
+            self.mlp2_weight = torch.empty(
+                (config.hidden_size, intermediate_size),
+                device=device,
+                dtype=torch.bfloat16,
+            )
+        self.position = torch.zeros(1, dtype=torch.long, device=device)
+
+
 class Transformer(torch.nn.Module):
     def __init__(
         self,
         config: ModelConfig,
         device: torch.device | None = None,
+        mxfp4_experts: bool = False,
     ):
         super().__init__()
+        self.config = config
         self.embedding = torch.nn.Embedding(
             config.vocab_size, config.hidden_size, device=device, dtype=torch.bfloat16
         )
         self.block = torch.nn.ModuleList(
             [
-                TransformerBlock(config, layer_idx, device)
+                TransformerBlock(config, layer_idx, device, mxfp4_experts)
                 for layer_idx in range(config.num_hidden_layers)
             ]
         )
@@ -379,18 +733,76 @@ class Transformer(torch.nn.Module):
             dtype=torch.bfloat16,
         )
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        x: torch.Tensor,
+        seq_lens: list[int] | None = None,
+        cache: PagedKVCache | None = None,
+        seq_ids: list | None = None,
+    ) -> torch.Tensor:
+        """Run the model over `x`.
+
+        With `seq_lens`, `x` is a packed batch holding several sequences back
+        to back; every token and expert matmul is shared, attention is not.
+        With `cache`, `x` holds only the tokens of each sequence in `seq_ids`
+        that are not cached yet; they are appended to the cache and attend to
+        everything cached before them.
+        """
+        positions, slots = None, None
+        if cache is not None:
+            seq_lens = seq_lens or [x.shape[0]]
+            assert seq_ids is not None and len(seq_ids) == len(seq_lens)
+            slots = [
+                cache.reserve(seq_id, n) for seq_id, n in zip(seq_ids, seq_lens)
+            ]
+            positions = torch.cat(
+                [
+                    torch.arange(s.start, s.start + n, dtype=torch.long, device=x.device)
+                    for s, n in zip(slots, seq_lens)
+                ]
+            )
+        elif seq_lens is not None:
+            positions = packed_positions(seq_lens, device=x.device)
+        if seq_lens is not None:
+            assert sum(seq_lens) == x.shape[0]
         x = self.embedding(x)
         for block in self.block:
-            x = block(x)
+            x = block(
+                x, seq_lens=seq_lens, positions=positions, cache=cache, slots=slots
+            )
         x = self.norm(x)
         x = self.unembedding(x)
         return x
 
+    def decode_step(
+        self,
+        token: torch.Tensor,
+        cache: PagedKVCache,
+        seq_id,
+        workspace: DecodeWorkspace,
+    ) -> torch.Tensor:
+        """Same as `forward(token, cache=cache, seq_ids=[seq_id])` for a
+        single `token`, but with fewer, smaller kernels; meant for decoding on
+        CPU, where dispatch and allocation dominate."""
+        slots = cache.reserve(seq_id, 1)
+        workspace.position.fill_(slots.start)
+        x = torch.index_select(self.embedding.weight, 0, token, out=workspace.x)
+        for block in self.block:
+            x = block.attn.decode_step(x, cache, slots, workspace)
+            x = block.mlp.decode_step(x, workspace)
+        x = self.norm.decode_step(x, workspace)
+        return self.unembedding(x)
+
     @staticmethod
     def from_checkpoint(
-        path: str, device: str | torch.device = "cuda"
+        path: str,
+        device: str | torch.device = "cuda",
+        mxfp4_experts: bool = False,
+        converted_cache_dir: str | None = None,
     ) -> "Transformer":
+        """Load a checkpoint. With `converted_cache_dir`, the parameters of this
+        rank are saved there after the first load, already dequantized and
+        sharded, and later loads memory-map them instead."""
         if not isinstance(device, torch.device):
             device = torch.device(device)
 
@@ -402,6 +814,7 @@ class Transformer(torch.nn.Module):
         model = Transformer(
             config=config,
             device=device,
+            mxfp4_experts=mxfp4_experts,
         )
         model.eval()
 
@@ -410,42 +823,243 @@ class Transformer(torch.nn.Module):
         world_size = dist.get_world_size() if dist.is_initialized() else 1
         per_rank_intermediate_size = config.intermediate_size // world_size
 
-        checkpoint = Checkpoint(path, device)
+        converted_path = None
+        if converted_cache_dir is not None:
+            layout = "mxfp4" if mxfp4_experts else "bf16"
+            converted_path = os.path.join(
+                converted_cache_dir,
+                f"{checkpoint_fingerprint(path)}-{layout}-rank{my_rank}-of-{world_size}.safetensors",
+            )
+            if os.path.exists(converted_path):
+                with safe_open(converted_path, framework="pt", device=str(device)) as f:
+                    for name, param in model.named_parameters():
+                        param.data.copy_(f.get_tensor(name))
+                return model
 
-        for name, param in model.named_parameters():
-            loaded_tensor = checkpoint.get(name)
+        checkpoint = Checkpoint(path, device)
 
-            # Note: it would be more efficient to do sharding before upcasting from MXFP4,
-            # but for simplicity we do it after.
+        def get_shard(name: str) -> Shard | None:
+            # Every rank reads and dequantizes only its own slice of the MoE
+            # weights and biases
             if "mlp1" in name:  # both weight and bias
-                loaded_tensor = loaded_tensor[
-                    :,
-                    my_rank * 2
-                    * per_rank_intermediate_size : (my_rank + 1) * 2
-                    * per_rank_intermediate_size,
-                    ...,
-                ]
+                return Shard(
+                    1,
+                    my_rank * 2 * per_rank_intermediate_size,
+                    (my_rank + 1) * 2 * per_rank_intermediate_size,
+                )
+            elif name.endswith(("mlp2_weight_blocks", "mlp2_weight_scales")):
+                # Packed weights are sharded in whole blocks of 32 values
+                assert per_rank_intermediate_size % 32 == 0, (
+                    "packed MXFP4 experts need a per-rank intermediate size"
+                    " that is a multiple of 32"
+                )
+                per_rank_blocks = per_rank_intermediate_size // 32
+                return Shard(
+                    2, my_rank * per_rank_blocks, (my_rank + 1) * per_rank_blocks
+                )
             elif "mlp2_weight" in name:  # only weight
-                loaded_tensor = loaded_tensor[
-                    ...,
-                    my_rank
-                    * per_rank_intermediate_size : (my_rank + 1)
-                    * per_rank_intermediate_size,
-                ]
+                return Shard(
+                    -1,
+                    my_rank * per_rank_intermediate_size,
+                    (my_rank + 1) * per_rank_intermediate_size,
+                )
+            return None
+
+        params = dict(model.named_parameters())
+        # Tensors are read on a thread pool while earlier ones are copied
+        for name, loaded_tensor in checkpoint.get_all(
+            (name, get_shard(name)) for name in params
+        ):
+            param = params[name]
             try:
                 param.data.copy_(loaded_tensor)
             except:
                 print(f"{name=} {param.data.shape=} {loaded_tensor.shape=}")
                 raise
 
+        if converted_path is not None:
+            save_converted(dict(model.named_parameters()), converted_path)
         return model
 
 
 class TokenGenerator:
     @torch.inference_mode()
-    def __init__(self, checkpoint: str, device: torch.device):
+    def __init__(
+        self,
+        checkpoint: str,
+        device: torch.device,
+        drafter: Drafter | None = None,
+        num_draft_tokens: int = 4,
+        max_context: int = 131_072,
+        mxfp4_experts: bool = False,
+        converted_cache_dir: str | None = None,
+        num_threads: int | None = None,
+        compile_decode: bool = False,
+    ):
         self.device = device
-        self.model = Transformer.from_checkpoint(checkpoint, device=self.device)
+        if num_threads is not None:
+            # Intra-op threads for CPU kernels
+            torch.set_num_threads(num_threads)
+        self.model = Transformer.from_checkpoint(
+            checkpoint,
+            device=self.device,
+            mxfp4_experts=mxfp4_experts,
+            converted_cache_dir=converted_cache_dir,
+        )
+        # Keys and values of the last generated sequence; the pool grows as
+        # needed, so `max_context` only bounds it
+        config = self.model.config
+        self.cache = PagedKVCache(
+            config.num_hidden_layers,
+            config.num_key_value_heads,
+            config.head_dim,
+            block_size=16,
+            num_blocks=64,
+            max_num_blocks=-(-max_context // 16),
+            device=self.device,
+        )
+        self.cache.allocate(0)
+        self.cached_tokens: list[int] = []
+        # Optional speculative decoding: the drafter proposes up to
+        # `num_draft_tokens` tokens that are verified in the same forward
+        self.drafter = drafter
+        self.num_draft_tokens = num_draft_tokens
+        # Single new tokens take the leaner decode path
+        self.workspace = DecodeWorkspace(config, self.device, mxfp4_experts)
+        self.decode_step = self.model.decode_step
+        if compile_decode:
+            self.decode_step = torch.compile(self.decode_step, dynamic=True)
+
+    def _truncate_cache(self, n_tokens: int) -> None:
+        if n_tokens < len(self.cached_tokens):
+            self.cache.truncate(0, n_tokens)
+            del self.cached_tokens[n_tokens:]
+
+    def _reuse_cache(self, tokens: list[int]) -> None:
+        """Keep the cache for the prefix shared with the previous call, but
+        always leave at least one token to feed."""
+        num_cached = 0
+        max_cached = min(len(self.cached_tokens), len(tokens) - 1)
+        while num_cached < max_cached and self.cached_tokens[num_cached] == tokens[num_cached]:
+            num_cached += 1
+        self._truncate_cache(num_cached)
+
+    def _prefill(self, prompt_tokens: list[int]) -> torch.Tensor:
+        """Cache `prompt_tokens` as sequence 0 and return the logits that
+        follow them."""
+        self._reuse_cache(prompt_tokens)
+        new_tokens = prompt_tokens[len(self.cached_tokens):]
+        logits = self.model(
+            torch.as_tensor(new_tokens, dtype=torch.int32, device=self.device),
+            cache=self.cache,
+            seq_ids=[0],
+        )
+        self.cached_tokens.extend(new_tokens)
+        return logits[-1]
+
+    def _decode_batch(self, tokens: list[int], seq_ids: list) -> torch.Tensor:
+        """Feed one token to each sequence in `seq_ids` in a single forward."""
+        return self.model(
+            torch.as_tensor(tokens, dtype=torch.int32, device=self.device),
+            seq_lens=[1] * len(tokens),
+            cache=self.cache,
+            seq_ids=seq_ids,
+        )
+
+    @torch.inference_mode()
+    def sample(self,
+               prompt_tokens: list[int],
+               stop_tokens: list[int],
+               n: int,
+               temperature: float = 1.0,
+               max_tokens: int = 0) -> list[list[int]]:
+        """Draw `n` completions of `prompt_tokens`.
+
+        The prompt is prefilled once; the samples share its cache blocks
+        copy-on-write and are decoded together as one batch. Every completion
+        ends with its stop token, unless it ran into `max_tokens`.
+        """
+        logits = self._prefill(list(prompt_tokens)).expand(n, -1)
+        seq_ids = [("sample", i) for i in range(n)]
+        for seq_id in seq_ids:
+            self.cache.fork(0, seq_id)
+        samples: list[list[int]] = [[] for _ in range(n)]
+        active = list(range(n))
+        try:
+            while True:
+                if temperature == 0.0:
+                    next_tokens = torch.argmax(logits, dim=-1)
+                else:
+                    probs = torch.softmax(logits.float() * (1.0 / temperature), dim=-1)
+                    next_tokens = torch.multinomial(probs, num_samples=1)[:, 0]
+                for i, token in zip(active, next_tokens.tolist()):
+                    samples[i].append(token)
+                active = [
+                    i
+                    for i in active
+                    if samples[i][-1] not in stop_tokens and len(samples[i]) != max_tokens
+                ]
+                if not active:
+                    return samples
+                logits = self._decode_batch(
+                    [samples[i][-1] for i in active], [seq_ids[i] for i in active]
+                )
+        finally:
+            for seq_id in seq_ids:
+                self.cache.free(seq_id)
+
+    @torch.inference_mode()
+    def beam_search(self,
+                    prompt_tokens: list[int],
+                    stop_tokens: list[int],
+                    num_beams: int,
+                    max_tokens: int = 0,
+                    length_penalty: float = 1.0) -> list[tuple[list[int], float]]:
+        """Return up to `num_beams` completions with their total log
+        probability, best first by `logprob / len ** length_penalty`.
+
+        The search ends once `num_beams` completions reached a stop token (or
+        `max_tokens`). Beams share the cache blocks of their common prefix,
+        including the prompt, which is prefilled once.
+        """
+        logprobs = torch.log_softmax(self._prefill(list(prompt_tokens)).float(), dim=-1)
+        # Live beams as (sequence id, tokens, log probability)
+        beams = [(("beam", 0), [], 0.0)]
+        self.cache.fork(0, beams[0][0])
+        num_seq_ids = 1
+        finished: list[tuple[list[int], float]] = []
+        try:
+            while True:
+                scores = torch.as_tensor([score for *_, score in beams], device=logprobs.device)
+                candidates = (scores[:, None] + logprobs).flatten()
+                top = torch.topk(candidates, k=min(2 * num_beams, candidates.numel()))
+                next_beams = []
+                for score, index in zip(top.values.tolist(), top.indices.tolist()):
+                    parent_id, tokens, _ = beams[index // logprobs.shape[-1]]
+                    tokens = tokens + [index % logprobs.shape[-1]]
+                    if tokens[-1] in stop_tokens or len(tokens) == max_tokens:
+                        finished.append((tokens, score))
+                    elif len(next_beams) < num_beams:
+                        seq_id = ("beam", num_seq_ids)
+                        num_seq_ids += 1
+                        self.cache.fork(parent_id, seq_id)
+                        next_beams.append((seq_id, tokens, score))
+                    if len(finished) >= num_beams or len(next_beams) == num_beams:
+                        break
+                for seq_id, *_ in beams:
+                    self.cache.free(seq_id)
+                beams = next_beams
+                if len(finished) >= num_beams or not beams:
+                    break
+                logits = self._decode_batch(
+                    [tokens[-1] for _, tokens, _ in beams], [seq_id for seq_id, *_ in beams]
+                )
+                logprobs = torch.log_softmax(logits.float(), dim=-1)
+        finally:
+            for seq_id, *_ in beams:
+                self.cache.free(seq_id)
+        finished.sort(key=lambda beam: beam[1] / len(beam[0]) ** length_penalty, reverse=True)
+        return finished[:num_beams]
 
     @torch.inference_mode()
     def generate(self,
@@ -455,23 +1069,40 @@ class TokenGenerator:
                  max_tokens: int = 0,
                  return_logprobs: bool = False):
         tokens = list(prompt_tokens)
+        self._reuse_cache(tokens)
+
         num_generated_tokens = 0
         while max_tokens == 0 or num_generated_tokens < max_tokens:
-            logits = self.model(torch.as_tensor(tokens, dtype=torch.int32, device=self.device))[-1]
-            if temperature == 0.0:
-                predicted_token = torch.argmax(logits, dim=-1).item()
+            draft_tokens, draft_probs = [], None
+            if self.drafter is not None:
+                num_draft_tokens = self.num_draft_tokens
+                if max_tokens:
+                    num_draft_tokens = min(num_draft_tokens, max_tokens - num_generated_tokens - 1)
+                if num_draft_tokens > 0:
+                    draft_tokens, draft_probs = self.drafter.propose(tokens, num_draft_tokens, temperature)
+            new_tokens = tokens[len(self.cached_tokens):] + draft_tokens
+            x = torch.as_tensor(new_tokens, dtype=torch.int32, device=self.device)
+            if len(new_tokens) == 1:
+                logits = self.decode_step(x, self.cache, 0, self.workspace)
             else:
-                probs = torch.softmax(logits * (1.0 / temperature), dim=-1)
-                predicted_token = torch.multinomial(probs, num_samples=1).item()
-            tokens.append(predicted_token)
-            num_generated_tokens += 1
-
+                logits = self.model(x, cache=self.cache, seq_ids=[0])
+            self.cached_tokens.extend(new_tokens)
+            logits = logits[-len(draft_tokens) - 1:]
+            predicted_tokens = verify_draft(logits, draft_tokens, draft_probs, temperature)
+            # Drop the keys and values of rejected draft tokens
+            self._truncate_cache(len(tokens) + len(predicted_tokens) - 1)
             if return_logprobs:
-                logprobs = torch.log_softmax(logits, dim=-1)
-                selected_logprobs = logprobs[predicted_token].item()
-                yield predicted_token, selected_logprobs
-            else:
-                yield predicted_token
+                logprobs = torch.log_softmax(logits[:len(predicted_tokens)], dim=-1)
+                selected_logprobs = logprobs[torch.arange(len(predicted_tokens)), predicted_tokens].tolist()
+
+            for i, predicted_token in enumerate(predicted_tokens):
+                tokens.append(predicted_token)
+                num_generated_tokens += 1
+
+                if return_logprobs:
+                    yield predicted_token, selected_logprobs[i]
+                else:
+                    yield predicted_token
 
-            if predicted_token in stop_tokens:
-                break
+                if predicted_token in stop_tokens:
+                    return
@@ -0,0 +1,188 @@
+from dataclasses import dataclass
+from typing import Hashable
+
+import torch
+
+
+@dataclass
+class SequenceSlots:
+    """Where one sequence's keys and values live for a single forward.
+
+    Slots index the flattened `(num_blocks * block_size)` token dimension of
+    the cache, so they can be used directly with `index_copy_`/`index_select`.
+    """
+
+    start: int  # position of the first new token
+    write_slots: torch.Tensor  # slots of the new tokens
+    read_slots: torch.Tensor  # slots of every token, new ones included
+
+
+class PagedKVCache:
+    """Key/value cache made of fixed-size blocks shared by all sequences.
+
+    Each sequence owns a block table listing the blocks that hold its tokens.
+    Blocks are reference counted: `fork` lets a new sequence share all of
+    another's blocks, and the last, partially filled block is copied on the
+    first write after a fork. The pool starts small and doubles up to
+    `max_num_blocks`, so memory follows the number of tokens actually held.
+    """
+
+    def __init__(
+        self,
+        num_layers: int,
+        n_kv_heads: int,
+        d_head: int = 64,
+        block_size: int = 16,
+        num_blocks: int = 64,
+        max_num_blocks: int | None = None,
+        dtype: torch.dtype = torch.bfloat16,
+        device: torch.device | None = None,
+    ):
+        self.block_size = block_size
+        self.max_num_blocks = max_num_blocks or num_blocks
+        assert num_blocks <= self.max_num_blocks
+        shape = (num_layers, num_blocks, block_size, n_kv_heads, d_head)
+        self.k = torch.zeros(shape, dtype=dtype, device=device)
+        self.v = torch.zeros(shape, dtype=dtype, device=device)
+        self.ref_counts = [0] * num_blocks
+        self.free_blocks = list(reversed(range(num_blocks)))
+        self.block_tables: dict[Hashable, list[int]] = {}
+        self.seq_lens: dict[Hashable, int] = {}
+
+    @property
+    def num_blocks(self) -> int:
+        return self.k.shape[1]
+
+    @property
+    def num_available_blocks(self) -> int:
+        """Blocks that can still be handed out, counting future growth."""
+        return len(self.free_blocks) + self.max_num_blocks - self.num_blocks
+
+    def __contains__(self, seq_id: Hashable) -> bool:
+        return seq_id in self.block_tables
+
+    def seq_len(self, seq_id: Hashable) -> int:
+        return self.seq_lens[seq_id]
+
+    def blocks_needed(self, seq_id: Hashable, n_tokens: int) -> int:
+        """Number of free blocks `reserve(seq_id, n_tokens)` would consume."""
+        seq_len = self.seq_lens.get(seq_id, 0)
+        table = self.block_tables.get(seq_id, [])
+        needed = -(-(seq_len + n_tokens) // self.block_size) - len(table)
+        if n_tokens > 0 and seq_len % self.block_size and self._is_shared(table[-1]):
+            needed += 1  # copy-on-write of the partially filled last block
+        return needed
+
+    def allocate(self, seq_id: Hashable, prefix_blocks: list[int] = ()) -> None:
+        """Start a sequence, optionally on top of full blocks held elsewhere."""
+        assert seq_id not in self.block_tables, f"Sequence {seq_id} already exists."
+        for block in prefix_blocks:
+            self.retain(block)
+        self.block_tables[seq_id] = list(prefix_blocks)
+        self.seq_lens[seq_id] = len(prefix_blocks) * self.block_size
+
+    def fork(self, src_seq_id: Hashable, dst_seq_id: Hashable) -> None:
+        """Make `dst_seq_id` a copy of `src_seq_id` that shares all its blocks."""
+        assert dst_seq_id not in self.block_tables, f"Sequence {dst_seq_id} already exists."
+        table = list(self.block_tables[src_seq_id])
+        for block in table:
+            self.retain(block)
+        self.block_tables[dst_seq_id] = table
+        self.seq_lens[dst_seq_id] = self.seq_lens[src_seq_id]
+
+    def free(self, seq_id: Hashable) -> None:
+        for block in self.block_tables.pop(seq_id):
+            self.release(block)
+        del self.seq_lens[seq_id]
+
+    def truncate(self, seq_id: Hashable, n_tokens: int) -> None:
+        """Keep only the first `n_tokens` tokens of the sequence."""
+        assert n_tokens <= self.seq_lens[seq_id]
+        table = self.block_tables[seq_id]
+        num_blocks = -(-n_tokens // self.block_size)
+        for block in table[num_blocks:]:
+            self.release(block)
+        del table[num_blocks:]
+        self.seq_lens[seq_id] = n_tokens
+
+    @torch.compiler.disable
+    def reserve(self, seq_id: Hashable, n_tokens: int) -> SequenceSlots:
+        """Append room for `n_tokens` new tokens and return their slots."""
+        if seq_id not in self.block_tables:
+            self.allocate(seq_id)
+        table = self.block_tables[seq_id]
+        start = self.seq_lens[seq_id]
+
+        if n_tokens > 0 and start % self.block_size and self._is_shared(table[-1]):
+            table[-1] = self._copy_block(table[-1])
+        while len(table) * self.block_size < start + n_tokens:
+            table.append(self._allocate_block())
+        self.seq_lens[seq_id] = start + n_tokens
+
+        blocks = torch.as_tensor(table, dtype=torch.long, device=self.k.device)
+        read_slots = (
+            blocks[:, None] * self.block_size
+            + torch.arange(self.block_size, device=self.k.device)[None, :]
+        ).view(-1)[: start + n_tokens]
+        return SequenceSlots(
+            start=start,
+            write_slots=read_slots[start:],
+            read_slots=read_slots,
+        )
+
+    @torch.compiler.disable
+    def write(
+        self, layer_idx: int, slots: torch.Tensor, k: torch.Tensor, v: torch.Tensor
+    ) -> None:
+        *_, n_kv_heads, d_head = self.k.shape
+        self.k[layer_idx].view(-1, n_kv_heads, d_head).index_copy_(0, slots, k)
+        self.v[layer_idx].view(-1, n_kv_heads, d_head).index_copy_(0, slots, v)
+
+    @torch.compiler.disable
+    def read(
+        self, layer_idx: int, slots: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        *_, n_kv_heads, d_head = self.k.shape
+        k = self.k[layer_idx].view(-1, n_kv_heads, d_head).index_select(0, slots)
+        v = self.v[layer_idx].view(-1, n_kv_heads, d_head).index_select(0, slots)
+        return k, v
+
+    def retain(self, block: int) -> None:
+        """Take an extra reference on a block that is already in use."""
+        assert self.ref_counts[block] > 0
+        self.ref_counts[block] += 1
+
+    def release(self, block: int) -> None:
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def _is_shared(self, block: int) -> bool:
+        return self.ref_counts[block] > 1
+
+    def _allocate_block(self) -> int:
+        if not self.free_blocks:
+            self._grow()
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def _copy_block(self, block: int) -> int:
+        new_block = self._allocate_block()
+        self.k[:, new_block] = self.k[:, block]
+        self.v[:, new_block] = self.v[:, block]
+        self.release(block)
+        return new_block
+
+    def _grow(self) -> None:
+        num_blocks = self.num_blocks
+        new_num_blocks = min(2 * num_blocks, self.max_num_blocks)
+        if new_num_blocks == num_blocks:
+            raise RuntimeError(
+                f"KV cache is full ({num_blocks} blocks of {self.block_size} tokens)."
+            )
+        padding = (0, 0, 0, 0, 0, 0, 0, new_num_blocks - num_blocks)
+        self.k = torch.nn.functional.pad(self.k, padding)
+        self.v = torch.nn.functional.pad(self.v, padding)
+        self.ref_counts.extend([0] * (new_num_blocks - num_blocks))
+        self.free_blocks.extend(reversed(range(num_blocks, new_num_blocks)))
@@ -0,0 +1,105 @@
+import heapq
+import itertools
+from typing import Optional
+
+from gpt_oss.torch.paged_cache import PagedKVCache
+
+
+class PrefixNode:
+    __slots__ = ("key", "block", "parent", "children", "last_access")
+
+    def __init__(self, key: tuple[int, ...], block: int, parent: Optional["PrefixNode"]):
+        self.key = key
+        self.block = block
+        self.parent = parent
+        self.children: dict[tuple[int, ...], "PrefixNode"] = {}
+        self.last_access = 0
+
+
+class PrefixCache:
+    """Radix tree over token sequences whose nodes own KV cache blocks.
+
+    Every edge is one full block of tokens, and the node it leads to holds a
+    reference on the block with the keys and values for those tokens given
+    the whole path above it. Any request starting with a cached path (e.g.
+    the same system and tool preamble) can borrow its blocks instead of
+    prefilling them. Blocks used only by the tree are evicted least recently
+    used first, leaves before their parents.
+    """
+
+    def __init__(self, cache: PagedKVCache):
+        self.cache = cache
+        self.block_size = cache.block_size
+        self.root = PrefixNode((), -1, None)
+        self._clock = itertools.count(1)
+
+    def _keys(self, tokens: list[int]):
+        for i in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            yield tuple(tokens[i : i + self.block_size])
+
+    def contains(self, node: PrefixNode) -> bool:
+        """Whether `node` is still part of the tree, i.e. was not evicted."""
+        return node is self.root or node.parent is not None
+
+    def match(self, tokens: list[int]) -> list[int]:
+        """Blocks holding the longest cached prefix of `tokens`."""
+        now = next(self._clock)
+        node, blocks = self.root, []
+        for key in self._keys(tokens):
+            node = node.children.get(key)
+            if node is None:
+                break
+            node.last_access = now
+            blocks.append(node.block)
+        return blocks
+
+    def insert(
+        self,
+        tokens: list[int],
+        blocks: list[int],
+        node: Optional[PrefixNode] = None,
+    ) -> PrefixNode:
+        """Add the full blocks of `tokens` below `node` (the root by default).
+
+        `blocks` hold the keys and values of `tokens`; blocks for paths that
+        are already cached are left alone. Returns the node reached, which
+        can be passed back in to continue the same sequence later.
+        """
+        now = next(self._clock)
+        node = node or self.root
+        for key, block in zip(self._keys(tokens), blocks):
+            child = node.children.get(key)
+            if child is None:
+                self.cache.retain(block)
+                child = node.children[key] = PrefixNode(key, block, node)
+            child.last_access = now
+            node = child
+        return node
+
+    def _is_evictable(self, node: PrefixNode) -> bool:
+        return (
+            node is not self.root
+            and not node.children
+            and self.cache.ref_counts[node.block] == 1
+        )
+
+    def evict(self, num_blocks: int) -> None:
+        """Drop cached paths until the cache has `num_blocks` available."""
+        if self.cache.num_available_blocks >= num_blocks:
+            return
+        heap, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if self._is_evictable(node):
+                heap.append((node.last_access, id(node), node))
+        heapq.heapify(heap)
+
+        while heap and self.cache.num_available_blocks < num_blocks:
+            _, _, node = heapq.heappop(heap)
+            parent = node.parent
+            del parent.children[node.key]
+            node.parent = None
+            self.cache.release(node.block)
+            if self._is_evictable(parent):
+                heapq.heappush(heap, (parent.last_access, id(parent), parent))
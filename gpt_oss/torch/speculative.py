@@ -0,0 +1,160 @@
+"""Speculative decoding helpers shared by the torch and triton generators.
+
+A drafter guesses the next few tokens cheaply, the main model scores all of
+them in a single forward, and :func:`verify_draft` keeps the longest prefix
+the main model agrees with. Acceptance follows speculative sampling, so the
+generated tokens are distributed exactly as without a drafter.
+"""
+
+from typing import Protocol
+
+import torch
+
+from gpt_oss.torch.paged_cache import PagedKVCache
+
+DraftProposal = tuple[list[int], torch.Tensor | None]
+
+
+class Drafter(Protocol):
+    def propose(
+        self, tokens: list[int], num_tokens: int, temperature: float
+    ) -> DraftProposal:
+        """Guess up to `num_tokens` tokens following `tokens`.
+
+        Returns the guessed tokens and, for drafters that sample, the
+        `(len(draft), vocab_size)` probabilities they were drawn from. `None`
+        means every token was proposed with certainty.
+        """
+        ...
+
+
+class PromptLookupDrafter:
+    """Drafts by copying what followed the latest earlier occurrence of the
+    last few tokens. Needs no second model and does well whenever the output
+    echoes its context, e.g. code edits or tool call arguments."""
+
+    def __init__(self, max_ngram: int = 3, min_ngram: int = 1):
+        assert 1 <= min_ngram <= max_ngram
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.tokens: list[int] = []
+        # n-gram -> position right after its latest occurrence
+        self.index: dict[tuple[int, ...], int] = {}
+
+    def _update(self, tokens: list[int]) -> None:
+        if tokens[: len(self.tokens)] != self.tokens:
+            self.tokens, self.index = [], {}
+        # Only index n-grams that are followed by at least one token
+        for end in range(max(len(self.tokens), 1), len(tokens)):
+            for n in range(self.min_ngram, min(self.max_ngram, end) + 1):
+                self.index[tuple(tokens[end - n : end])] = end
+        self.tokens.extend(tokens[len(self.tokens) :])
+
+    def propose(
+        self, tokens: list[int], num_tokens: int, temperature: float = 0.0
+    ) -> DraftProposal:
+        self._update(tokens)
+        for n in range(min(self.max_ngram, len(tokens)), self.min_ngram - 1, -1):
+            start = self.index.get(tuple(tokens[-n:]))
+            if start is not None:
+                return tokens[start : start + num_tokens], None
+        return [], None
+
+
+class DraftModelDrafter:
+    """Drafts with a smaller gpt-oss checkpoint sharing the main model's
+    tokenizer. Its keys and values are cached between calls."""
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        device: torch.device | None = None,
+        max_context: int = 131_072,
+    ):
+        self.model = model
+        self.device = device
+        config = model.config
+        self.cache = PagedKVCache(
+            config.num_hidden_layers,
+            config.num_key_value_heads,
+            config.head_dim,
+            block_size=16,
+            num_blocks=64,
+            max_num_blocks=max_context // 16,
+            device=device,
+        )
+        self.tokens: list[int] = []
+
+    @torch.inference_mode()
+    def propose(
+        self, tokens: list[int], num_tokens: int, temperature: float
+    ) -> DraftProposal:
+        num_cached = 0
+        max_len = min(len(self.tokens), len(tokens) - 1)
+        while num_cached < max_len and self.tokens[num_cached] == tokens[num_cached]:
+            num_cached += 1
+        if 0 in self.cache:
+            self.cache.truncate(0, num_cached)
+        self.tokens = tokens[:num_cached]
+
+        draft_tokens, draft_probs = [], []
+        new_tokens = tokens[num_cached:]
+        for _ in range(num_tokens):
+            x = torch.as_tensor(new_tokens, dtype=torch.int32, device=self.device)
+            logits = self.model(x, cache=self.cache, seq_ids=[0])[-1].float()
+            self.tokens.extend(new_tokens)
+            if temperature == 0.0:
+                token = torch.argmax(logits, dim=-1).item()
+            else:
+                probs = torch.softmax(logits * (1.0 / temperature), dim=-1)
+                token = torch.multinomial(probs, num_samples=1).item()
+                draft_probs.append(probs)
+            draft_tokens.append(token)
+            new_tokens = [token]
+        return draft_tokens, torch.stack(draft_probs) if draft_probs else None
+
+
+def verify_draft(
+    logits: torch.Tensor,
+    draft_tokens: list[int],
+    draft_probs: torch.Tensor | None,
+    temperature: float,
+) -> list[int]:
+    """Accept a prefix of `draft_tokens` and append one token from the model.
+
+    `logits` are the main model's `(len(draft_tokens) + 1, vocab_size)` logits
+    for the positions predicting each draft token and the one after them. The
+    returned tokens always include at least one token sampled from the model.
+    """
+    num_draft = len(draft_tokens)
+    if temperature == 0.0:
+        targets = torch.argmax(logits, dim=-1).tolist()
+        num_accepted = 0
+        while num_accepted < num_draft and draft_tokens[num_accepted] == targets[num_accepted]:
+            num_accepted += 1
+        return draft_tokens[:num_accepted] + [targets[num_accepted]]
+
+    probs = torch.softmax(logits.float() * (1.0 / temperature), dim=-1)
+    if num_draft == 0:
+        return [torch.multinomial(probs[-1], num_samples=1).item()]
+
+    # Accept draft token x with probability min(1, p(x) / q(x)), otherwise
+    # resample from the residual max(0, p - q)
+    rows = torch.arange(num_draft, device=probs.device)
+    x = torch.as_tensor(draft_tokens, device=probs.device)
+    if draft_probs is None:
+        q = torch.nn.functional.one_hot(x, probs.shape[-1]).to(probs.dtype)
+    else:
+        q = draft_probs.to(probs.dtype)
+    ratio = probs[rows, x] / q[rows, x]
+    accepted = torch.rand(num_draft, device=probs.device) < ratio
+    residual = (probs[:-1] - q).clamp_(min=0)
+    # A zero residual means the draft could not have been rejected
+    residual = torch.where(residual.sum(-1, keepdim=True) > 0, residual, probs[:-1])
+    samples = torch.multinomial(torch.cat([residual, probs[-1:]]), num_samples=1)[:, 0]
+
+    accepted, samples = accepted.tolist(), samples.tolist()
+    num_accepted = 0
+    while num_accepted < num_draft and accepted[num_accepted]:
+        num_accepted += 1
+    return draft_tokens[:num_accepted] + [samples[num_accepted]]
@@ -1,8 +1,15 @@
+import functools
+import hashlib
 import math
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Iterator
 
 import torch
 from safetensors import safe_open
+from safetensors.torch import save_file
 
 
 # Bytes per MXFP4 block: 32 FP4 numbers packed in 16 bytes
@@ -22,17 +29,118 @@ PARAM_NAME_MAP = {
     f"block.{n}.mlp.mlp2_bias": f"block.{n}.mlp.mlp2_bias" for n in range(36)
 } | {
     f"block.{n}.mlp.mlp2_weight": (f"block.{n}.mlp.mlp2_weight.blocks", f"block.{n}.mlp.mlp2_weight.scales") for n in range(36)
+} | {
+    # MoE weights kept packed in MXFP4
+    f"block.{n}.mlp.{mlp}_weight_{part}": f"block.{n}.mlp.{mlp}_weight.{part}"
+    for n in range(36) for mlp in ("mlp1", "mlp2") for part in ("blocks", "scales")
 }
 
 
+@functools.cache
+def _mxfp4_luts(dtype: torch.dtype, device: torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+    fp4_values = torch.tensor(FP4_VALUES, dtype=dtype, device=device)
+    byte = torch.arange(256, device=device)
+    # Both values of a packed byte, low nibble first
+    pair_lut = torch.stack((fp4_values[byte & 0x0F], fp4_values[byte >> 4]), dim=-1)
+    # 2 ** (scale - 127) for every biased exponent
+    scale_lut = torch.exp2(byte.to(torch.float32) - 127).to(dtype)
+    return pair_lut, scale_lut
+
+
+def dequantize_mxfp4(
+    blocks: torch.Tensor,
+    scales: torch.Tensor,
+    dtype: torch.dtype = torch.bfloat16,
+    out: torch.Tensor | None = None,
+) -> torch.Tensor:
+    """Unpack MXFP4 `blocks` of shape (..., 16) with their biased exponents
+    `scales` of shape (...) into values of shape (..., 32)."""
+    pair_lut, scale_lut = _mxfp4_luts(dtype, blocks.device)
+    if out is None:
+        out = torch.empty(
+            *blocks.shape[:-1], blocks.shape[-1] * 2, dtype=dtype, device=blocks.device
+        )
+    # One lookup per byte yields both of its values, and scaling by a power
+    # of two is exact, so no wide intermediates are needed
+    torch.index_select(
+        pair_lut, 0, blocks.reshape(-1).to(torch.int32), out=out.view(-1, 2)
+    )
+    out.mul_(scale_lut[scales.to(torch.int32)].unsqueeze(-1))
+    return out
+
+
+def checkpoint_fingerprint(path: str) -> str:
+    """Hash of a checkpoint's config and safetensors headers, which hold the
+    name, dtype, shape and offsets of every tensor."""
+    digest = hashlib.sha256()
+    for fname in sorted(os.listdir(path)):
+        if fname != "config.json" and not fname.endswith(".safetensors"):
+            continue
+        digest.update(fname.encode())
+        with open(os.path.join(path, fname), "rb") as f:
+            if fname.endswith(".safetensors"):
+                header_size = f.read(8)
+                digest.update(header_size + f.read(int.from_bytes(header_size, "little")))
+            else:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def save_converted(tensors: dict[str, torch.Tensor], path: str) -> None:
+    """Write converted parameters to `path`, which appears only once complete."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_file(
+        {name: tensor.detach().contiguous().cpu() for name, tensor in tensors.items()},
+        tmp_path,
+    )
+    os.replace(tmp_path, path)
+
+
+@dataclass(frozen=True)
+class Shard:
+    """The range [start, stop) of dimension `dim` of a tensor. For MXFP4 weights
+    the range is in dequantized values and need not cover whole blocks."""
+
+    dim: int
+    start: int
+    stop: int
+
+    def index(self, shape: list[int]) -> tuple[slice, ...]:
+        index = [slice(None)] * len(shape)
+        index[self.dim] = slice(self.start, self.stop)
+        return tuple(index)
+
+
+@dataclass(frozen=True)
+class _MXFP4Blocks:
+    """Packed blocks and exponents read for an MXFP4 weight, not dequantized."""
+
+    blocks: torch.Tensor
+    scales: torch.Tensor
+    # Values to trim off the dequantized blocks on the last dimension
+    trim: slice | None = None
+
+
 class Checkpoint:
-    def __init__(self, path: str, device: torch.device):
+    def __init__(
+        self, path: str, device: torch.device, read_device: torch.device | None = None
+    ):
+        """Tensors are loaded to `device`. With `read_device`, they are read
+        there and moved to `device` after dequantization."""
         device_str = (
             device.type
             if device.index is None
             else device.type + ":" + str(device.index)
         )
         self.device_str = device_str
+        self.device = device
+        self.read_device = read_device if read_device is not None else device
+        read_device_str = (
+            self.read_device.type
+            if self.read_device.index is None
+            else self.read_device.type + ":" + str(self.read_device.index)
+        )
 
         # Read from all files ending with .safetensors in the checkpoint directory
         safetensor_files = [
@@ -40,30 +148,101 @@ class Checkpoint:
             for fname in os.listdir(path)
             if fname.endswith(".safetensors")
         ]
+        # Every file is opened (and memory-mapped) once and kept open
+        self.files = {
+            safetensor_file: safe_open(safetensor_file, framework="pt", device=read_device_str)
+            for safetensor_file in safetensor_files
+        }
         # Build a mapping from tensor name to (file, key)
         tensor_name_to_file = {}
-        for safetensor_file in safetensor_files:
-            with safe_open(safetensor_file, framework="pt", device=device_str) as f:
-                for key in f.keys():
-                    tensor_name_to_file[key] = safetensor_file
+        for safetensor_file, f in self.files.items():
+            for key in f.keys():
+                tensor_name_to_file[key] = safetensor_file
 
         self.tensor_name_to_file = tensor_name_to_file
 
-    def get(self, name: str) -> torch.Tensor:
+    def get(self, name: str, shard: Shard | None = None) -> torch.Tensor:
+        """Load the tensor for parameter `name`, or only its `shard`, which is
+        read from disk without loading or dequantizing the rest."""
+        return self._load(self._read(name, shard))
+
+    def get_all(
+        self,
+        names: Iterable[tuple[str, Shard | None]],
+        num_workers: int = 4,
+        prefetch: int = 2,
+    ) -> Iterator[tuple[str, torch.Tensor]]:
+        """Like :meth:`get` for every `(name, shard)`, in order. Up to `prefetch`
+        tensors per worker are read on a thread pool while the caller handles
+        the previous ones. When tensors are read on another device than the
+        one they are loaded to, MXFP4 weights are prefetched packed and are
+        moved and dequantized as they are yielded, so only one dequantized
+        tensor at a time is added to `device`."""
+        def read(name: str, shard: Shard | None):
+            raw = self._read(name, shard)
+            return self._load(raw) if self.read_device == self.device else raw
+
+        with ThreadPoolExecutor(num_workers) as executor:
+            pending = deque()
+            for name, shard in names:
+                pending.append((name, executor.submit(read, name, shard)))
+                if len(pending) > num_workers * prefetch:
+                    name, future = pending.popleft()
+                    yield name, self._load(future.result())
+            while pending:
+                name, future = pending.popleft()
+                yield name, self._load(future.result())
+
+    def _read(self, name: str, shard: Shard | None = None) -> "torch.Tensor | _MXFP4Blocks":
         match PARAM_NAME_MAP.get(name, name):
             case (blocks_name, scales_name):
                 # MoE weights: are in block-based MXFP4 format
-                return self._get_mxfp4_tensor(blocks_name, scales_name, dtype=torch.bfloat16)
+                return self._read_mxfp4(blocks_name, scales_name, shard)
             case tensor_name:
                 # MoE biases and other weights
-                return self._get_tensor(tensor_name)
+                return self._get_tensor(tensor_name, shard)
+
+    def _load(
+        self,
+        raw: "torch.Tensor | _MXFP4Blocks",
+        *,
+        dtype: torch.dtype = torch.bfloat16,
+        rows_per_chunk: int = 16384 * 512,
+    ) -> torch.Tensor:
+        """Move what :meth:`_read` returned to `self.device`, dequantizing
+        MXFP4 weights there."""
+        if isinstance(raw, torch.Tensor):
+            return raw.to(self.device)
+        blocks = raw.blocks.to(self.device)
+        scales = raw.scales.to(self.device)
+
+        *prefix_shape, G, B = blocks.shape
+        rows_total   = math.prod(prefix_shape) * G
+
+        blocks = blocks.reshape(rows_total, B)
+        scales = scales.reshape(rows_total)
 
-    def _get_tensor(self, name: str) -> str:
+        out = torch.empty(rows_total, B * 2, dtype=dtype, device=blocks.device)
+
+        for r0 in range(0, rows_total, rows_per_chunk):
+            r1 = min(r0 + rows_per_chunk, rows_total)
+            dequantize_mxfp4(blocks[r0:r1], scales[r0:r1], dtype=dtype, out=out[r0:r1])
+
+        out = out.reshape(*prefix_shape, G, B * 2).view(*prefix_shape, G * B * 2)
+        if raw.trim is not None:
+            out = out[..., raw.trim].contiguous()
+        return out
+
+    def _get_tensor(self, name: str, shard: Shard | None = None) -> torch.Tensor:
         assert name in self.tensor_name_to_file, f"Tensor {name} not found in checkpoint."
-        with safe_open(
-            self.tensor_name_to_file[name], framework="pt", device=self.device_str
-        ) as f:
+        f = self.files[self.tensor_name_to_file[name]]
+        if shard is None:
             return f.get_tensor(name)
+        tensor_slice = f.get_slice(name)
+        return tensor_slice[shard.index(tensor_slice.get_shape())]
+
+    def _get_shape(self, name: str) -> list[int]:
+        return self.files[self.tensor_name_to_file[name]].get_slice(name).get_shape()
 
     def _get_mxfp4_tensor(
         self,
@@ -72,7 +251,17 @@ class Checkpoint:
         *,
         dtype: torch.dtype = torch.bfloat16,
         rows_per_chunk: int = 16384 * 512,
+        shard: Shard | None = None,
     ) -> torch.Tensor:
+        return self._load(
+            self._read_mxfp4(blocks_name, scales_name, shard),
+            dtype=dtype,
+            rows_per_chunk=rows_per_chunk,
+        )
+
+    def _read_mxfp4(
+        self, blocks_name: str, scales_name: str, shard: Shard | None = None
+    ) -> _MXFP4Blocks:
         assert blocks_name in self.tensor_name_to_file, (
             f"Blocks tensor {blocks_name} not found in checkpoint."
         )
@@ -80,41 +269,29 @@ class Checkpoint:
             f"Scales tensor {scales_name} not found in checkpoint."
         )
 
-        blocks = self._get_tensor(blocks_name)
-        scales = self._get_tensor(scales_name).to(torch.int32) - 127
+        # The dequantized tensor has the shape of the scales, with every
+        # exponent expanded into a block of 32 values
+        blocks_shard = scales_shard = shard
+        trim = None
+        if shard is not None:
+            ndim = len(self._get_shape(scales_name))
+            if shard.dim % ndim == ndim - 1:
+                # Read the blocks covering the range, e.g. 720:1440 of a
+                # 2880-wide weight split over 4 ranks, and slice it exactly
+                first_block, end_block = shard.start // 32, -(-shard.stop // 32)
+                blocks_shard = Shard(ndim - 1, first_block, end_block)
+                scales_shard = blocks_shard
+                if shard.start % 32 or shard.stop % 32:
+                    trim = slice(shard.start - first_block * 32, shard.stop - first_block * 32)
+            else:
+                blocks_shard = scales_shard = Shard(shard.dim % ndim, shard.start, shard.stop)
+        blocks = self._get_tensor(blocks_name, blocks_shard)
+        scales = self._get_tensor(scales_name, scales_shard)
 
         assert blocks.shape[:-1] == scales.shape, (
             f"{blocks.shape=} does not match {scales.shape=}"
         )
-
-        lut = torch.tensor(FP4_VALUES, dtype=dtype, device=blocks.device)
-
-        *prefix_shape, G, B = blocks.shape
-        rows_total   = math.prod(prefix_shape) * G
-
-        blocks = blocks.reshape(rows_total, B)
-        scales = scales.reshape(rows_total, 1)
-
-        out = torch.empty(rows_total, B * 2, dtype=dtype, device=blocks.device)
-
-        for r0 in range(0, rows_total, rows_per_chunk):
-            r1 = min(r0 + rows_per_chunk, rows_total)
-
-            blk = blocks[r0:r1]
-            exp = scales[r0:r1]
-
-            # nibble indices -> int64
-            idx_lo = (blk & 0x0F).to(torch.long)
-            idx_hi = (blk >> 4).to(torch.long)
-
-            sub = out[r0:r1]
-            sub[:, 0::2] = lut[idx_lo]
-            sub[:, 1::2] = lut[idx_hi]
-
-            torch.ldexp(sub, exp, out=sub)
-            del idx_lo, idx_hi, blk, exp
-
-        return out.reshape(*prefix_shape, G, B * 2).view(*prefix_shape, G * B * 2)
+        return _MXFP4Blocks(blocks, scales, trim)
 
     def _get_mxfp4_tensor_copy(self, blocks_name: str, scales_name: str, dtype: torch.dtype = torch.bfloat16):
         "short version that uses a lot of memory"
@@ -131,7 +308,7 @@ class Checkpoint:
         loaded_scales = loaded_scales.int() - 127
 
         # Convert MXFP4 numbers into target dtype
-        fp4_values = torch.tensor(FP4_VALUES, dtype=dtype, device=self.device_str)
+        fp4_values = torch.tensor(FP4_VALUES, dtype=dtype, device=loaded_blocks.device)
         loaded_tensor = torch.ldexp(fp4_values[loaded_blocks.int()], loaded_scales.unsqueeze(-1))
         loaded_tensor = loaded_tensor.view(*loaded_tensor.shape[:-2], -1)
         return loaded_tensor
@@ -1,3 +1,4 @@
+import copy
 import json
 import math
 import os
@@ -6,6 +7,7 @@ import torch
 from torch.profiler import record_function
 
 from gpt_oss.torch.model import ModelConfig, RMSNorm
+from gpt_oss.torch.speculative import Drafter, verify_draft
 from gpt_oss.torch.weights import Checkpoint
 from gpt_oss.triton.attention import attention, attention_ref
 from gpt_oss.triton.moe import quantize_mx4, moe
@@ -134,13 +136,33 @@ class Cache:
         self.k = self.k.repeat_interleave(n, dim=0)
         self.v = self.v.repeat_interleave(n, dim=0)
 
-    def truncate(self, n_ctx):
-        """Truncate the cache to the first n_ctx tokens."""
+    def slots(self) -> list["Cache"]:
+        """Split the batch into independent single-sequence caches.
+
+        Every slot is a view into this cache's storage with its own offset, so
+        the sequences held in different slots can be extended and truncated
+        independently of each other.
+        """
+        slots = []
+        for i in range(self.k.shape[0]):
+            slot = copy.copy(self)
+            slot.k = self.k[i : i + 1]
+            slot.v = self.v[i : i + 1]
+            slot.offset = torch.zeros_like(self.offset)
+            slots.append(slot)
+        return slots
+
+    def truncate(self, n_ctx, end=None):
+        """Truncate the cache to the first n_ctx tokens.
+
+        Only positions up to `end`, the old length if known, are cleared, so
+        dropping a few tokens does not touch the rest of the context.
+        """
         batch_size, _, n_kv_heads, d_head = self.k.shape
         assert batch_size == self.v.shape[0]
         assert n_ctx <= self.k.shape[1]
-        self.k[:, n_ctx:, :, :].zero_()
-        self.v[:, n_ctx:, :, :].zero_()
+        self.k[:, n_ctx:end, :, :].zero_()
+        self.v[:, n_ctx:end, :, :].zero_()
         self.offset.fill_(n_ctx)
         return self.k, self.v
 
@@ -418,6 +440,15 @@ class Transformer(torch.nn.Module):
             x = self.unembedding(x)
         return x.float()
 
+    @torch.inference_mode()
+    def prefill(self, x: torch.Tensor, caches: list[Cache]) -> None:
+        """Fill `caches` with the keys and values of `x` without computing logits."""
+        with record_function("embedding"):
+            x = self.embedding(x)
+        for block, cache in zip(self.block, caches):
+            with record_function("block"):
+                x = block(x, cache=cache)
+
     @staticmethod
     def from_checkpoint(
         path: str, config: ModelConfig | None = None, device: str | torch.device = "cuda",
@@ -434,11 +465,14 @@ class Transformer(torch.nn.Module):
         model = Transformer(config=config, device=device)
         model.eval()
 
-        checkpoint = Checkpoint(path, device)
+        # The next tensors are read on the CPU while one is quantized; MoE
+        # weights are dequantized to bf16 on the GPU only as they are consumed
+        checkpoint = Checkpoint(path, device, read_device=torch.device("cpu"))
 
-        for name, param in model.named_parameters():
+        params = dict(model.named_parameters())
+        for name, loaded_tensor in checkpoint.get_all((name, None) for name in params):
             torch.cuda.empty_cache()
-            loaded_tensor = checkpoint.get(name)
+            param = params[name]
 
             if "mlp1" in name:
                 if "weight" in name:
@@ -469,11 +503,22 @@ class Transformer(torch.nn.Module):
 
 class TokenGenerator:
     @torch.inference_mode()
-    def __init__(self, checkpoint: str, context: int, device: torch.device):
+    def __init__(
+        self,
+        checkpoint: str,
+        context: int,
+        device: torch.device,
+        drafter: Drafter | None = None,
+        num_draft_tokens: int = 4,
+    ):
         self.device = device
         self.model = Transformer.from_checkpoint(checkpoint, device=self.device)
         self.caches = [Cache(1, context, self.model.config.num_key_value_heads, device=self.device) for _ in range(len(self.model.block))]
         self.input_token = torch.zeros(1, dtype=torch.int32, device=self.device)
+        # Optional speculative decoding: the drafter proposes up to
+        # `num_draft_tokens` tokens that are verified in the same forward
+        self.drafter = drafter
+        self.num_draft_tokens = num_draft_tokens
         # warmup
         self.model(self.input_token[None, :], caches=self.caches)
         # capture for sampling
@@ -491,26 +536,47 @@ class TokenGenerator:
         stop_tokens = stop_tokens or []
         for cache in self.caches:
             cache.reset()
+        tokens = list(prompt_tokens)
         prompt_tokens = torch.as_tensor(prompt_tokens, dtype=torch.int32, device=self.device)
         self.model(prompt_tokens[None, :-1], self.caches)
-        predicted_token = prompt_tokens[-1]
+        num_cached = len(tokens) - 1
         num_generated_tokens = 0
         while max_tokens == 0 or num_generated_tokens < max_tokens:
-            self.input_token[0] = predicted_token
-            self.graph.replay()
-            if temperature == 0.0:
-                predicted_token = torch.argmax(self.logits[-1, :], dim=-1).item()
+            draft_tokens, draft_probs = [], None
+            if self.drafter is not None:
+                num_draft_tokens = self.num_draft_tokens
+                if max_tokens:
+                    num_draft_tokens = min(num_draft_tokens, max_tokens - num_generated_tokens - 1)
+                if num_draft_tokens > 0:
+                    draft_tokens, draft_probs = self.drafter.propose(tokens, num_draft_tokens, temperature)
+            if draft_tokens:
+                # Verify the whole draft in one forward, then drop the keys and
+                # values of the rejected tokens
+                x = torch.as_tensor(tokens[-1:] + draft_tokens, dtype=torch.int32, device=self.device)
+                logits = self.model(x[None, :], self.caches)[0]
+                predicted_tokens = verify_draft(logits, draft_tokens, draft_probs, temperature)
+                end = num_cached + len(x)
+                num_cached += len(predicted_tokens)
+                for cache in self.caches:
+                    cache.truncate(num_cached, end)
             else:
-                probs = torch.softmax(self.logits * (1.0 / temperature), dim=-1)
-                predicted_token = torch.multinomial(probs[-1, :], num_samples=1).item()
-            num_generated_tokens += 1
-
+                self.input_token[0] = tokens[-1]
+                self.graph.replay()
+                logits = self.logits
+                predicted_tokens = verify_draft(logits, [], None, temperature)
+                num_cached += 1
             if return_logprobs:
-                logprobs = torch.log_softmax(self.logits[-1, :], dim=-1)
-                selected_logprobs = logprobs[predicted_token].item()
-                yield predicted_token, selected_logprobs
-            else:
-                yield predicted_token
+                logprobs = torch.log_softmax(logits[:len(predicted_tokens)], dim=-1)
+                selected_logprobs = logprobs[torch.arange(len(predicted_tokens)), predicted_tokens].tolist()
+
+            for i, predicted_token in enumerate(predicted_tokens):
+                tokens.append(predicted_token)
+                num_generated_tokens += 1
+
+                if return_logprobs:
+                    yield predicted_token, selected_logprobs[i]
+                else:
+                    yield predicted_token
 
-            if predicted_token in stop_tokens:
-                break
+                if predicted_token in stop_tokens:
+                    return
@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("gpt_oss.metal")
+
+from gpt_oss.responses_api.inference.metal import MetalStreamingBackend
+from gpt_oss.responses_api.streaming import SamplingParams
+
+
+class FakeContext:
+    """One sequence; every sampled token depends on all tokens before it."""
+
+    def __init__(self):
+        self.tokens = []
+
+    def reset(self):
+        self.tokens = []
+
+    def append(self, token):
+        self.tokens.append(token)
+
+    def sample(self, max_output_tokens, temperature, seed):
+        sampled = []
+        for _ in range(max_output_tokens):
+            # Slow enough for the other stream to start meanwhile
+            time.sleep(0.001)
+            token = (sum(self.tokens) * 31 + len(self.tokens)) % 97
+            self.tokens.append(token)
+            sampled.append(token)
+        return sampled
+
+
+async def collect(stream) -> list[int]:
+    return [token async for chunk in stream for token in chunk]
+
+
+def test_overlapping_streams_run_in_turn():
+    params = SamplingParams(max_tokens=20)
+    prompts = [[1, 2, 3], [4, 5]]
+
+    async def alone(prompt):
+        return await collect(MetalStreamingBackend(FakeContext()).start("r", prompt, params))
+
+    async def overlapping():
+        backend = MetalStreamingBackend(FakeContext())
+        streams = [backend.start(f"r{i}", prompt, params) for i, prompt in enumerate(prompts)]
+        return await asyncio.gather(*(collect(stream) for stream in streams))
+
+    expected = [asyncio.run(alone(prompt)) for prompt in prompts]
+    assert all(len(tokens) == 20 for tokens in expected)
+    assert asyncio.run(overlapping()) == expected
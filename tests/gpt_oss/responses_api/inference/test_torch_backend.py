@@ -0,0 +1,65 @@
+import pytest
+import torch
+
+from gpt_oss.responses_api.inference import torch as backend
+from gpt_oss.responses_api.scheduler import DecodeRequest
+from gpt_oss.torch.model import ModelConfig, Transformer
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = ModelConfig(
+        num_hidden_layers=2,
+        num_experts=4,
+        experts_per_token=2,
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=32,
+        head_dim=16,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        sliding_window=4,
+    )
+    model = Transformer(config, device=torch.device("cpu"))
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if name.endswith("scale"):
+                param.fill_(1.0)
+            else:
+                param.normal_(0.0, 0.2)
+    return model.eval()
+
+
+@torch.inference_mode()
+def greedy(model, prompt: list[int], num_tokens: int) -> list[int]:
+    tokens = list(prompt)
+    for _ in range(num_tokens):
+        logits = model(torch.as_tensor(tokens, dtype=torch.int32))
+        tokens.append(torch.argmax(logits[-1]).item())
+    return tokens[len(prompt) :]
+
+
+def test_requests_that_do_not_fit_in_the_kv_cache_wait(model, monkeypatch):
+    # 16 blocks of 16 tokens, for four prompts that need 7 blocks each
+    monkeypatch.setattr(backend, "KV_CACHE_MAX_TOKENS", 256)
+    infer_next_tokens = backend.get_infer_next_tokens(model, torch.device("cpu"))
+    prompts = [[(7 * i + n * n) % 64 for n in range(100)] for i in range(4)]
+    requests = [
+        DecodeRequest(f"r{i}", list(prompt), new_request=True)
+        for i, prompt in enumerate(prompts)
+    ]
+    num_tokens = 6
+    active, waited = list(requests), set()
+    while active:
+        for request, next_token in zip(active, infer_next_tokens(active)):
+            if next_token is None:
+                waited.add(request.request_id)
+                continue
+            request.tokens.append(next_token)
+            request.new_request = False
+        active = [r for r in active if len(r.tokens) < 100 + num_tokens]
+
+    assert waited == {"r2", "r3"}
+    for request, prompt in zip(requests, prompts):
+        assert request.tokens[len(prompt) :] == greedy(model, prompt, num_tokens)
@@ -0,0 +1,59 @@
+import pytest
+import torch
+
+transformers = pytest.importorskip("transformers")
+
+from gpt_oss.responses_api.inference import transformers as backend
+from gpt_oss.responses_api.scheduler import DecodeRequest
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = transformers.GptOssConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        head_dim=8,
+        num_local_experts=4,
+        num_experts_per_tok=2,
+        sliding_window=4,
+    )
+    return transformers.GptOssForCausalLM(config).eval()
+
+
+@torch.inference_mode()
+def full_recompute(model, tokens: list[int]) -> int:
+    logits = model(input_ids=torch.tensor([tokens])).logits
+    return torch.argmax(logits[0, -1]).item()
+
+
+def decode(infer_next_tokens, model, requests: list[DecodeRequest], num_steps: int):
+    for _ in range(num_steps):
+        next_tokens = infer_next_tokens(requests)
+        for request, next_token in zip(requests, next_tokens):
+            assert next_token == full_recompute(model, request.tokens)
+            request.tokens.append(next_token)
+            request.new_request = False
+
+
+def test_sessions_match_full_recompute(model, monkeypatch):
+    # A single session is taken over by the other request on every step
+    monkeypatch.setattr(backend, "MAX_SESSIONS", 1)
+    infer_next_tokens = backend.get_infer_next_tokens(model)
+    requests = [
+        DecodeRequest("a", [1, 2, 3, 4, 5, 6, 7], new_request=True),
+        DecodeRequest("b", [9, 8, 7], new_request=True),
+    ]
+    decode(infer_next_tokens, model, requests, 6)
+
+    # A follow-up that diverges from the cached tokens crops the session
+    monkeypatch.setattr(backend, "MAX_SESSIONS", 4)
+    infer_next_tokens = backend.get_infer_next_tokens(model)
+    first = DecodeRequest("c", [1, 2, 3, 4, 5, 6, 7, 8], new_request=True)
+    decode(infer_next_tokens, model, [first], 3)
+    follow_up = DecodeRequest("d", first.tokens[:5] + [30, 31], new_request=True)
+    decode(infer_next_tokens, model, [follow_up], 3)
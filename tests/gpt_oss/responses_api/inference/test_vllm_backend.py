@@ -0,0 +1,79 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("vllm")
+
+from gpt_oss.responses_api.inference.vllm import VLLMStreamingBackend
+from gpt_oss.responses_api.streaming import SamplingParams
+
+
+class FakeEngine:
+    """Produces cumulative outputs the way `AsyncLLMEngine.generate` does."""
+
+    def __init__(self, token_ids: list[int], stop_reason=None, delay: float = 0.0):
+        self.token_ids = token_ids
+        self.stop_reason = stop_reason
+        self.delay = delay
+        self.requests = []
+        self.aborted = []
+
+    async def generate(self, prompt, sampling, request_id):
+        self.requests.append((request_id, prompt["prompt_token_ids"], sampling))
+        try:
+            for i in range(1, len(self.token_ids) + 1):
+                await asyncio.sleep(self.delay)
+                finished = i == len(self.token_ids)
+                yield SimpleNamespace(
+                    finished=finished,
+                    outputs=[
+                        SimpleNamespace(
+                            token_ids=self.token_ids[:i],
+                            stop_reason=self.stop_reason if finished else None,
+                        )
+                    ],
+                )
+        except asyncio.CancelledError:
+            self.aborted.append(request_id)
+            raise
+
+
+async def collect(stream) -> list[int]:
+    return [token async for chunk in stream for token in chunk]
+
+
+def test_streams_new_tokens_and_the_stop_token():
+    engine = FakeEngine([5, 6, 7], stop_reason=9)
+    backend = VLLMStreamingBackend(engine)
+    params = SamplingParams(temperature=0.5, stop_tokens=frozenset({9}), max_tokens=8)
+
+    async def main():
+        first = await collect(backend.start("resp", [1, 2], params))
+        second = await collect(backend.start("resp", [1, 2, 5, 6, 7, 9], params))
+        return first, second
+
+    first, second = asyncio.run(main())
+
+    # Only new tokens are sent, and the stop token vLLM leaves out is appended
+    assert first == second == [5, 6, 7, 9]
+    (first_id, prompt, sampling), (second_id, _, _) = engine.requests
+    assert prompt == [1, 2]
+    assert first_id != second_id
+    assert sampling.max_tokens == 8
+    assert sampling.stop_token_ids == [9]
+
+
+def test_closing_the_stream_aborts_the_engine_request():
+    engine = FakeEngine(list(range(100)), delay=0.01)
+    backend = VLLMStreamingBackend(engine)
+
+    async def main():
+        stream = backend.start("resp", [1], SamplingParams())
+        chunk = await stream.__anext__()
+        stream.close()
+        await asyncio.sleep(0.05)
+        return chunk
+
+    assert asyncio.run(main())[0] == 0
+    assert len(engine.aborted) == 1
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from openai_harmony import (
+    Conversation,
+    HarmonyEncodingName,
+    HarmonyError,
+    Message,
+    Role,
+    load_harmony_encoding,
+)
+
+from gpt_oss.responses_api.api_server import create_api_server, next_turn_tokens
+from gpt_oss.responses_api.store import InMemoryResponseStore
+from gpt_oss.responses_api.streaming import TokenStream
+
+
+class FakeEncoding:
+    """Tokenizes text into the pieces listed in `VOCAB`."""
+
+    VOCAB = [
+        "<|start|>",
+        "<|end|>",
+        "<|return|>",
+        "<|call|>",
+        "<|channel|>",
+        "<|message|>",
+        "system",
+        "user",
+        "assistant",
+        "analysis",
+        "final",
+        "commentary to=functions.f",
+        "hmm",
+        "hi",
+        "{}",
+    ]
+
+    def encode(self, text: str, allowed_special="all") -> list[int]:
+        tokens = []
+        while text:
+            piece = next(p for p in self.VOCAB if text.startswith(p))
+            tokens.append(self.VOCAB.index(piece))
+            text = text[len(piece) :]
+        return tokens
+
+    def decode_utf8(self, tokens: list[int]) -> str:
+        return "".join(self.VOCAB[token] for token in tokens)
+
+
+def test_next_turn_drops_reasoning_before_a_final_answer():
+    encoding = FakeEncoding()
+    prompt = "<|start|>system<|message|>hi<|end|><|start|>user<|message|>hi<|end|>"
+    reasoning = "<|start|>assistant<|channel|>analysis<|message|>hmm<|end|>"
+    call = "<|start|>assistant<|channel|>commentary to=functions.f<|message|>{}<|call|>"
+    answer = "<|start|>assistant<|channel|>final<|message|>hi"
+
+    tokens = encoding.encode(prompt + reasoning + call)
+    assert next_turn_tokens(encoding, tokens) == tokens
+
+    tokens = encoding.encode(prompt + reasoning + answer + "<|return|>")
+    assert next_turn_tokens(encoding, tokens) == encoding.encode(
+        prompt + answer + "<|end|>"
+    )
+
+    # Cut off before a stop token
+    assert next_turn_tokens(encoding, encoding.encode(prompt + reasoning + answer)) is None
+
+
+@pytest.fixture(scope="module")
+def encoding():
+    try:
+        return load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS)
+    except HarmonyError:
+        pytest.skip("the harmony vocab cannot be loaded")
+
+
+class RecordingBackend:
+    """Answers every prompt with `reply` and keeps the prompts."""
+
+    def __init__(self, reply: list[int]):
+        self.reply = reply
+        self.prompts = []
+
+    def start(self, request_id, tokens, sampling_params):
+        self.prompts.append(list(tokens))
+        stream = TokenStream(asyncio.get_running_loop())
+        stream.put(self.reply)
+        stream.end()
+        return stream
+
+
+def test_follow_ups_continue_from_the_stored_tokens(encoding):
+    reply = encoding.encode("<|channel|>final<|message|>Hello<|return|>", allowed_special="all")
+    backend = RecordingBackend(reply)
+    store = InMemoryResponseStore()
+    client = TestClient(create_api_server(backend, encoding, response_store=store))
+
+    first = client.post("/v1/responses", json={"input": "Hi", "store": True}).json()
+    first_prompt = backend.prompts[0]
+    stored = store.get(first["id"])
+    assert stored.tokens == first_prompt + reply[:-1] + encoding.encode(
+        "<|end|>", allowed_special="all"
+    )
+
+    def follow_up(**body) -> list[int]:
+        body = {"input": "Again", "previous_response_id": first["id"], **body}
+        assert client.post("/v1/responses", json=body).status_code == 200
+        return backend.prompts[-1]
+
+    new_turn = encoding.render_conversation_for_completion(
+        Conversation.from_messages([Message.from_role_and_content(Role.USER, "Again")]),
+        Role.ASSISTANT,
+    )
+    assert follow_up() == stored.tokens + new_turn
+
+    # Only the new items are rendered after the stored tokens
+    marker = encoding.encode("marker")
+    store.put(first["id"], stored.request, stored.response, marker)
+    assert follow_up() == marker + new_turn
+
+    # Otherwise the whole conversation is rendered again: without stored
+    # tokens, or when the system and developer messages change
+    for tokens, body in [(None, {}), (marker, {"instructions": "Be brief"})]:
+        store.put(first["id"], stored.request, stored.response, tokens)
+        prompt = follow_up(**body)
+        assert prompt[: len(marker)] != marker
+        text = encoding.decode_utf8(prompt)
+        assert "Hello" in text and text.endswith(encoding.decode_utf8(new_turn))
+        if not body:
+            assert prompt[: len(first_prompt)] == first_prompt
@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+from gpt_oss.responses_api.scheduler import BatchScheduler, DecodeRequest
+from gpt_oss.responses_api.streaming import SamplingParams
+
+
+def test_concurrent_requests_share_steps():
+    batch_sizes = []
+
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[int]:
+        batch_sizes.append(len(requests))
+        return [len(request.tokens) for request in requests]
+
+    scheduler = BatchScheduler(infer_next_tokens, max_batch_size=8)
+
+    async def stream(request_id: str, num_tokens: int) -> list[int]:
+        stream = scheduler.start(request_id, [0], SamplingParams(max_tokens=num_tokens))
+        return [token async for chunk in stream for token in chunk]
+
+    async def main():
+        return await asyncio.gather(*(stream(f"r{i}", 5) for i in range(4)))
+
+    results = asyncio.run(main())
+
+    assert results == [[1, 2, 3, 4, 5]] * 4
+    assert batch_sizes == [4] * 5
+
+
+def test_max_batch_size_is_respected():
+    batch_sizes = []
+
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[int]:
+        batch_sizes.append(len(requests))
+        return [0] * len(requests)
+
+    scheduler = BatchScheduler(infer_next_tokens, max_batch_size=3)
+
+    async def stream(request_id: str) -> list[int]:
+        stream = scheduler.start(request_id, [0], SamplingParams(max_tokens=1))
+        return [token async for chunk in stream for token in chunk]
+
+    async def main():
+        await asyncio.gather(*(stream(f"r{i}") for i in range(7)))
+
+    asyncio.run(main())
+
+    assert max(batch_sizes) == 3
+    assert sum(batch_sizes) == 7
+
+
+def test_batch_size_is_capped_at_backend_capacity():
+    batches = []
+
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[int]:
+        batches.append([request.request_id for request in requests])
+        return [len(request.tokens) for request in requests]
+
+    infer_next_tokens.max_batch_size = 2
+    scheduler = BatchScheduler(infer_next_tokens, max_batch_size=8)
+
+    async def stream(request_id: str) -> list[int]:
+        stream = scheduler.start(request_id, [0], SamplingParams(max_tokens=2))
+        return [token async for chunk in stream for token in chunk]
+
+    async def main():
+        return await asyncio.gather(*(stream(f"r{i}") for i in range(3)))
+
+    assert asyncio.run(main()) == [[1, 2]] * 3
+    # Requests keep their place until they finish instead of taking turns
+    assert batches == [["r0", "r1"], ["r0", "r1"], ["r2"], ["r2"]]
+
+
+def test_chunked_prefill_interleaves_with_decode():
+    steps = []
+    prefill_steps = {"long": 3}
+
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[int]:
+        steps.append(sorted(request.request_id for request in requests))
+        next_tokens = []
+        for request in requests:
+            if prefill_steps.get(request.request_id):
+                prefill_steps[request.request_id] -= 1
+                next_tokens.append(None)
+            else:
+                next_tokens.append(len(request.tokens))
+        return next_tokens
+
+    scheduler = BatchScheduler(infer_next_tokens, max_batch_size=8)
+
+    async def stream(request_id: str, prompt: list[int], num_tokens: int) -> list[int]:
+        stream = scheduler.start(request_id, prompt, SamplingParams(max_tokens=num_tokens))
+        return [token async for chunk in stream for token in chunk]
+
+    async def main():
+        return await asyncio.gather(stream("short", [0], 4), stream("long", [0] * 10, 1))
+
+    results = asyncio.run(main())
+
+    assert results == [[1, 2, 3, 4], [10]]
+    # The short request kept decoding while the long prompt was prefilled
+    assert steps == [["long", "short"]] * 4
+
+
+def test_streams_stop_at_stop_tokens_without_blocking_the_event_loop():
+    def infer_next_tokens(requests: list[DecodeRequest]) -> list[int]:
+        time.sleep(0.01)
+        return [len(request.tokens) for request in requests]
+
+    scheduler = BatchScheduler(infer_next_tokens)
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.001)
+
+        ticker_task = asyncio.create_task(ticker())
+        stream = scheduler.start("r", [0], SamplingParams(stop_tokens=frozenset({5})))
+        tokens = [token async for chunk in stream for token in chunk]
+        ticker_task.cancel()
+        return tokens, ticks
+
+    tokens, ticks = asyncio.run(main())
+
+    assert tokens == [1, 2, 3, 4, 5]
+    # The event loop kept running while the backend was busy
+    assert ticks > 10
+
+
+def test_tokens_that_arrive_together_are_returned_as_one_chunk():
+    scheduler = BatchScheduler(lambda requests: [len(r.tokens) for r in requests])
+
+    async def main():
+        stream = scheduler.start("r", [0], SamplingParams(max_tokens=3))
+        while scheduler._active or scheduler._incoming:
+            await asyncio.sleep(0.001)
+        return [chunk async for chunk in stream]
+
+    assert asyncio.run(main()) == [[1, 2, 3]]
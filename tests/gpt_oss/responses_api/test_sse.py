@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from gpt_oss.responses_api.sse import (
+    MAX_FLUSH_INTERVAL,
+    coalesce_events,
+    parse_flush_interval,
+)
+
+
+async def produce(bursts: list[list[str]], pause: float = 0.05, error=None):
+    for i, burst in enumerate(bursts):
+        if i:
+            await asyncio.sleep(pause)
+        for event in burst:
+            yield event
+            # Events of a burst arrive on separate loop iterations
+            await asyncio.sleep(0)
+    if error is not None:
+        raise error
+
+
+async def collect(events) -> list[str]:
+    return [chunk async for chunk in events]
+
+
+def test_events_of_a_burst_are_written_together():
+    bursts = [["a", "b", "c"], ["d"], ["e", "f"]]
+    chunks = asyncio.run(collect(coalesce_events(produce(bursts), flush_interval=0.01)))
+    assert chunks == ["abc", "d", "ef"]
+
+    # Chunks stop growing at max_bytes
+    chunks = asyncio.run(
+        collect(coalesce_events(produce(bursts), flush_interval=0.01, max_bytes=2))
+    )
+    assert chunks == ["ab", "c", "d", "ef"]
+
+    # A flush interval of 0 writes every event on its own
+    chunks = asyncio.run(collect(coalesce_events(produce(bursts), flush_interval=0)))
+    assert chunks == ["a", "b", "c", "d", "e", "f"]
+
+
+def test_errors_are_raised_after_the_pending_events():
+    chunks = []
+
+    async def main():
+        events = produce([["a", "b"]], error=ValueError("boom"))
+        async for chunk in coalesce_events(events, flush_interval=0.01):
+            chunks.append(chunk)
+
+    with pytest.raises(ValueError, match="boom"):
+        asyncio.run(main())
+    assert chunks == ["ab"]
+
+
+def test_closing_early_stops_the_events():
+    closed = []
+
+    async def events():
+        try:
+            while True:
+                yield "x"
+                await asyncio.sleep(0.001)
+        finally:
+            closed.append(True)
+
+    async def main():
+        stream = coalesce_events(events(), flush_interval=0.01)
+        assert (await stream.__anext__()).startswith("x")
+        await stream.aclose()
+
+    asyncio.run(main())
+    assert closed == [True]
+
+
+def test_a_slow_client_holds_back_the_events():
+    produced = 0
+
+    async def events():
+        nonlocal produced
+        while True:
+            produced += 1
+            yield "x"
+            await asyncio.sleep(0)
+
+    async def main():
+        stream = coalesce_events(events(), flush_interval=0.01, max_bytes=4)
+        assert await stream.__anext__() == "xxxx"
+        # The client reads nothing for a while
+        await asyncio.sleep(0.05)
+        await stream.aclose()
+
+    asyncio.run(main())
+    assert produced <= 5
+
+
+def test_flush_interval_header_must_be_finite_and_not_negative():
+    assert parse_flush_interval("0") == 0
+    assert parse_flush_interval("0.05") == 0.05
+    assert parse_flush_interval("3600") == MAX_FLUSH_INTERVAL
+    for value in ["nan", "inf", "-inf", "-0.5", "soon"]:
+        with pytest.raises(ValueError):
+            parse_flush_interval(value)
@@ -0,0 +1,90 @@
+import pytest
+
+from gpt_oss.responses_api import store as store_module
+from gpt_oss.responses_api.store import (
+    InMemoryResponseStore,
+    SQLiteResponseStore,
+    StoredResponse,
+)
+from gpt_oss.responses_api.types import (
+    FunctionCallItem,
+    Item,
+    ReasoningItem,
+    ReasoningTextContentItem,
+    ResponseObject,
+    ResponsesRequest,
+    TextContentItem,
+)
+
+
+def make_record(i: int) -> StoredResponse:
+    request = ResponsesRequest(input=f"question {i}", store=True, temperature=0.5)
+    response = ResponseObject(
+        id=f"resp_{i}",
+        created_at=1_700_000_000 + i,
+        status="completed",
+        output=[
+            ReasoningItem(
+                type="reasoning",
+                summary=[],
+                content=[ReasoningTextContentItem(type="reasoning_text", text="hmm")],
+            ),
+            FunctionCallItem(type="function_call", name="f", arguments='{"x": 1}'),
+            Item(
+                role="assistant",
+                content=[TextContentItem(type="output_text", text=f"answer {i}")],
+            ),
+        ],
+    )
+    return StoredResponse(request, response, [200006, i, 1 << 20, 200012])
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "memory":
+            return InMemoryResponseStore(**kwargs)
+        return SQLiteResponseStore(str(tmp_path / "responses.db"), **kwargs)
+
+    return make
+
+
+def test_round_trip_and_lru_eviction(make_store):
+    store = make_store(max_entries=2)
+    records = [make_record(i) for i in range(3)]
+    store.put("a", *records[0])
+    store.put("b", *records[1][:2])
+    assert store.get("b").tokens is None
+    assert store.get("a") == records[0]
+    # "b" is now the least recently used entry
+    store.put("c", *records[2])
+    assert store.get("b") is None
+    assert store.get("a").tokens == records[0].tokens
+    assert store.get("c") == records[2]
+    assert len(store) == 2
+
+
+def test_expired_entries_are_dropped(make_store, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(store_module.time, "time", lambda: now)
+    store = make_store(ttl=10)
+    store.put("a", *make_record(0))
+    now += 6
+    store.put("b", *make_record(1))
+    now += 6
+    assert store.get("a") is None
+    assert store.get("b") == make_record(1)
+    now += 6
+    store.put("c", *make_record(2))
+    assert len(store) == 1
+
+
+def test_sqlite_store_is_shared_and_survives_reopening(tmp_path):
+    path = str(tmp_path / "responses.db")
+    first = SQLiteResponseStore(path)
+    second = SQLiteResponseStore(path)
+    first.put("a", *make_record(0))
+    assert second.get("a") == make_record(0)
+    first.close()
+    second.close()
+    assert SQLiteResponseStore(path).get("a") == make_record(0)
@@ -0,0 +1,34 @@
+import logging
+
+from gpt_oss.responses_api.tracing import TokenLogger
+
+
+class FakeEncoding:
+    def decode(self, tokens: list[int]) -> str:
+        return " ".join(map(str, tokens))
+
+
+def test_generated_tokens_are_logged_in_batches(caplog):
+    tracer = TokenLogger(FakeEncoding(), batch_size=3)
+
+    # Nothing is collected while the logger is off
+    tracer.tokens("a", [1, 2, 3, 4])
+    assert tracer.pending == {}
+
+    with caplog.at_level(logging.DEBUG, logger="gpt_oss.responses_api.tracing"):
+        tracer.prompt("a", [9, 9])
+        for token in range(5):
+            tracer.tokens("a", [token])
+            tracer.tokens("b", [token + 10])
+        tracer.end("a")
+        tracer.end("b")
+
+    assert [(r.response_id, r.kind, r.num_tokens) for r in caplog.records] == [
+        ("a", "prompt", 2),
+        ("a", "output", 3),
+        ("b", "output", 3),
+        ("a", "output", 2),
+        ("b", "output", 2),
+    ]
+    assert caplog.records[1].getMessage() == "a output (3 tokens): 0 1 2"
+    assert tracer.pending == {}
@@ -0,0 +1,39 @@
+import random
+
+from gpt_oss.tools.simple_browser import SimpleBrowserTool
+from gpt_oss.tools.simple_browser.backend import ExaBackend
+
+
+def make_browser_tool():
+    tool_state = {"page_stack": ["https://example.com/a", "https://www.example.org/b"]}
+    return SimpleBrowserTool(backend=ExaBackend(source="web"), tool_state=tool_state)
+
+
+def test_citation_normalizer_matches_full_normalization():
+    browser_tool = make_browser_tool()
+    text = (
+        "Cats sleep a lot【0†L1-L3】. Dogs【1†L4】 bark【0†L2†extra】 and "
+        "unknown pages stay as is【7†L1】. Brackets【like this】 are kept."
+    )
+    expected_text, expected_annotations, _ = browser_tool.normalize_citations(text)
+
+    rng = random.Random(0)
+    for _ in range(20):
+        normalizer = browser_tool.citation_normalizer()
+        cuts = sorted(rng.sample(range(1, len(text)), 12))
+        streamed_text, annotations = "", []
+        for start, end in zip([0] + cuts, cuts + [len(text)]):
+            new_text, new_annotations, _ = normalizer.feed(text[start:end])
+            streamed_text += new_text
+            annotations += new_annotations
+        assert streamed_text == expected_text
+        assert annotations == expected_annotations
+
+
+def test_citation_normalizer_holds_back_only_partial_citations():
+    normalizer = make_browser_tool().citation_normalizer()
+    assert normalizer.feed("See【0") == ("See", [], True)
+    new_text, annotations, has_partial = normalizer.feed("†L1】 now")
+    assert new_text == " ([example.com](https://example.com/a))  now"
+    assert annotations[0]["start_index"] == 3
+    assert not has_partial
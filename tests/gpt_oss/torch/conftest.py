@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from gpt_oss.torch.model import ModelConfig, Transformer
+
+
+@pytest.fixture(scope="module")
+def tiny_config():
+    return ModelConfig(
+        num_hidden_layers=2,
+        num_experts=4,
+        experts_per_token=2,
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=32,
+        head_dim=16,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        sliding_window=4,
+    )
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tiny_config):
+    torch.manual_seed(0)
+    model = Transformer(tiny_config, device=torch.device("cpu"))
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if name.endswith("scale"):
+                param.fill_(1.0)
+            else:
+                param.normal_(0.0, 0.2)
+    model.eval()
+    return model
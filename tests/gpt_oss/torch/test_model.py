@@ -0,0 +1,155 @@
+import pytest
+import torch
+
+from gpt_oss.torch import model as model_module
+from gpt_oss.torch.paged_cache import PagedKVCache
+
+
+@torch.inference_mode()
+def test_packed_batch_matches_separate_sequences(tiny_model):
+    sequences = [[1, 2, 3, 4, 5, 6, 7], [8, 9], [10, 11, 12, 13, 14]]
+    seq_lens = [len(s) for s in sequences]
+    packed = tiny_model(
+        torch.as_tensor(sum(sequences, []), dtype=torch.int32), seq_lens=seq_lens
+    )
+    for expected_input, logits in zip(sequences, packed.split(seq_lens)):
+        expected = tiny_model(torch.as_tensor(expected_input, dtype=torch.int32))
+        torch.testing.assert_close(logits, expected, atol=2e-2, rtol=2e-2)
+
+
+def reference_sdpa(Q, K, V, S, sm_scale, sliding_window=0, start_q=0):
+    n_tokens, n_heads, q_mult, d_head = Q.shape
+    q_pos = torch.arange(start_q, start_q + n_tokens)[:, None]
+    k_pos = torch.arange(K.shape[0])[None, :]
+    mask = k_pos > q_pos
+    if sliding_window > 0:
+        mask |= k_pos <= q_pos - sliding_window
+    QK = torch.einsum("qhmd,khd->hmqk", Q, K) * sm_scale
+    QK = QK.masked_fill(mask, -float("inf"))
+    sinks = S.reshape(n_heads, q_mult, 1, 1).expand(-1, -1, n_tokens, 1)
+    W = torch.softmax(torch.cat([QK, sinks], dim=-1), dim=-1)[..., :-1]
+    return torch.einsum("hmqk,khd->qhmd", W, V).reshape(n_tokens, -1)
+
+
+@pytest.mark.parametrize("sliding_window", [0, 5])
+@pytest.mark.parametrize("n_tokens, start_q", [(13, 0), (4, 9), (1, 12)])
+def test_blockwise_sdpa_matches_reference(monkeypatch, sliding_window, n_tokens, start_q):
+    # Small tiles so that queries and keys span several blocks
+    monkeypatch.setattr(model_module, "SDPA_QUERY_BLOCK_SIZE", 3)
+    monkeypatch.setattr(model_module, "SDPA_TILE_SIZE", 6)
+    torch.manual_seed(0)
+    n_kv_tokens = start_q + n_tokens
+    Q = torch.randn(n_tokens, 2, 3, 8)
+    K = torch.randn(n_kv_tokens, 2, 8)
+    V = torch.randn(n_kv_tokens, 2, 8)
+    S = torch.randn(2, 3)
+    args = (Q, K, V, S, 0.5, sliding_window, start_q)
+    torch.testing.assert_close(model_module.sdpa(*args), reference_sdpa(*args))
+
+
+@torch.inference_mode()
+def test_grouped_experts_match_gathered_weights(tiny_model):
+    mlp = tiny_model.block[0].mlp
+    torch.manual_seed(0)
+    x = torch.randn(9, 32, dtype=torch.bfloat16)
+
+    # Each token gathers the weights of its experts
+    t = mlp.norm(x)
+    experts = torch.topk(mlp.gate(t), k=mlp.experts_per_token, dim=-1, sorted=True)
+    expert_weights = torch.nn.functional.softmax(experts.values, dim=1)
+    t = torch.einsum("beck,bk->bec", mlp.mlp1_weight[experts.indices], t)
+    t = model_module.swiglu(t + mlp.mlp1_bias[experts.indices], limit=mlp.swiglu_limit)
+    t = torch.einsum("beck,bek->bec", mlp.mlp2_weight[experts.indices], t)
+    t = t + mlp.mlp2_bias[experts.indices]
+    expected = x + torch.einsum("bec,be->bc", t, expert_weights)
+
+    torch.testing.assert_close(mlp(x), expected, atol=2e-2, rtol=2e-2)
+
+
+@torch.inference_mode()
+def test_norm_decode_step_matches_forward(tiny_config):
+    norm = model_module.RMSNorm(tiny_config.hidden_size)
+    torch.manual_seed(0)
+    norm.scale.copy_(torch.rand_like(norm.scale) + 0.5)
+    workspace = model_module.DecodeWorkspace(tiny_config)
+    x = torch.randn(1, tiny_config.hidden_size, dtype=torch.bfloat16)
+    out = norm.decode_step(x, workspace)
+    assert out.data_ptr() == workspace.norm.data_ptr()
+    assert torch.equal(out, norm(x))
+
+
+@torch.inference_mode()
+def test_decode_step_matches_cached_forward(tiny_model, tiny_config):
+    cache = PagedKVCache(
+        tiny_config.num_hidden_layers,
+        tiny_config.num_key_value_heads,
+        tiny_config.head_dim,
+        block_size=4,
+        num_blocks=4,
+    )
+    tokens = [3, 1, 4, 1, 5, 9, 2, 6]
+    tiny_model(torch.as_tensor(tokens[:3], dtype=torch.int32), cache=cache, seq_ids=[0])
+    workspace = model_module.DecodeWorkspace(tiny_config)
+    # Past the sliding window and across cache blocks
+    for n in range(3, len(tokens)):
+        logits = tiny_model.decode_step(
+            torch.as_tensor(tokens[n : n + 1]), cache, 0, workspace
+        )
+        expected = tiny_model(torch.as_tensor(tokens[: n + 1], dtype=torch.int32))
+        torch.testing.assert_close(logits, expected[-1:], atol=2e-2, rtol=2e-2)
+
+
+@pytest.fixture
+def tiny_generator(tiny_model, monkeypatch):
+    monkeypatch.setattr(model_module.Transformer, "from_checkpoint", lambda *args, **kwargs: tiny_model)
+    return model_module.TokenGenerator("tiny", device=torch.device("cpu"))
+
+
+def uncached_greedy(model, prompt, num_tokens):
+    tokens = list(prompt)
+    for _ in range(num_tokens):
+        logits = model(torch.as_tensor(tokens, dtype=torch.int32))
+        tokens.append(torch.argmax(logits[-1]).item())
+    return tokens[len(prompt) :]
+
+
+@torch.inference_mode()
+def test_cached_generation_matches_uncached_decoding(tiny_generator, tiny_model):
+    prompt = [3, 1, 4, 1, 5, 9, 2, 6]
+    generated = list(tiny_generator.generate(prompt, stop_tokens=[], temperature=0.0, max_tokens=8))
+    assert generated == uncached_greedy(tiny_model, prompt, 8)
+
+    # A follow-up reuses the cached conversation, a different prompt crops it
+    for prompt in [prompt + generated + [7, 7], prompt[:4] + [8, 8]]:
+        generated = list(tiny_generator.generate(prompt, stop_tokens=[], temperature=0.0, max_tokens=6))
+        assert generated == uncached_greedy(tiny_model, prompt, 6)
+
+
+@torch.inference_mode()
+def test_samples_share_one_prefill(tiny_generator, tiny_model):
+    prompt = [3, 1, 4, 1, 5, 9, 2]
+    greedy = list(tiny_generator.generate(prompt, stop_tokens=[], temperature=0.0, max_tokens=6))
+    assert tiny_generator.sample(prompt, [], n=3, temperature=0.0, max_tokens=6) == [greedy] * 3
+    # Only the prompt stays cached
+    assert tiny_generator.cache.block_tables.keys() == {0}
+
+    samples = tiny_generator.sample(prompt, [greedy[2]], n=4, temperature=1.0, max_tokens=6)
+    for sample in samples:
+        assert len(sample) == 6 or sample[-1] == greedy[2]
+
+
+def sequence_logprob(model, prompt, tokens):
+    logits = model(torch.as_tensor(prompt + tokens, dtype=torch.int32))
+    logprobs = torch.log_softmax(logits[len(prompt) - 1 : -1].float(), dim=-1)
+    return logprobs[torch.arange(len(tokens)), tokens].sum().item()
+
+
+@torch.inference_mode()
+def test_beam_search_scores_are_sequence_logprobs(tiny_generator, tiny_model):
+    prompt = [3, 1, 4, 1, 5, 9, 2]
+    beams = tiny_generator.beam_search(prompt, [], num_beams=3, max_tokens=5, length_penalty=0.0)
+    assert len(beams) == 3 and len({tuple(tokens) for tokens, _ in beams}) == 3
+    assert [score for _, score in beams] == sorted((score for _, score in beams), reverse=True)
+    for tokens, score in beams:
+        assert score == pytest.approx(sequence_logprob(tiny_model, prompt, tokens), abs=0.05)
+    assert tiny_generator.cache.block_tables.keys() == {0}
@@ -0,0 +1,59 @@
+import torch
+
+from gpt_oss.torch.paged_cache import PagedKVCache
+
+
+def make_cache(config, **kwargs):
+    return PagedKVCache(
+        config.num_hidden_layers,
+        config.num_key_value_heads,
+        config.head_dim,
+        dtype=torch.bfloat16,
+        **kwargs,
+    )
+
+
+@torch.inference_mode()
+def test_incremental_decode_matches_full_forward(tiny_model, tiny_config):
+    tokens = [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5]
+    expected = tiny_model(torch.as_tensor(tokens, dtype=torch.int32))
+
+    cache = make_cache(tiny_config, block_size=4, num_blocks=2, max_num_blocks=8)
+    logits = [tiny_model(torch.as_tensor(tokens[:6], dtype=torch.int32), cache=cache, seq_ids=[0])]
+    for token in tokens[6:]:
+        logits.append(
+            tiny_model(torch.as_tensor([token], dtype=torch.int32), cache=cache, seq_ids=[0])
+        )
+
+    torch.testing.assert_close(torch.cat(logits), expected, atol=2e-2, rtol=2e-2)
+    assert cache.seq_len(0) == len(tokens)
+    assert cache.num_blocks == 4
+
+
+@torch.inference_mode()
+def test_forked_sequences_share_prefix_blocks(tiny_model, tiny_config):
+    prefix, a, b = [7, 8, 9, 10, 11, 12], [13, 14], [15]
+    cache = make_cache(tiny_config, block_size=4, num_blocks=8)
+    tiny_model(torch.as_tensor(prefix, dtype=torch.int32), cache=cache, seq_ids=["a"])
+    cache.fork("a", "b")
+    assert cache.block_tables["a"] == cache.block_tables["b"]
+
+    logits = tiny_model(
+        torch.as_tensor(a + b, dtype=torch.int32),
+        seq_lens=[len(a), len(b)],
+        cache=cache,
+        seq_ids=["a", "b"],
+    )
+
+    # The full first block stays shared, the partial one was copied on write
+    assert cache.block_tables["a"][0] == cache.block_tables["b"][0]
+    assert cache.block_tables["a"][1] != cache.block_tables["b"][1]
+    for tokens, seq_logits in zip([prefix + a, prefix + b], logits.split([2, 1])):
+        expected = tiny_model(torch.as_tensor(tokens, dtype=torch.int32))
+        torch.testing.assert_close(
+            seq_logits, expected[-len(seq_logits) :], atol=2e-2, rtol=2e-2
+        )
+
+    cache.free("a")
+    cache.free("b")
+    assert len(cache.free_blocks) == cache.num_blocks
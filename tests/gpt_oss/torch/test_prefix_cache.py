@@ -0,0 +1,59 @@
+import torch
+
+from gpt_oss.torch.paged_cache import PagedKVCache
+from gpt_oss.torch.prefix_cache import PrefixCache
+
+
+def make_cache(config, **kwargs):
+    return PagedKVCache(
+        config.num_hidden_layers,
+        config.num_key_value_heads,
+        config.head_dim,
+        dtype=torch.bfloat16,
+        **kwargs,
+    )
+
+
+@torch.inference_mode()
+def test_shared_prefix_matches_full_forward(tiny_model, tiny_config):
+    prefix = [7, 8, 9, 10, 11, 12, 13, 14, 15]
+    cache = make_cache(tiny_config, block_size=4, num_blocks=8)
+    prefix_cache = PrefixCache(cache)
+    tiny_model(torch.as_tensor(prefix, dtype=torch.int32), cache=cache, seq_ids=["a"])
+    prefix_cache.insert(prefix, cache.block_tables["a"])
+    cache.free("a")
+
+    # Only the two full blocks are cached, and they outlive the sequence
+    tokens = prefix[:8] + [20, 21, 22]
+    blocks = prefix_cache.match(tokens)
+    assert len(blocks) == 2
+    cache.allocate("b", blocks)
+    logits = tiny_model(
+        torch.as_tensor(tokens[8:], dtype=torch.int32), cache=cache, seq_ids=["b"]
+    )
+    expected = tiny_model(torch.as_tensor(tokens, dtype=torch.int32))
+    torch.testing.assert_close(logits, expected[8:], atol=2e-2, rtol=2e-2)
+
+    # Blocks still used by "b" cannot be evicted
+    prefix_cache.evict(cache.num_blocks)
+    assert prefix_cache.match(tokens) == blocks
+    cache.free("b")
+    prefix_cache.evict(cache.num_blocks)
+    assert prefix_cache.match(tokens) == []
+    assert len(cache.free_blocks) == cache.num_blocks
+
+
+def test_evicts_least_recently_used_leaves_first(tiny_config):
+    cache = make_cache(tiny_config, block_size=2, num_blocks=4)
+    prefix_cache = PrefixCache(cache)
+    for seq_id, tokens in [("a", [1, 2, 3, 4]), ("b", [1, 2, 5, 6])]:
+        cache.reserve(seq_id, len(tokens))
+        prefix_cache.insert(tokens, cache.block_tables[seq_id])
+        cache.free(seq_id)
+    # The first block of "b" was already cached, so the tree holds three blocks
+    assert cache.num_available_blocks == 1
+
+    prefix_cache.match([1, 2, 3, 4])
+    prefix_cache.evict(2)
+    assert len(prefix_cache.match([1, 2, 5, 6])) == 1
+    assert len(prefix_cache.match([1, 2, 3, 4])) == 2
@@ -0,0 +1,89 @@
+import pytest
+import torch
+
+from gpt_oss.torch import model as model_module
+from gpt_oss.torch.speculative import DraftModelDrafter, PromptLookupDrafter, verify_draft
+
+
+def test_prompt_lookup_copies_latest_continuation():
+    drafter = PromptLookupDrafter(max_ngram=2)
+    assert drafter.propose([1, 2, 3, 9, 2, 3, 4, 5, 2, 3], 3) == ([4, 5, 2], None)
+    # Falls back to shorter n-grams and keeps its index across calls
+    assert drafter.propose([1, 2, 3, 9, 2, 3, 4, 5, 2, 3, 7, 5], 2) == ([2, 3], None)
+    assert drafter.propose([6, 6], 2) == ([6], None)
+    assert drafter.propose([8], 2) == ([], None)
+
+
+@torch.inference_mode()
+def test_greedy_draft_model_matches_plain_decoding(tiny_model):
+    tokens = [3, 1, 4, 1, 5]
+    expected = list(tokens)
+    for _ in range(6):
+        logits = tiny_model(torch.as_tensor(expected, dtype=torch.int32))
+        expected.append(torch.argmax(logits[-1]).item())
+
+    # The model drafting for itself gets every draft token accepted
+    drafter = DraftModelDrafter(tiny_model)
+    draft_tokens, draft_probs = drafter.propose(tokens, 5, temperature=0.0)
+    assert draft_probs is None
+    logits = tiny_model(torch.as_tensor(tokens + draft_tokens, dtype=torch.int32))
+    assert verify_draft(logits[-6:], draft_tokens, None, 0.0) == expected[5:]
+
+    # A wrong draft token is replaced by the model's own choice
+    wrong = (expected[6] + 1) % 64
+    logits = tiny_model(torch.as_tensor(expected[:6] + [wrong], dtype=torch.int32))
+    assert verify_draft(logits[-2:], [wrong], None, 0.0) == [expected[6]]
+
+
+@pytest.mark.parametrize("draft_probs", [None, torch.tensor([[0.1, 0.6, 0.2, 0.1]])])
+def test_sampled_tokens_follow_the_model_distribution(draft_probs):
+    torch.manual_seed(0)
+    logits = torch.log(torch.tensor([[0.5, 0.2, 0.2, 0.1], [0.25, 0.25, 0.25, 0.25]]))
+    num_samples = 4000
+    counts = torch.zeros(4)
+    for _ in range(num_samples):
+        # Draft tokens are drawn from the drafter's distribution, if it has one
+        draft = [1] if draft_probs is None else torch.multinomial(draft_probs, 1)[0].tolist()
+        counts[verify_draft(logits, draft, draft_probs, temperature=1.0)[0]] += 1
+    torch.testing.assert_close(counts / num_samples, logits[0].exp(), atol=0.03, rtol=0)
+
+
+@pytest.fixture
+def draft_model(tiny_config):
+    # Different weights from tiny_model, so that some draft tokens are rejected
+    torch.manual_seed(1)
+    model = model_module.Transformer(tiny_config, device=torch.device("cpu"))
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if name.endswith("scale"):
+                param.fill_(1.0)
+            else:
+                param.normal_(0.0, 0.2)
+    return model.eval()
+
+
+@pytest.mark.parametrize("drafter", ["prompt_lookup", "draft_model"])
+def test_greedy_generation_with_a_drafter_matches_plain_generation(
+    tiny_model, draft_model, monkeypatch, drafter
+):
+    monkeypatch.setattr(
+        model_module.Transformer, "from_checkpoint", lambda *args, **kwargs: tiny_model
+    )
+    drafters = {
+        "prompt_lookup": lambda: PromptLookupDrafter(max_ngram=2),
+        "draft_model": lambda: DraftModelDrafter(draft_model),
+    }
+    plain = model_module.TokenGenerator("tiny", device=torch.device("cpu"))
+    speculative = model_module.TokenGenerator(
+        "tiny", device=torch.device("cpu"), drafter=drafters[drafter](), num_draft_tokens=3
+    )
+    prompt = [3, 1, 4, 1, 5, 9, 2, 6, 3, 1, 4, 1]
+    # The second prompt continues from part of the first generation, so the
+    # cache is also rolled back between calls
+    for _ in range(2):
+        expected = list(plain.generate(prompt, stop_tokens=[], temperature=0.0, max_tokens=12))
+        generated = list(
+            speculative.generate(prompt, stop_tokens=[], temperature=0.0, max_tokens=12)
+        )
+        assert generated == expected
+        prompt = prompt + expected[:5]
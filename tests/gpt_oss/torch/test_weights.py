@@ -0,0 +1,126 @@
+import dataclasses
+import json
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from gpt_oss.torch.model import DecodeWorkspace, Transformer
+from gpt_oss.torch.paged_cache import PagedKVCache
+from gpt_oss.torch.weights import Checkpoint, Shard
+
+
+def write_checkpoint(path, config):
+    """A random checkpoint with MoE weights in MXFP4, as released."""
+    torch.manual_seed(0)
+    model = Transformer(config, device=torch.device("cpu"), mxfp4_experts=True)
+    tensors = {}
+    for name, param in model.named_parameters():
+        if name.endswith("_blocks"):
+            tensor = torch.randint(0, 256, param.shape, dtype=torch.uint8)
+            name = name.removesuffix("_blocks") + ".blocks"
+        elif name.endswith("_scales"):
+            tensor = torch.randint(120, 130, param.shape, dtype=torch.uint8)
+            name = name.removesuffix("_scales") + ".scales"
+        elif name.endswith("scale"):
+            tensor = torch.ones(param.shape, dtype=param.dtype)
+        else:
+            tensor = torch.randn(param.shape, dtype=param.dtype) * 0.2
+        tensors[name] = tensor
+    save_file(tensors, str(path / "model.safetensors"))
+    (path / "config.json").write_text(json.dumps(dataclasses.asdict(config)))
+
+
+def test_dequantized_mxfp4_matches_reference(tmp_path, tiny_config):
+    write_checkpoint(tmp_path, tiny_config)
+    checkpoint = Checkpoint(str(tmp_path), torch.device("cpu"))
+    torch.testing.assert_close(
+        checkpoint._get_mxfp4_tensor(
+            "block.0.mlp.mlp1_weight.blocks", "block.0.mlp.mlp1_weight.scales", rows_per_chunk=5
+        ),
+        checkpoint._get_mxfp4_tensor_copy(
+            "block.0.mlp.mlp1_weight.blocks", "block.0.mlp.mlp1_weight.scales"
+        ),
+        atol=0,
+        rtol=0,
+    )
+
+
+def test_shards_match_slices_of_full_tensors(tmp_path, tiny_config):
+    # Two blocks of 32 intermediate values to shard mlp2 by
+    write_checkpoint(tmp_path, dataclasses.replace(tiny_config, intermediate_size=64))
+    checkpoint = Checkpoint(str(tmp_path), torch.device("cpu"))
+    for name, shard in [
+        ("block.0.mlp.mlp1_weight", Shard(1, 32, 96)),
+        ("block.0.mlp.mlp1_bias", Shard(1, 32, 96)),
+        ("block.1.mlp.mlp2_weight", Shard(-1, 32, 64)),
+        # Boundaries inside blocks, as with 2880 values split over 4 ranks
+        ("block.1.mlp.mlp2_weight", Shard(-1, 16, 48)),
+        ("block.1.mlp.mlp2_weight", Shard(-1, 0, 20)),
+        ("block.1.mlp.mlp2_weight_blocks", Shard(2, 1, 2)),
+    ]:
+        full = checkpoint.get(name)
+        torch.testing.assert_close(
+            checkpoint.get(name, shard), full[shard.index(full.shape)], atol=0, rtol=0
+        )
+
+
+# Reading on another device than the one loaded to prefetches packed weights
+@pytest.mark.parametrize("device", [torch.device("cpu"), torch.device("cpu", 0)])
+def test_get_all_prefetches_in_order(tmp_path, tiny_config, device):
+    write_checkpoint(tmp_path, tiny_config)
+    checkpoint = Checkpoint(str(tmp_path), device, read_device=torch.device("cpu"))
+    names = [
+        ("block.1.mlp.mlp2_weight", None),
+        ("embedding.weight", None),
+        ("block.0.mlp.mlp1_weight", Shard(1, 0, 32)),
+        ("block.0.mlp.mlp1_bias", None),
+    ]
+    loaded = list(checkpoint.get_all(names, num_workers=2, prefetch=1))
+    assert [name for name, _ in loaded] == [name for name, _ in names]
+    for (name, shard), (_, tensor) in zip(names, loaded):
+        torch.testing.assert_close(tensor, checkpoint.get(name, shard), atol=0, rtol=0)
+
+
+@torch.inference_mode()
+def test_mxfp4_experts_match_upcast_weights(tmp_path, tiny_config):
+    write_checkpoint(tmp_path, tiny_config)
+    upcast = Transformer.from_checkpoint(str(tmp_path), device="cpu")
+    packed = Transformer.from_checkpoint(str(tmp_path), device="cpu", mxfp4_experts=True)
+    assert packed.block[0].mlp.mlp1_weight_blocks.dtype == torch.uint8
+
+    x = torch.as_tensor([3, 1, 4, 1, 5, 9, 2, 6], dtype=torch.int32)
+    torch.testing.assert_close(packed(x), upcast(x), atol=0, rtol=0)
+
+    # Decoding dequantizes the experts into the workspace
+    logits = []
+    for model, mxfp4_experts in [(upcast, False), (packed, True)]:
+        cache = PagedKVCache(
+            tiny_config.num_hidden_layers,
+            tiny_config.num_key_value_heads,
+            tiny_config.head_dim,
+            block_size=4,
+            num_blocks=4,
+        )
+        model(x[:-1], cache=cache, seq_ids=[0])
+        workspace = DecodeWorkspace(tiny_config, mxfp4_experts=mxfp4_experts)
+        logits.append(model.decode_step(x[-1:], cache, 0, workspace))
+    torch.testing.assert_close(*logits, atol=0, rtol=0)
+
+
+@torch.inference_mode()
+def test_converted_cache_is_reused(tmp_path, tiny_config, monkeypatch):
+    path = tmp_path / "checkpoint"
+    path.mkdir()
+    write_checkpoint(path, tiny_config)
+    cache_dir = tmp_path / "converted"
+    expected = Transformer.from_checkpoint(str(path), device="cpu")
+    first = Transformer.from_checkpoint(str(path), device="cpu", converted_cache_dir=str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # The second load does not touch the original checkpoint
+    monkeypatch.setattr(Checkpoint, "get", None)
+    second = Transformer.from_checkpoint(str(path), device="cpu", converted_cache_dir=str(cache_dir))
+    for model in (first, second):
+        for (name, param), expected_param in zip(model.named_parameters(), expected.parameters()):
+            torch.testing.assert_close(param, expected_param, atol=0, rtol=0, msg=name)